@@ -0,0 +1,50 @@
+"""
+Expressive rendering of MIDI scores.
+
+The names below are imported from their module on first access, so ``import src`` is
+cheap and only the paths that need music21 (loading and transforming streams) import it.
+Annotation, alignment and note table arrays only need numpy.
+"""
+import importlib
+
+# name -> module defining it
+_API = {
+    "get_stream": "utils",
+    "save_midi": "utils",
+    "load_musicxml": "utils",
+    "read_musicxml": "musicxml",
+    "render": "render",
+    "load_plan": "render",
+    "render_incremental": "incremental",
+    "play": "playback",
+    "NoteTable": "notetable",
+    "MeasureIndex": "index",
+    "TempoMap": "tempo",
+    "read_annotations": "tempo",
+    "apply_tempo_map": "tempo",
+    "read_notes": "midi_io",
+    "write_midi": "midi_io",
+    "align": "alignment",
+    "align_performers": "alignment",
+    "process_corpus": "corpus",
+    "CorpusStatistics": "corpus",
+    "ExpressiveModel": "model",
+    "fit_performers": "model",
+    "evaluate_file": "evaluation",
+    "Reference": "evaluation",
+    "Variant": "variants",
+}
+
+__all__ = sorted(_API)
+
+
+def __getattr__(name):
+    if name not in _API:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_API[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_API))
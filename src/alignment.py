@@ -0,0 +1,226 @@
+import numpy as np
+
+from . import midi_io
+from .tempo import ANNOTATION_DIR, PERFORMERS, TempoMap, annotation_path
+
+# One row per score note (row of the NoteTable it was aligned from). Performance columns
+# are NaN / -1 for score notes the performer did not play.
+ALIGNMENT_DTYPE = np.dtype([
+    ('row', 'i4'),  # row of the NoteTable
+    ('part', 'i2'),
+    ('measure', 'i4'),
+    ('pitch', 'i2'),
+    ('score_onset', 'f8'),  # quarter lengths
+    ('score_duration', 'f8'),
+    ('matched', '?'),
+    ('performed', 'i4'),  # index of the performed note, -1 if unmatched
+    ('expected_onset', 'f8'),  # seconds, score onset through the tempo map
+    ('expected_duration', 'f8'),
+    ('onset', 'f8'),  # performed, seconds
+    ('duration', 'f8'),
+    ('velocity', 'i2'),
+    ('deviation', 'f8'),  # onset - expected_onset, seconds
+    ('articulation', 'f8'),  # duration / expected_duration
+    ('tempo', 'f8'),  # local tempo of the tempo map, quarter notes per minute
+])
+
+DEFAULT_WINDOW = 0.35
+
+_DIAGONAL, _SKIP_SCORE, _SKIP_PERFORMED = 0, 1, 2
+
+
+def _align_sequences(expected: np.ndarray, performed: np.ndarray, window: float) -> list:
+    """
+    Monotone alignment of two sorted onset sequences of the same pitch (dynamic time
+    warping with gaps). Matching costs the onset distance and is only allowed within
+    ``window`` seconds; leaving a note unmatched costs ``window``.
+
+    With the gap costs taken out (``C[i, j] - (i + j) * window``), a row only changes on
+    the band of performed notes within ``window`` of its expected onset, found with
+    np.searchsorted: left of the band it equals the previous row, right of it it is
+    constant. The cost row is updated in place on the band (one vectorized step, the run
+    of horizontal gaps being a cumulative minimum), and only the moves of the band are
+    kept, so time and memory grow with the number of notes times the band width.
+    :return: list of (score position, performed position) pairs
+    """
+    n, m = len(expected), len(performed)
+    if n == 0 or m == 0:
+        return []
+    lows = np.searchsorted(performed, expected - window, side='left')
+    highs = np.searchsorted(performed, expected + window, side='right')
+    cost = np.zeros(m + 1)
+    filled = 0  # the bands only move right: cost[filled + 1:] is stale, its value is cost[filled]
+    moves = []  # per row: moves of the band columns lows[i] + 1 .. highs[i]
+    tail_left = np.zeros(n, dtype=bool)  # right of the band, horizontal gaps beat the row above
+    for i in range(n):
+        low, high = int(lows[i]), int(highs[i])
+        if high > filled:
+            cost[filled + 1:high + 1] = cost[filled]
+            filled = high
+        if high == low:
+            moves.append(None)
+            continue
+        above = cost[low:high + 1].copy()
+        distance = np.abs(performed[low:high] - expected[i])
+        diagonal = np.where(distance <= window, above[:-1] + distance - 2 * window, np.inf)
+        move = np.where(diagonal <= above[1:], _DIAGONAL, _SKIP_SCORE).astype(np.int8)
+        row = np.minimum(diagonal, above[1:])
+        best = np.minimum.accumulate(np.r_[above[0], row])
+        move[best[:-1] < row] = _SKIP_PERFORMED
+        cost[low + 1:high + 1] = best[1:]
+        tail_left[i] = best[-1] < above[-1]
+        moves.append(move)
+    pairs = []
+    i, j = n, m
+    while i > 0 and j > 0:
+        low, high = int(lows[i - 1]), int(highs[i - 1])
+        if j > high:
+            if tail_left[i - 1]:
+                j = high
+            else:
+                i -= 1
+            continue
+        if j <= low:
+            i -= 1
+            continue
+        move = moves[i - 1][j - low - 1]
+        if move == _DIAGONAL:
+            pairs.append((i - 1, j - 1))
+            i, j = i - 1, j - 1
+        elif move == _SKIP_SCORE:
+            i -= 1
+        else:
+            j -= 1
+    return pairs[::-1]
+
+
+def align(table, performed: np.ndarray, tempo_map: TempoMap, window: float = DEFAULT_WINDOW) -> np.ndarray:
+    """
+    Match the notes of a performance to the notes of a score.
+
+    The tempo map (built from the downbeat and beat annotations of the performance) gives
+    the expected time of every score note; notes of the same pitch are then aligned in
+    time order, only within ``window`` seconds of their expected time. Because the
+    annotations pin every beat, the band stays narrow and the alignment runs in time
+    close to linear in the number of notes.
+    :param table: NoteTable of the score, onsets in quarter lengths
+    :param performed: np.ndarray with midi_io.PERFORMED_DTYPE, see midi_io.read_notes
+    :param tempo_map: TempoMap of the performance, in the performance's own seconds
+    :param window: largest onset distance of a match, in seconds
+    :return: np.ndarray with ALIGNMENT_DTYPE, one row per row of the table
+    """
+    data = table.data
+    result = np.zeros(len(data), dtype=ALIGNMENT_DTYPE)
+    result['row'] = np.arange(len(data))
+    for name in ('part', 'measure', 'pitch'):
+        result[name] = data[name]
+    result['score_onset'] = data['onset']
+    result['score_duration'] = data['duration']
+    result['expected_onset'] = tempo_map.seconds(data['onset'])
+    result['expected_duration'] = tempo_map.seconds(data['onset'] + data['duration']) - result['expected_onset']
+    result['tempo'] = tempo_map.tempo(data['onset'])
+    result['performed'] = -1
+
+    score_order = np.lexsort((result['expected_onset'], data['pitch']))
+    performed_order = np.lexsort((performed['onset'], performed['pitch']))
+    pitches = np.union1d(data['pitch'], performed['pitch'])
+    score_bounds = np.searchsorted(data['pitch'][score_order], pitches)
+    score_ends = np.searchsorted(data['pitch'][score_order], pitches, side='right')
+    performed_bounds = np.searchsorted(performed['pitch'][performed_order], pitches)
+    performed_ends = np.searchsorted(performed['pitch'][performed_order], pitches, side='right')
+    for low, high, p_low, p_high in zip(score_bounds, score_ends, performed_bounds, performed_ends):
+        rows = score_order[low:high]
+        candidates = performed_order[p_low:p_high]
+        for i, j in _align_sequences(result['expected_onset'][rows], performed['onset'][candidates], window):
+            result['performed'][rows[i]] = candidates[j]
+
+    matched = result['performed'] >= 0
+    played = performed[result['performed'][matched]]
+    result['matched'] = matched
+    result['onset'] = np.nan
+    result['duration'] = np.nan
+    result['velocity'] = -1
+    result['onset'][matched] = played['onset']
+    result['duration'][matched] = played['offset'] - played['onset']
+    result['velocity'][matched] = played['velocity']
+    result['deviation'] = result['onset'] - result['expected_onset']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result['articulation'] = np.where(result['expected_duration'] > 0,
+                                          result['duration'] / result['expected_duration'], np.nan)
+    return result
+
+
+def unmatched_performed(alignment: np.ndarray, performed: np.ndarray) -> np.ndarray:
+    """
+    Performed notes matched to no score note (wrong notes, added ornaments, ...).
+    :param alignment: np.ndarray with ALIGNMENT_DTYPE
+    :param performed: np.ndarray with midi_io.PERFORMED_DTYPE
+    :return: np.ndarray with midi_io.PERFORMED_DTYPE
+    """
+    used = np.zeros(len(performed), dtype=bool)
+    used[alignment['performed'][alignment['matched']]] = True
+    return performed[~used]
+
+
+def measure_statistics(alignment: np.ndarray) -> np.ndarray:
+    """
+    Per-measure summary of an alignment: mean velocity, mean and spread of the timing
+    deviation, mean articulation and share of matched notes, over the matched notes.
+    :param alignment: np.ndarray with ALIGNMENT_DTYPE
+    :return: structured array with fields measure, notes, matched, velocity, deviation,
+        deviation_std, articulation
+    """
+    measures, inverse = np.unique(alignment['measure'], return_inverse=True)
+    matched = alignment['matched']
+    counts = np.bincount(inverse, minlength=len(measures))
+    hits = np.bincount(inverse, weights=matched, minlength=len(measures))
+
+    def mean(values, mask):
+        total = np.bincount(inverse[mask], weights=values[mask], minlength=len(measures))
+        number = np.bincount(inverse[mask], minlength=len(measures))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return total / number
+
+    deviation = np.nan_to_num(alignment['deviation'])
+    mean_deviation = mean(deviation, matched)
+    spread = mean((deviation - mean_deviation[inverse]) ** 2, matched)
+    articulated = matched & np.isfinite(alignment['articulation'])
+    stats = np.zeros(len(measures), dtype=[('measure', 'i4'), ('notes', 'i4'), ('matched', 'f8'),
+                                           ('velocity', 'f8'), ('deviation', 'f8'), ('deviation_std', 'f8'),
+                                           ('articulation', 'f8')])
+    stats['measure'] = measures
+    stats['notes'] = counts
+    stats['matched'] = hits / np.maximum(counts, 1)
+    stats['velocity'] = mean(alignment['velocity'].astype(float), matched)
+    stats['deviation'] = mean_deviation
+    stats['deviation_std'] = np.sqrt(spread)
+    stats['articulation'] = mean(np.nan_to_num(alignment['articulation']), articulated)
+    return stats
+
+
+def align_performer(table, name: str, directory: str = ANNOTATION_DIR, window: float = DEFAULT_WINDOW) -> tuple:
+    """
+    Align one of the recorded renditions (``<name>.mid`` and ``<name>_annotations.txt``)
+    to a score.
+    :param table: NoteTable of the score
+    :param name: performer, see tempo.PERFORMERS
+    :param directory: str
+    :param window: largest onset distance of a match, in seconds
+    :return: (alignment, performed notes)
+    """
+    performed = midi_io.read_notes(f"{directory}/{name}.mid")
+    tempo_map = TempoMap.from_annotations(annotation_path(name, directory))
+    return align(table, performed, tempo_map, window), performed
+
+
+def align_performers(table, performers=PERFORMERS, directory: str = ANNOTATION_DIR,
+                     window: float = DEFAULT_WINDOW) -> dict:
+    """
+    Align every recorded rendition to a score.
+    :param table: NoteTable of the score
+    :param performers: iterable of performer names
+    :param directory: str
+    :param window: largest onset distance of a match, in seconds
+    :return: dict performer -> alignment
+    """
+    return {name: align_performer(table, name, directory, window)[0] for name in performers}
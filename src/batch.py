@@ -0,0 +1,217 @@
+"""
+Render many expressive variants of one or more scores in parallel.
+
+Usage: python -m src.batch jobs.json out_dir [--workers N]
+
+The command exits with status 1 when a job failed.
+
+The jobs file holds a base ``plan`` (see src.render), a list of ``inputs`` and a ``grid``
+of parameter overrides; every combination of input, grid point and seed is one job.
+With --evaluate, each rendition is also scored against the recordings (see
+src.evaluation) and the mean scores go into its manifest entry. With --variants, each
+rendition is stored as its differences from the input score (a .dmv file, see
+src.variants) instead of a MIDI file.
+"""
+import argparse
+import copy
+import functools
+import hashlib
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .evaluation import evaluate_file, summarize
+from .notetable import NoteTable
+from .render import load_plan, render
+from .utils import get_stream, save_midi
+from .variants import Variant
+
+MANIFEST = "manifest.jsonl"
+
+
+def expand_jobs(plan: dict, inputs: list, grid: dict = None, seeds: list = (0,)) -> list:
+    """
+    Build one job per combination of input file, grid point and seed.
+
+    ``grid`` maps ``"<transform>.<argument>"`` to the list of values to try; every step of
+    the plan using that transform gets the value.
+    :param plan: dict, base performance plan
+    :param inputs: list of input MIDI files
+    :param grid: dict of parameter lists
+    :param seeds: random seeds
+    :return: list of job dicts with "id", "input", "seed", "params" and "plan"
+    """
+    grid = grid or {}
+    names = sorted(grid)
+    jobs = []
+    for filename, values, seed in itertools.product(inputs, itertools.product(*(grid[n] for n in names)), seeds):
+        params = dict(zip(names, values))
+        job_plan = copy.deepcopy(plan)
+        for name, value in params.items():
+            transform, argument = name.rsplit(".", 1)
+            for step in job_plan.get("steps", []):
+                if step["transform"] == transform:
+                    step.setdefault("args", {})[argument] = value
+        key = json.dumps([os.path.abspath(filename), params, seed, job_plan], sort_keys=True)
+        jobs.append({"id": hashlib.sha1(key.encode()).hexdigest()[:16], "input": filename, "seed": seed,
+                     "params": params, "plan": job_plan})
+    return jobs
+
+
+@functools.lru_cache(maxsize=None)
+def base_table(filename: str) -> NoteTable:
+    """
+    Note table of an input score, built once per worker, that variants are stored against.
+    :param filename: str
+    :return: NoteTable
+    """
+    return NoteTable.from_stream(get_stream(filename))
+
+
+def run_job(job: dict, output_dir: str, evaluate: bool = False, variants: bool = False) -> dict:
+    """
+    Render one job and save it to ``<output_dir>/<id>.mid``, or ``<id>.dmv`` with variants.
+    :param job: dict, see expand_jobs
+    :param output_dir: str
+    :param evaluate: also score the rendition, see src.evaluation
+    :param variants: store the rendition as a variant of its input, see src.variants
+    :return: dict, manifest entry
+    """
+    start = time.perf_counter()
+    # get_stream parses each input once per worker and hands out fresh copies afterwards
+    my_stream = render(get_stream(job["input"]), job["plan"], rng=job["seed"])
+    output = os.path.join(output_dir, job["id"] + (".dmv" if variants else ".mid"))
+    if variants:
+        variant = Variant.from_stream(base_table(job["input"]), my_stream,
+                                      meta={"input": job["input"], "seed": job["seed"], "params": job["params"]})
+        variant.save(output)
+    else:
+        save_midi(my_stream, output + ".tmp")
+        os.replace(output + ".tmp", output)
+    entry = {"id": job["id"], "input": job["input"], "seed": job["seed"], "params": job["params"],
+             "output": os.path.basename(output), "seconds": time.perf_counter() - start}
+    if evaluate:
+        if variants:
+            # the evaluation reads MIDI files, export a temporary one
+            midi = output + ".mid"
+            variant.to_midi(base_table(job["input"]), midi)
+            entry["scores"] = summarize(evaluate_file(midi))["mean"]
+            os.remove(midi)
+        else:
+            entry["scores"] = summarize(evaluate_file(output))["mean"]
+    return entry
+
+
+def completed_jobs(output_dir: str, evaluate: bool = False, variants: bool = False) -> set:
+    """
+    Ids of the jobs already listed in the manifest of an output directory, with an output
+    of the kind asked for (a .dmv file with variants, a MIDI file otherwise) and, when
+    evaluating, with scores.
+    :param output_dir: str
+    :param evaluate: only count the jobs that were scored
+    :param variants: only count the jobs stored as variants, else only the MIDI files
+    :return: set of str
+    """
+    path = os.path.join(output_dir, MANIFEST)
+    if not os.path.exists(path):
+        return set()
+    suffix = ".dmv" if variants else ".mid"
+    done = set()
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # line cut short by an interrupted run
+            if not entry["output"].endswith(suffix) or (evaluate and "scores" not in entry):
+                continue
+            if os.path.exists(os.path.join(output_dir, entry["output"])):
+                done.add(entry["id"])
+    return done
+
+
+def open_manifest(path: str):
+    """
+    Open a JSON-lines manifest for appending. A line cut short by an interrupted run is
+    ended first, so the next entry starts on a line of its own.
+    :param path: str
+    :return: text file
+    """
+    ended = True
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            ended = f.read(1) == b"\n"
+    manifest = open(path, "a")
+    if not ended:
+        manifest.write("\n")
+    return manifest
+
+
+def run_batch(jobs: list, output_dir: str, workers: int = None, progress=sys.stderr, evaluate: bool = False,
+              variants: bool = False) -> dict:
+    """
+    Render jobs over a process pool, appending each result to the manifest as it
+    completes. Jobs already in the manifest with the same kind of output are skipped, so an
+    interrupted run resumes.
+    :param jobs: list of job dicts, see expand_jobs
+    :param output_dir: str
+    :param workers: number of worker processes, os.cpu_count() if None
+    :param progress: file receiving progress lines, or None
+    :param evaluate: also score every rendition, see run_job
+    :param variants: store the renditions as variants, see run_job
+    :return: dict, summary with counts and throughput
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    done = completed_jobs(output_dir, evaluate, variants)
+    pending = [job for job in jobs if job["id"] not in done]
+    start = time.perf_counter()
+    failures = []
+    rendered = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool, \
+            open_manifest(os.path.join(output_dir, MANIFEST)) as manifest:
+        futures = {pool.submit(run_job, job, output_dir, evaluate, variants): job for job in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                failures.append({"id": job["id"], "error": repr(e)})
+                continue
+            manifest.write(json.dumps(entry) + "\n")
+            manifest.flush()
+            rendered += 1
+            if progress is not None:
+                elapsed = time.perf_counter() - start
+                print(f"[{rendered + len(failures)}/{len(pending)}] {entry['id']} {entry['seconds']:.2f}s "
+                      f"({rendered / elapsed:.2f} jobs/s)", file=progress)
+    elapsed = time.perf_counter() - start
+    return {"jobs": len(jobs), "skipped": len(jobs) - len(pending), "rendered": rendered, "failed": failures,
+            "seconds": elapsed, "jobs_per_second": rendered / elapsed if elapsed > 0 else 0.0}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.batch", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("jobs", help="JSON file with plan, inputs, grid and seeds")
+    parser.add_argument("output_dir", help="directory receiving the MIDI files and the manifest")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--evaluate", action="store_true", help="score every rendition against the recordings")
+    parser.add_argument("--variants", action="store_true",
+                        help="store each rendition as a compact variant of its input (.dmv) instead of MIDI")
+    args = parser.parse_args(argv)
+
+    with open(args.jobs) as f:
+        spec = json.load(f)
+    plan = spec["plan"] if isinstance(spec["plan"], dict) else load_plan(spec["plan"])
+    jobs = expand_jobs(plan, spec["inputs"], spec.get("grid"), spec.get("seeds", [0]))
+    summary = run_batch(jobs, args.output_dir, args.workers, evaluate=args.evaluate, variants=args.variants)
+    print(json.dumps(summary, indent=2))
+    if summary["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
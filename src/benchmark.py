@@ -0,0 +1,417 @@
+"""
+Benchmark the expressive transforms on the score and on scaled-up copies of it.
+
+Every case runs on the corrected score and on synthetic scores made of 10 and 100 copies
+of its measures. A case covering measures [a, b] of the score covers the same measures in
+every copy, so a transform that scales linearly keeps the same cost per measure and a
+quadratic one (e.g. repeated ``measure()`` lookups) shows a growing cost.
+
+With ``--startup``, it instead times the import of every module of the package in a fresh
+interpreter and reports whether music21 and numpy were loaded.
+
+Usage: python -m src.benchmark [--scales 1 10 100] [--cases accelerate_measure ...]
+                               [--json results.json] [--compare baseline.json]
+       python -m src.benchmark --startup
+"""
+import argparse
+import copy
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from . import midi_io
+from .index import MeasureIndex
+from .render import TRANSFORMS, transform_function
+
+# name -> keyword arguments on the original score, following plans/berceuse.json where the
+# plan uses the transform
+CASES = {
+    "adjust_note_in_measures": {"start_measure": 1, "end_measure": 69, "note_index": 0, "pitch_interval": 1},
+    "accentuate_highest_note_in_measure": {"measure_number": 37, "accent_factor": 1.2},
+    "increase_volume_of_highest_note_in_triples": {"start_measure_number": 40, "end_measure_number": 41},
+    "increase_volume_of_higher_notes_in_track": {"start_measure_number": 27, "end_measure_number": 30},
+    "accentuate_melody": {"start_measure": 1, "end_measure": 69, "volume_increase": 5},
+    "add_pedal_event": {"start_measure": 1, "end_measure": 68},
+    "apply_pedal_to_measures": {"start_measure": 1, "end_measure": 68},
+    "apply_trill_to_hand_note": {"hand": "right", "measure_number": 43, "note_index": -2, "semitones": 1,
+                                 "trill_speed": 0.25, "trill_duration": 1},
+    "apply_ornaments": {"ornaments": [
+        {"kind": kind, "part": measure % 2, "measure": measure, "note_index": 0, "speed": 0.125}
+        for measure, kind in zip(range(1, 70), ["trill", "mordent", "turn", "grace"] * 18)]},
+    "change_dynamics_decrescendo_measure": {"measure": 19},
+    "change_dynamics_crescendo_measure": {"measure": 20},
+    "classical_dynamics_shape": {"measure": 24},
+    "change_dynamics_for_whole_piece": {},
+    "apply_notated_hairpins": {"score": "Berceuse_op_57/xml_score.musicxml"},
+    "change_velocity_measures_in_stream": {"start_measure": 1, "end_measure": 69, "velocity_factor": 1.1},
+    "randomize_velocity_in_measures": {"start_measure": 31, "end_measure": 46, "delta_range": 2},
+    "change_duration_specific_beats_in_stream": {"start_measure": 1, "end_measure": 69, "target_beats": [1],
+                                                 "duration_factor": 1.0},
+    "adjust_durations_for_specific_measure": {"measure_number": 1},
+    "execute_adjust_durations_for_specific_measure": {"start_measure_number": 1, "end_measure_number": 14},
+    "change_duration_in_measure": {"measure_number": 15, "target_duration": 0.5, "new_duration": 0.3},
+    "execute_change_duration_in_measure": {"start_measure_number": 15, "end_measure_number": 18},
+    "accelerate_measure": {"measure_number": 19, "accelerate_rate": 1.2},
+}
+
+IO_CASES = ("get_stream", "save_midi", "save_midi_fast")
+
+# notated markings tiled by the apply_notated_hairpins case
+HAIRPIN_MARKINGS = ("dynamic", "wedge")
+
+# modules imported by the startup benchmark, "src" being the package entry point alone
+STARTUP_MODULES = ("src", "src.tempo", "src.midi_io", "src.alignment", "src.notetable", "src.index",
+                   "src.controllers", "src.curves", "src.incremental", "src.render", "src.model", "src.evaluation",
+                   "src.playback", "src.musicxml", "src.variants", "src.utils")
+
+_STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(seconds, "music21" in sys.modules, "numpy" in sys.modules)
+"""
+
+
+def tile_score(s, copies: int):
+    """
+    Build a score made of ``copies`` copies of the measures of s, numbered after each other.
+    :param s: music21 Score
+    :param copies: int
+    :return: music21 Score
+    """
+    from music21 import stream
+
+    if copies == 1:
+        return copy.deepcopy(s)
+    tiled = stream.Score()
+    for part in s.parts:
+        new_part = stream.Part()
+        for element in part.getElementsNotOfClass(stream.Measure):
+            new_part.insert(element.offset, copy.deepcopy(element))
+        measures = list(part.getElementsByClass(stream.Measure))
+        count = max(m.number for m in measures)
+        length = measures[-1].offset + measures[-1].quarterLength
+        for k in range(copies):
+            for m in measures:
+                new_measure = copy.deepcopy(m)
+                new_measure.number = m.number + k * count
+                new_part.insert(m.offset + k * length, new_measure)
+        tiled.insert(0, new_part)
+    return tiled
+
+
+def measure_count(s) -> int:
+    """
+    Number of measures of the first part.
+    """
+    return len(MeasureIndex(s).numbers())
+
+
+def _add_pedal_events(s, start_measure, end_measure, index=None):
+    """
+    add_pedal_event on every measure of the range, with the pattern of apply_pedal_to_measures
+    in 6/8: down on beats 1 and 4, up on beats 3 and 6.
+    """
+    from .articulations import add_pedal_event
+    from .index import measure_index
+
+    index = measure_index(s, index)
+    for number in index.numbers():
+        if start_measure <= number <= end_measure:
+            m = index.get(number)
+            for beat, is_pedal_down in ((1, True), (3, False), (4, True), (6, False)):
+                add_pedal_event(s, m, beat, is_pedal_down, m.offset)
+    return s
+
+
+def _apply_notated_hairpins(s, markings, index=None):
+    """
+    apply_notated_hairpins with the markings of a MusicXML score attached to the index of s.
+    """
+    from .dynamics import apply_notated_hairpins
+    from .index import measure_index
+
+    index = measure_index(s, index)
+    index.markings = markings
+    return apply_notated_hairpins(s, index=index)
+
+
+# cases run through a wrapper rather than the transform of the same name
+CASE_FUNCTIONS = {"add_pedal_event": _add_pedal_events, "apply_notated_hairpins": _apply_notated_hairpins}
+
+
+def case_function(name: str):
+    return CASE_FUNCTIONS[name] if name in CASE_FUNCTIONS else transform_function(name)
+
+
+def tiled_markings(filename: str, copies: int, count: int):
+    """
+    Dynamics and hairpins of a MusicXML score repeated in every copy of the score.
+    :param filename: MusicXML file, relative to the repository if not absolute
+    :param copies: number of copies of the score
+    :param count: number of measures of the original score
+    :return: np.ndarray with musicxml.MARKING_DTYPE
+    """
+    import numpy as np
+
+    from .musicxml import read_musicxml
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    score = read_musicxml(os.path.join(root, filename))
+    markings = score.markings[np.isin(score.markings['kind'], HAIRPIN_MARKINGS)]
+    markings['row'] = -1
+    measures = score.measures
+    length = float((measures['offset'] + measures['length']).max()) if len(measures) else 0.0
+    tiled = []
+    for k in range(copies):
+        shifted = markings.copy()
+        for field in ("measure", "end_measure"):
+            shifted[field] += k * count
+        for field in ("onset", "end_onset"):
+            shifted[field] += k * length
+        tiled.append(shifted)
+    return np.concatenate(tiled)
+
+
+def tiled_calls(name: str, args: dict, copies: int, count: int) -> list:
+    """
+    Keyword arguments of the calls covering the measures of a case in every copy.
+    :param name: transform name
+    :param args: keyword arguments on the original score
+    :param copies: number of copies of the score
+    :param count: number of measures of the original score
+    :return: list of (kwargs, number of measures covered)
+    """
+    if name == "change_dynamics_for_whole_piece":
+        from .dynamics import WHOLE_PIECE_HAIRPINS, whole_piece_curve
+
+        segments = []
+        hairpins = []
+        for k in range(copies):
+            for segment in whole_piece_curve()["segments"]:
+                start, end = segment["measures"]
+                segments.append(dict(segment, measures=[start + k * count, end + k * count]))
+            hairpins += [(measure + k * count, *rest) for measure, *rest in WHOLE_PIECE_HAIRPINS]
+        return [({"spec": {"segments": segments}, "hairpins": hairpins}, copies * count)]
+    if name == "apply_ornaments":
+        ornaments = [dict(ornament, measure=ornament["measure"] + k * count)
+                     for k in range(copies) for ornament in args["ornaments"]]
+        return [({"ornaments": ornaments}, copies * len({o["measure"] for o in args["ornaments"]}))]
+    if name == "apply_notated_hairpins":
+        markings = tiled_markings(args["score"], copies, count)
+        wedges = markings[markings['kind'] == "wedge"]
+        covered = len({m for w in wedges for m in range(int(w['measure']), int(w['end_measure']) + 1)})
+        return [({"markings": markings}, covered)]
+    if name == "add_pedal_event":
+        start_arg, end_arg = "start_measure", "end_measure"
+    else:
+        _, _, start_arg, end_arg = TRANSFORMS[name]
+    calls = []
+    for k in range(copies):
+        kwargs = dict(args)
+        kwargs[start_arg] = args[start_arg] + k * count
+        if end_arg != start_arg:
+            kwargs[end_arg] = args[end_arg] + k * count
+        calls.append((kwargs, kwargs[end_arg] - kwargs[start_arg] + 1))
+    return calls
+
+
+def _run(function, s, calls, shared_index: bool):
+    index = MeasureIndex(s) if shared_index else None
+    for kwargs, _ in calls:
+        if shared_index:
+            kwargs = dict(kwargs, index=index)
+        s = function(s, **kwargs)
+    return s
+
+
+def measure(run, prepare, memory: bool = True) -> dict:
+    """
+    Time one run and, in a second run, record its peak traced memory. ``prepare`` builds
+    the input of each run outside of the measurement.
+    :param run: callable taking the prepared input
+    :param prepare: callable returning a fresh input
+    :param memory: bool, measure the peak memory
+    :return: dict with "seconds" and "peak_bytes"
+    """
+    argument = prepare()
+    start = time.perf_counter()
+    run(argument)
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        argument = prepare()
+        tracemalloc.start()
+        try:
+            run(argument)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {"seconds": seconds, "peak_bytes": peak}
+
+
+def run_benchmarks(filename: str, scales=(1, 10, 100), cases=None, memory: bool = True,
+                   shared_index: bool = False, progress=None) -> list:
+    """
+    Run the benchmark cases at every scale.
+    :param filename: input MIDI file
+    :param scales: numbers of copies of the score
+    :param cases: case names (CASES and IO_CASES), every case if None
+    :param memory: bool, measure the peak memory of each case
+    :param shared_index: bool, pass one MeasureIndex to all the calls of a case, like src.render
+    :param progress: optional callable receiving each result as it is produced
+    :return: list of result dicts
+    """
+    from .utils import get_stream, save_midi
+
+    cases = list(CASES) + list(IO_CASES) if cases is None else list(cases)
+    for name in cases:
+        if name not in CASES and name not in IO_CASES:
+            raise ValueError(f"Unknown benchmark case {name!r}.")
+    original = get_stream(filename)
+    count = measure_count(original)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for copies in scales:
+            tiled = tile_score(original, copies)
+            measures = measure_count(tiled)
+            for name in cases:
+                if name == "get_stream":
+                    source = os.path.join(directory, f"tiled_{copies}.mid")
+                    midi_io.write_stream(tiled, source)
+                    result = measure(lambda path: get_stream(path, cache=None), lambda: source, memory)
+                    covered = measures
+                elif name in ("save_midi", "save_midi_fast"):
+                    target = os.path.join(directory, "out.mid")
+                    fast = name == "save_midi_fast"
+                    result = measure(lambda s: save_midi(s, target, fast=fast), lambda: tiled, memory)
+                    covered = measures
+                else:
+                    calls = tiled_calls(name, CASES[name], copies, count)
+                    function = case_function(name)
+                    covered = sum(c for _, c in calls)
+                    try:
+                        result = measure(lambda s: _run(function, s, calls, shared_index),
+                                         lambda: copy.deepcopy(tiled), memory)
+                    except Exception as e:
+                        # report the failing transform and keep going with the other cases
+                        result = {"seconds": 0.0, "peak_bytes": None, "error": f"{type(e).__name__}: {e}"}
+                result.update({"case": name, "scale": copies, "measures": measures, "covered": covered,
+                               "ms_per_measure": result["seconds"] * 1000 / max(covered, 1)})
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+    return results
+
+
+def startup_time(module: str, repeat: int = 3) -> dict:
+    """
+    Time the import of a module in fresh interpreters, keeping the fastest run.
+    :param module: dotted module name
+    :param repeat: number of interpreters
+    :return: dict with "case", "seconds", "music21" and "numpy"
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT.format(module=module)], env=env,
+                                capture_output=True, text=True, check=True).stdout.split()
+        runs.append((float(output[0]), output[1] == "True", output[2] == "True"))
+    seconds, music21, numpy = min(runs)
+    return {"case": f"import {module}", "scale": 1, "seconds": seconds, "music21": music21, "numpy": numpy}
+
+
+def run_startup(modules=STARTUP_MODULES, repeat: int = 3, progress=None) -> list:
+    """
+    Run the startup benchmark on every module.
+    :param modules: dotted module names
+    :param repeat: number of interpreters per module
+    :param progress: optional callable receiving each result as it is produced
+    :return: list of result dicts
+    """
+    results = []
+    for module in modules:
+        results.append(startup_time(module, repeat))
+        if progress is not None:
+            progress(results[-1])
+    return results
+
+
+def format_startup(result: dict) -> str:
+    return (f"{result['case']:<48}{result['seconds'] * 1000:>12.1f}"
+            f"{'yes' if result['music21'] else 'no':>10}{'yes' if result['numpy'] else 'no':>8}")
+
+
+STARTUP_HEADER = f"{'case':<48}{'ms':>12}{'music21':>10}{'numpy':>8}"
+
+
+def compare(results: list, baseline: list, tolerance: float = 1.5) -> list:
+    """
+    Find the results slower than the baseline by more than ``tolerance`` times.
+    :param results: list of result dicts
+    :param baseline: list of result dicts from an earlier run
+    :param tolerance: allowed slowdown factor
+    :return: list of (case, scale, baseline seconds, seconds)
+    """
+    previous = {(r["case"], r["scale"]): r["seconds"] for r in baseline}
+    regressions = []
+    for r in results:
+        before = previous.get((r["case"], r["scale"]))
+        if before is not None and not r.get("error") and r["seconds"] > before * tolerance:
+            regressions.append((r["case"], r["scale"], before, r["seconds"]))
+    return regressions
+
+
+def format_result(result: dict) -> str:
+    if result.get("error"):
+        return f"{result['case']:<48}{result['scale']:>6}{result['measures']:>9}  error: {result['error']}"
+    peak = "-" if result["peak_bytes"] is None else f"{result['peak_bytes'] / 2 ** 20:.1f}"
+    return (f"{result['case']:<48}{result['scale']:>6}{result['measures']:>9}{result['seconds'] * 1000:>12.1f}"
+            f"{result['ms_per_measure']:>10.3f}{peak:>10}")
+
+
+HEADER = f"{'case':<48}{'scale':>6}{'measures':>9}{'ms':>12}{'ms/meas':>10}{'peak MB':>10}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.benchmark", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", default="./Berceuse_op_57/corrected_midi_score.mid", help="input MIDI file")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100],
+                        help="numbers of copies of the score")
+    parser.add_argument("--cases", nargs="+", help="cases to run, all by default")
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory runs")
+    parser.add_argument("--shared-index", action="store_true",
+                        help="share one measure index between the calls of a case")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed slowdown factor, 1.5 by default")
+    parser.add_argument("--startup", action="store_true", help="time the imports of the package modules instead")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        print(STARTUP_HEADER)
+        results = run_startup(progress=lambda result: print(format_startup(result), flush=True))
+    else:
+        print(HEADER)
+        results = run_benchmarks(args.input, args.scales, args.cases, not args.no_memory, args.shared_index,
+                                 progress=lambda result: print(format_result(result), flush=True))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for case, scale, before, after in regressions:
+            print(f"regression: {case} x{scale} {before * 1000:.1f} ms -> {after * 1000:.1f} ms", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import numpy as np
+
+from . import midi_io
+from .index import MeasureIndex, measure_index
+from .metric import time_signature_map
+
+SUSTAIN_PEDAL = 64
+SOSTENUTO_PEDAL = 66
+SOFT_PEDAL = 67
+
+# Time-indexed controller events, sorted by time. ``time`` is in quarter lengths from the
+# start of the score, ``part`` is the 0-based part index the event is sent to.
+CONTROLLER_DTYPE = np.dtype([
+    ('time', 'f8'),
+    ('part', 'i2'),
+    ('control', 'u1'),
+    ('value', 'u1'),
+])
+
+# Pedal patterns per time signature, as (pulse, pedal down) pairs. Pulses count the
+# denominator unit from 1, so in 6/8 the pedal goes down on the 1st eighth, up on the
+# 3rd, down on the 4th and up on the 6th.
+PEDAL_PATTERNS = {
+    "6/8": [(1, True), (3, False), (4, True), (6, False)],
+    "3/4": [(1, True), (3, False)],
+    "4/4": [(1, True), (2, False), (3, True), (4, False)],
+}
+
+EDITORIAL_KEY = "controllers"
+
+
+class ControllerTrack:
+    """
+    Sorted array of controller events (sustain, soft pedal, any CC) kept next to a score.
+
+    Events are inserted in bulk and merged into the MIDI output in the same pass as the
+    notes, see midi_events and merge_into_midi_file.
+    """
+
+    def __init__(self, events: np.ndarray = None):
+        self.events = np.zeros(0, dtype=CONTROLLER_DTYPE) if events is None else np.sort(events, order='time',
+                                                                                           kind='stable')
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, times, control: int, values, parts=0):
+        """
+        Insert events in bulk, keeping the array sorted by time. Events at the same time
+        keep their insertion order.
+        :param times: float or array of quarter-length times
+        :param control: MIDI controller number
+        :param values: int or array of controller values (0-127)
+        :param parts: part index or array of part indices
+        :return: self
+        """
+        times, values, parts = np.broadcast_arrays(np.asarray(times, dtype=float), np.asarray(values),
+                                                   np.asarray(parts))
+        new = np.zeros(times.size, dtype=CONTROLLER_DTYPE)
+        new['time'] = times.ravel()
+        new['part'] = parts.ravel()
+        new['control'] = control
+        new['value'] = np.clip(values.ravel(), 0, 127)
+        merged = np.concatenate([self.events, new])
+        self.events = merged[np.argsort(merged['time'], kind='stable')]
+        return self
+
+    def between(self, start: float, end: float) -> np.ndarray:
+        """
+        Events with start <= time < end.
+        :param start: quarter-length time
+        :param end: quarter-length time
+        :return: np.ndarray with CONTROLLER_DTYPE
+        """
+        low, high = np.searchsorted(self.events['time'], [start, end], side='left')
+        return self.events[low:high]
+
+    def remove(self, start: float, end: float, control: int = None):
+        """
+        Remove the events with start <= time < end, optionally only one controller.
+        :param start: quarter-length time
+        :param end: quarter-length time
+        :param control: optional MIDI controller number
+        :return: self
+        """
+        mask = (self.events['time'] >= start) & (self.events['time'] < end)
+        if control is not None:
+            mask &= self.events['control'] == control
+        self.events = self.events[~mask]
+        return self
+
+    def midi_events(self, ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER, origin: float = 0.0) -> np.ndarray:
+        """
+        Convert to midi_io events, one track per part (part 0 is track 1).
+        :param ticks_per_quarter: MIDI resolution
+        :param origin: quarter-length time mapped to tick 0; earlier events are dropped
+        :return: np.ndarray with midi_io.EVENT_DTYPE
+        """
+        events = self.events[self.events['time'] >= origin]
+        # rounded on the absolute time, so a window gets the ticks of the whole track
+        ticks = (np.round(events['time'] * ticks_per_quarter) - np.round(origin * ticks_per_quarter)).astype(np.int64)
+        return midi_io.make_events(events['part'].astype(np.int64) + 1, ticks, midi_io.CONTROL,
+                                   np.minimum(events['part'], 15), events['control'], events['value'])
+
+
+def controller_track(s) -> ControllerTrack:
+    """
+    Return the controller track stored with a stream, creating an empty one if needed.
+    It lives in the stream's editorial, so it follows deep copies and the parse cache.
+    :param s: music21 stream
+    :return: ControllerTrack
+    """
+    if EDITORIAL_KEY not in s.editorial:
+        s.editorial[EDITORIAL_KEY] = ControllerTrack()
+    return s.editorial[EDITORIAL_KEY]
+
+
+def stored_controller_track(s):
+    """
+    Return the controller track of a stream, or None if nothing was added.
+    :param s: music21 stream
+    :return: ControllerTrack or None
+    """
+    track = s.editorial.get(EDITORIAL_KEY)
+    return track if track is not None and len(track) else None
+
+
+def pedal_pattern(time_signature) -> list:
+    """
+    Pedal pattern of a time signature: PEDAL_PATTERNS, or down on the first pulse and up
+    on the last one.
+    :param time_signature: music21.meter.TimeSignature
+    :return: list of (pulse, pedal down)
+    """
+    if time_signature.ratioString in PEDAL_PATTERNS:
+        return PEDAL_PATTERNS[time_signature.ratioString]
+    return [(1, True), (time_signature.numerator, False)]
+
+
+def add_pedal_to_measures(s, start_measure: int, end_measure: int, index: MeasureIndex = None,
+                          pattern: list = None, control: int = SUSTAIN_PEDAL, parts=None) -> ControllerTrack:
+    """
+    Insert pedal events for a measure range in one bulk insertion, following the pattern
+    of each measure's time signature.
+    :param s: music21 stream
+    :param start_measure: first measure number (inclusive)
+    :param end_measure: last measure number (inclusive)
+    :param index: optional measure index of s, built once if not given
+    :param pattern: optional list of (pulse, pedal down) used for every measure
+    :param control: MIDI controller number, SUSTAIN_PEDAL by default
+    :param parts: part indices receiving the events, every part if None
+    :return: ControllerTrack of s
+    """
+    index = measure_index(s, index)
+    parts = list(range(len(index.parts))) if parts is None else list(parts)
+    signatures = time_signature_map(index)
+    times = []
+    values = []
+    for number in index.numbers():
+        if not start_measure <= number <= end_measure:
+            continue
+        m = index.get(number)
+        ts = signatures[number]
+        if ts is None:
+            continue
+        measure_pattern = pattern if pattern is not None else pedal_pattern(ts)
+        pulses = np.array([pulse for pulse, _ in measure_pattern], dtype=float)
+        pulse_length = float(m.quarterLength) / ts.numerator
+        times.append(float(m.offset) + (pulses - 1) * pulse_length)
+        values.append([127 if down else 0 for _, down in measure_pattern])
+    track = controller_track(s)
+    if times:
+        times = np.concatenate(times)
+        values = np.concatenate(values)
+        track.add(np.repeat(times, len(parts)), control, np.repeat(values, len(parts)),
+                  np.tile(parts, len(times)))
+    return track
+
+
+def merge_into_midi_file(mf, track: ControllerTrack):
+    """
+    Merge controller events into a music21 MidiFile built by ``streamToMidiFile``, in one
+    sorted pass per MIDI track. Part p goes to track 1 + p, the p-th track after the
+    conductor track (as in midi_events), on the channel of that track's notes.
+    :param mf: music21.midi.MidiFile
+    :param track: ControllerTrack
+    :return: mf
+    """
+    from music21 import midi
+
+    part_count = int(track.events['part'].max()) + 1 if len(track) else 0
+    for part in range(part_count):
+        mt = mf.tracks[min(1 + part, len(mf.tracks) - 1)]
+        channels = [e.channel for e in mt.events if e.type == midi.ChannelVoiceMessages.NOTE_ON]
+        channel = channels[0] if channels else min(part + 1, 16)
+        events = track.events[track.events['part'] == part]
+        ticks = np.round(events['time'] * mf.ticksPerQuarterNote).astype(np.int64).tolist()
+        controls = []
+        for tick, number, value in zip(ticks, events['control'].tolist(), events['value'].tolist()):
+            me = midi.MidiEvent(mt, type=midi.ChannelVoiceMessages.CONTROLLER_CHANGE, channel=channel)
+            me.parameter1 = number
+            me.parameter2 = value
+            controls.append((tick, me))
+
+        # absolute ticks of the existing events; the end-of-track event stays last
+        timed = []
+        now = 0
+        end_of_track = None
+        for e in mt.events:
+            if e.isDeltaTime():
+                now += e.time
+            elif e.type == midi.MetaEvents.END_OF_TRACK:
+                end_of_track = e
+            else:
+                timed.append((now, e))
+        merged = []
+        pending = 0
+        for tick, e in timed:
+            # controllers go before the events sharing their tick
+            while pending < len(controls) and controls[pending][0] <= tick:
+                merged.append(controls[pending])
+                pending += 1
+            merged.append((tick, e))
+        merged.extend(controls[pending:])
+
+        mt.events = []
+        previous = 0
+        for tick, e in merged:
+            mt.events.append(midi.DeltaTime(mt, time=tick - previous))
+            mt.events.append(e)
+            previous = tick
+        if end_of_track is not None:
+            mt.events.append(midi.DeltaTime(mt, time=max(now - previous, 0)))
+            mt.events.append(end_of_track)
+    return mf
@@ -0,0 +1,401 @@
+"""
+Run the transforms over a whole corpus of MIDI files without holding it in memory.
+
+Files go through the pipeline one at a time (or a bounded batch at a time over a process
+pool): each is parsed, optionally rendered with a performance plan, turned into a note
+table written to ``tables/<id>.notes.npy`` / ``.measures.npy`` (or Parquet files) and
+dropped. Corpus statistics are updated from the memory-mapped tables as they are written
+and saved with the list of finished files after every batch, so an interrupted run
+resumes where it stopped.
+
+Usage: python -m src.corpus out_dir in1.mid in2.mid ... [--plan plan.json] [--batch-size 16]
+       python -m src.corpus out_dir --list files.txt [--workers N] [--format parquet]
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .incremental import file_key
+from .notetable import MEASURE_DTYPE, NOTE_DTYPE, NoteTable
+
+MANIFEST = "manifest.jsonl"
+STATISTICS = "statistics.npz"
+TABLE_FORMATS = ("npy", "parquet")
+
+# upper edges of the duration histogram bins, in quarter lengths (the last bin is open)
+DURATION_EDGES = 2.0 ** np.arange(-6, 5)
+VELOCITY_BINS = 128
+
+
+class CorpusStatistics:
+    """
+    Velocity and duration distributions per measure number, accumulated one note table at
+    a time: note counts, sums and sums of squares for the moments, and fixed histograms
+    (one bin per MIDI velocity, power-of-two duration bins, see DURATION_EDGES) for the
+    quantiles. Updating never keeps the tables themselves.
+
+    :param files: ids of the files already counted
+    :param table_format: format of the note tables of the counted files, see TABLE_FORMATS
+    """
+
+    def __init__(self, files=(), table_format: str = None):
+        self.files = list(files)
+        self.table_format = table_format
+        self.velocity_histogram = np.zeros((0, VELOCITY_BINS), dtype=np.int64)
+        self.duration_histogram = np.zeros((0, len(DURATION_EDGES) + 1), dtype=np.int64)
+        self.sums = np.zeros((0, 4))  # velocity, velocity ** 2, duration, duration ** 2
+
+    def __len__(self):
+        return len(self.sums)
+
+    def _grow(self, size: int):
+        if size <= len(self):
+            return
+        extra = size - len(self)
+        self.velocity_histogram = np.vstack([self.velocity_histogram, np.zeros((extra, VELOCITY_BINS), np.int64)])
+        self.duration_histogram = np.vstack(
+            [self.duration_histogram, np.zeros((extra, self.duration_histogram.shape[1]), np.int64)])
+        self.sums = np.vstack([self.sums, np.zeros((extra, 4))])
+
+    def update(self, table: NoteTable, file_id: str = None):
+        """
+        Add the notes of a table.
+        :param table: NoteTable, possibly memory-mapped
+        :param file_id: id recorded as counted, if given
+        """
+        data = table.data
+        measure = np.maximum(np.asarray(data['measure'], dtype=np.int64), 0)
+        if len(measure):
+            self._grow(int(measure.max()) + 1)
+            size = len(self)
+            velocity = np.clip(np.asarray(data['velocity'], dtype=np.int64), 0, VELOCITY_BINS - 1)
+            duration = np.asarray(data['duration'], dtype=float)
+            bins = np.searchsorted(DURATION_EDGES, duration)
+            width = self.duration_histogram.shape[1]
+            self.velocity_histogram += np.bincount(measure * VELOCITY_BINS + velocity,
+                                                   minlength=size * VELOCITY_BINS).reshape(size, VELOCITY_BINS)
+            self.duration_histogram += np.bincount(measure * width + bins, minlength=size * width).reshape(size, width)
+            for column, values in enumerate((velocity, velocity ** 2, duration, duration ** 2)):
+                self.sums[:, column] += np.bincount(measure, weights=values, minlength=size)
+        if file_id is not None:
+            self.files.append(file_id)
+
+    def counts(self) -> np.ndarray:
+        """
+        :return: number of notes of every measure number
+        """
+        return self.velocity_histogram.sum(axis=1)
+
+    def velocity_quantile(self, q: float) -> np.ndarray:
+        """
+        Velocity quantile of every measure number, -1 for measures without notes.
+        :param q: float in [0, 1]
+        :return: np.ndarray
+        """
+        return _histogram_quantile(self.velocity_histogram, np.arange(VELOCITY_BINS), q)
+
+    def duration_quantile(self, q: float) -> np.ndarray:
+        """
+        Duration quantile of every measure number, as the upper edge of its histogram bin
+        (inf for the open last bin), -1 for measures without notes.
+        :param q: float in [0, 1]
+        :return: np.ndarray
+        """
+        return _histogram_quantile(self.duration_histogram, np.append(DURATION_EDGES, np.inf), q)
+
+    def summary(self) -> np.ndarray:
+        """
+        Per-measure summary of the distributions, for the measure numbers holding notes.
+        :return: structured array with fields measure, notes, velocity_mean, velocity_std,
+            velocity_median, duration_mean, duration_std, duration_median
+        """
+        counts = self.counts()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = self.sums / counts[:, None]
+        stats = np.zeros(len(self), dtype=[('measure', 'i4'), ('notes', 'i8'), ('velocity_mean', 'f8'),
+                                           ('velocity_std', 'f8'), ('velocity_median', 'f8'),
+                                           ('duration_mean', 'f8'), ('duration_std', 'f8'),
+                                           ('duration_median', 'f8')])
+        stats['measure'] = np.arange(len(self))
+        stats['notes'] = counts
+        stats['velocity_mean'] = means[:, 0]
+        stats['velocity_std'] = np.sqrt(np.maximum(means[:, 1] - means[:, 0] ** 2, 0))
+        stats['velocity_median'] = self.velocity_quantile(0.5)
+        stats['duration_mean'] = means[:, 2]
+        stats['duration_std'] = np.sqrt(np.maximum(means[:, 3] - means[:, 2] ** 2, 0))
+        stats['duration_median'] = self.duration_quantile(0.5)
+        return stats[counts > 0]
+
+    def save(self, filename: str):
+        """
+        Save the statistics and the list of counted files, replacing the file atomically.
+        :param filename: str, .npz
+        """
+        tmp = filename + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, files=np.array(self.files, dtype=str), table_format=np.array(self.table_format or ""),
+                     velocity_histogram=self.velocity_histogram, duration_histogram=self.duration_histogram,
+                     sums=self.sums)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename: str) -> 'CorpusStatistics':
+        """
+        Load statistics saved by save.
+        :param filename: str
+        :return: CorpusStatistics
+        """
+        with np.load(filename) as f:
+            # files saved without a format predate it, their format is unknown
+            table_format = str(f['table_format']) if 'table_format' in f.files else ""
+            statistics = cls(f['files'].tolist(), table_format or None)
+            statistics.velocity_histogram = f['velocity_histogram']
+            statistics.duration_histogram = f['duration_histogram']
+            statistics.sums = f['sums']
+        return statistics
+
+
+def _histogram_quantile(histogram: np.ndarray, values: np.ndarray, q: float) -> np.ndarray:
+    counts = histogram.sum(axis=1)
+    cumulative = np.cumsum(histogram, axis=1)
+    position = np.argmax(cumulative >= np.maximum(q * counts, 1)[:, None], axis=1)
+    return np.where(counts > 0, values[position], -1.0)
+
+
+def write_parquet(array: np.ndarray, filename: str):
+    """
+    Write a structured array as a Parquet file, one column per field (requires pyarrow).
+    :param array: structured array
+    :param filename: str
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Writing Parquet note tables requires pyarrow (pip install pyarrow).") from e
+    tmp = filename + ".tmp"
+    pyarrow.parquet.write_table(pyarrow.table({name: array[name] for name in array.dtype.names}), tmp)
+    os.replace(tmp, filename)
+
+
+def read_parquet(filename: str, dtype: np.dtype) -> np.ndarray:
+    """
+    Read a Parquet file written by write_parquet back into a structured array.
+    :param filename: str
+    :param dtype: structured dtype of the array
+    :return: np.ndarray
+    """
+    try:
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Reading Parquet note tables requires pyarrow (pip install pyarrow).") from e
+    columns = pyarrow.parquet.read_table(filename)
+    array = np.zeros(columns.num_rows, dtype=dtype)
+    for name in dtype.names:
+        array[name] = columns.column(name).to_numpy()
+    return array
+
+
+def table_prefix(output_dir: str, file_id: str) -> str:
+    return os.path.join(output_dir, "tables", file_id)
+
+
+def save_table(table: NoteTable, prefix: str, table_format: str = "npy"):
+    """
+    Write the arrays of a note table, see NoteTable.save.
+    :param table: NoteTable
+    :param prefix: str, path without extension
+    :param table_format: "npy" or "parquet"
+    """
+    if table_format == "parquet":
+        write_parquet(table.data, prefix + ".notes.parquet")
+        write_parquet(table.measures, prefix + ".measures.parquet")
+    else:
+        table.save(prefix)
+
+
+def load_table(prefix: str, table_format: str = "npy") -> NoteTable:
+    """
+    Read a note table written by save_table, memory-mapped for .npy files.
+    :param prefix: str, path without extension
+    :param table_format: "npy" or "parquet"
+    :return: NoteTable
+    """
+    if table_format == "parquet":
+        return NoteTable(read_parquet(prefix + ".notes.parquet", NOTE_DTYPE),
+                         read_parquet(prefix + ".measures.parquet", MEASURE_DTYPE))
+    return NoteTable.load(prefix)
+
+
+def corpus_jobs(inputs: list, plan: dict = None, seed: int = 0) -> list:
+    """
+    One job per input file, identified by the file content, the plan and the seed.
+    :param inputs: list of MIDI files
+    :param plan: dict, performance plan, or None to only tabulate the scores
+    :param seed: seed of the randomized transforms
+    :return: list of dicts with "id", "input", "seed" and "plan"
+    """
+    jobs = []
+    for filename in inputs:
+        key = json.dumps([file_key(filename), plan, seed], sort_keys=True)
+        jobs.append({"id": hashlib.sha1(key.encode()).hexdigest()[:16], "input": filename, "seed": seed,
+                     "plan": plan})
+    return jobs
+
+
+def process_file(job: dict, output_dir: str, table_format: str = "npy", write_midi: bool = True) -> dict:
+    """
+    Parse one file, render its plan, and write its note table (and MIDI file if the job
+    has a plan). Nothing is kept in memory afterwards.
+    :param job: dict, see corpus_jobs
+    :param output_dir: str
+    :param table_format: "npy" or "parquet"
+    :param write_midi: bool, save the rendered MIDI file to ``midi/<id>.mid``
+    :return: dict, manifest entry
+    """
+    from .index import MeasureIndex
+    from .render import render
+    from .utils import get_stream, save_midi
+
+    start = time.perf_counter()
+    # every file is read once, keep it out of the stream cache
+    my_stream = get_stream(job["input"], cache=None)
+    index = MeasureIndex(my_stream)
+    entry = {"id": job["id"], "input": job["input"], "seed": job["seed"], "output": None}
+    if job["plan"] is not None:
+        my_stream = render(my_stream, job["plan"], index, rng=job["seed"])
+        if write_midi:
+            os.makedirs(os.path.join(output_dir, "midi"), exist_ok=True)
+            output = os.path.join(output_dir, "midi", job["id"] + ".mid")
+            save_midi(my_stream, output + ".tmp")
+            os.replace(output + ".tmp", output)
+            entry["output"] = os.path.relpath(output, output_dir)
+    table = NoteTable.from_stream(my_stream, index)
+    save_table(table, table_prefix(output_dir, job["id"]), table_format)
+    entry.update({"notes": len(table), "measures": len(np.unique(table.measures['number'])),
+                  "seconds": time.perf_counter() - start})
+    return entry
+
+
+def process_corpus(jobs: list, output_dir: str, batch_size: int = 16, workers: int = None,
+                   table_format: str = "npy", write_midi: bool = True, progress=sys.stderr) -> dict:
+    """
+    Process jobs a batch at a time, updating and saving the statistics after every batch.
+    Jobs counted in the saved statistics are skipped, so an interrupted run resumes; the
+    run is refused if they were written in another table format.
+    :param jobs: list of job dicts, see corpus_jobs
+    :param output_dir: str
+    :param batch_size: number of files between two checkpoints, and the most in flight
+    :param workers: number of worker processes, None to process the files in this process
+    :param table_format: "npy" or "parquet"
+    :param write_midi: bool, see process_file
+    :param progress: file receiving progress lines, or None
+    :return: dict, summary with counts and throughput
+    """
+    from .batch import open_manifest
+
+    if table_format not in TABLE_FORMATS:
+        raise ValueError(f"Unknown table format {table_format!r}.")
+    os.makedirs(os.path.join(output_dir, "tables"), exist_ok=True)
+    statistics_path = os.path.join(output_dir, STATISTICS)
+    statistics = CorpusStatistics.load(statistics_path) if os.path.exists(statistics_path) else CorpusStatistics()
+    if statistics.files and statistics.table_format not in (None, table_format):
+        raise ValueError(f"{output_dir} holds {statistics.table_format} tables, not {table_format}: "
+                         f"use the same format or another output directory.")
+    statistics.table_format = table_format
+    done = set(statistics.files)
+    pending = [job for job in jobs if job["id"] not in done]
+    start = time.perf_counter()
+    failures = []
+    processed = 0
+    pool = ProcessPoolExecutor(max_workers=workers) if workers else None
+    try:
+        with open_manifest(os.path.join(output_dir, MANIFEST)) as manifest:
+            for first in range(0, len(pending), batch_size):
+                batch = pending[first:first + batch_size]
+                if pool is None:
+                    results = [_try(process_file, job, output_dir, table_format, write_midi) for job in batch]
+                else:
+                    futures = [pool.submit(process_file, job, output_dir, table_format, write_midi)
+                               for job in batch]
+                    results = [_try(future.result) for future in futures]
+                entries = []
+                for job, (entry, error) in zip(batch, results):
+                    if error is not None:
+                        failures.append({"id": job["id"], "input": job["input"], "error": error})
+                        continue
+                    statistics.update(load_table(table_prefix(output_dir, job["id"]), table_format), job["id"])
+                    entries.append(entry)
+                # the statistics hold the finished files, the manifest only describes them
+                statistics.save(statistics_path)
+                for entry in entries:
+                    manifest.write(json.dumps(entry) + "\n")
+                manifest.flush()
+                processed += len(entries)
+                if progress is not None:
+                    elapsed = time.perf_counter() - start
+                    print(f"[{processed + len(failures)}/{len(pending)}] {processed / elapsed:.2f} files/s",
+                          file=progress)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    elapsed = time.perf_counter() - start
+    return {"files": len(jobs), "skipped": len(jobs) - len(pending), "processed": processed, "failed": failures,
+            "seconds": elapsed, "files_per_second": processed / elapsed if elapsed > 0 else 0.0}
+
+
+def _try(function, *args) -> tuple:
+    try:
+        return function(*args), None
+    except Exception as e:
+        return None, repr(e)
+
+
+def format_summary(stats: np.ndarray) -> str:
+    lines = [f"{'measure':>8}{'notes':>10}{'vel mean':>10}{'vel std':>9}{'vel med':>9}"
+             f"{'dur mean':>10}{'dur std':>9}{'dur med':>9}"]
+    for row in stats:
+        lines.append(f"{row['measure']:>8}{row['notes']:>10}{row['velocity_mean']:>10.1f}{row['velocity_std']:>9.1f}"
+                     f"{row['velocity_median']:>9.0f}{row['duration_mean']:>10.3f}{row['duration_std']:>9.3f}"
+                     f"{row['duration_median']:>9.3f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    from .render import load_plan
+
+    parser = argparse.ArgumentParser(prog="python -m src.corpus", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("output_dir", help="directory receiving the tables, statistics and manifest")
+    parser.add_argument("inputs", nargs="*", help="input MIDI files")
+    parser.add_argument("--list", help="text file with one input MIDI file per line")
+    parser.add_argument("--plan", help="performance plan (JSON or YAML) rendered on every file")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the randomized transforms")
+    parser.add_argument("--batch-size", type=int, default=16, help="files between two checkpoints")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, none by default")
+    parser.add_argument("--format", choices=TABLE_FORMATS, default="npy", help="note table file format")
+    parser.add_argument("--no-midi", action="store_true", help="do not save the rendered MIDI files")
+    parser.add_argument("--summary", action="store_true", help="print the per-measure statistics")
+    args = parser.parse_args(argv)
+
+    inputs = list(args.inputs)
+    if args.list:
+        with open(args.list) as f:
+            inputs += [line.strip() for line in f if line.strip()]
+    jobs = corpus_jobs(inputs, load_plan(args.plan) if args.plan else None, args.seed)
+    try:
+        result = process_corpus(jobs, args.output_dir, args.batch_size, args.workers, args.format, not args.no_midi)
+    except ValueError as e:
+        parser.error(str(e))
+    print(json.dumps(result, indent=2))
+    if args.summary:
+        print(format_summary(CorpusStatistics.load(os.path.join(args.output_dir, STATISTICS)).summary()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import numpy as np
+
+from .index import MeasureIndex, measure_index
+from .notetable import NoteTable
+from .seeding import measure_integers
+
+# MIDI velocities of the dynamic marks, from music21's Dynamic.volumeScalar * 127
+DYNAMIC_VELOCITIES = {
+    "pppp": 13, "ppp": 19, "pp": 32, "p": 44, "mp": 57, "mf": 70, "f": 89, "ff": 108, "fff": 114,
+}
+
+ARCH = "arch"
+CRESCENDO = "crescendo"
+DECRESCENDO = "decrescendo"
+
+
+def dynamic_velocity(dynamic) -> int:
+    """
+    Convert a dynamic mark ("p", "mf", ...) or a velocity to a MIDI velocity.
+    :param dynamic: str or int
+    :return: int
+    """
+    if isinstance(dynamic, str):
+        return DYNAMIC_VELOCITIES[dynamic]
+    return int(dynamic)
+
+
+def _per_measure(value, count: int) -> np.ndarray:
+    """
+    Expand a segment parameter to one value per measure: a scalar is repeated, a list
+    must hold one value per measure of the segment.
+    """
+    values = np.asarray(value, dtype=float)
+    if values.ndim == 0:
+        return np.full(count, float(values))
+    if len(values) != count:
+        raise ValueError(f"Expected {count} per-measure values, got {len(values)}.")
+    return values
+
+
+def compute_velocities(table: NoteTable, spec: dict, rng=None) -> np.ndarray:
+    """
+    Compute the target velocity of every row of a note table from a whole-piece curve
+    specification, in one batched pass.
+
+    The specification is a dict with a ``segments`` list. Each segment covers
+    ``measures: [start, end]`` (inclusive) and optionally ``parts`` (part indices), and has
+    one of the shapes
+
+    - ``arch``: low - high - low inside every measure, as classical_dynamics_shape does.
+      ``min`` and ``max`` are velocities, either one value or one value per measure.
+    - ``crescendo`` / ``decrescendo``: a hairpin over the whole segment from ``start`` to
+      ``end``, dynamic marks or velocities, interpolated on the note onsets.
+
+    Later segments override earlier ones where they overlap. ``jitter`` (top level, or per
+    segment) adds uniform integer noise in [-jitter, jitter] to each note or chord; arches
+    default to 2, hairpins to 0. The noise is drawn in one call from ``rng``, or from a
+    generator seeded with ``seed``, or from a fresh generator; from a step's SeedSequence
+    it is drawn measure by measure, see seeding.measure_integers. Rows outside every
+    segment keep their velocity.
+    :param table: NoteTable
+    :param spec: dict, curve specification
+    :param rng: optional numpy.random.Generator, SeedSequence or seed, overrides ``spec["seed"]``
+    :return: np.ndarray of int, new velocity column
+    """
+    data = table.data
+    velocities = data['velocity'].astype(np.int64)
+    segments = spec.get("segments", [])
+    if len(data) == 0 or not segments:
+        return velocities
+
+    # lookup tables indexed by (part, measure): owning segment and the arch parameters
+    part_count = int(data['part'].max()) + 1
+    measure_count = int(max(data['measure'].max(), max(seg["measures"][1] for seg in segments))) + 1
+    owner = np.full((part_count, measure_count), -1)
+    low = np.zeros((part_count, measure_count))
+    high = np.zeros((part_count, measure_count))
+    for k, seg in enumerate(segments):
+        start, end = seg["measures"]
+        parts = seg.get("parts", range(part_count))
+        for part in parts:
+            if part >= part_count:
+                continue
+            owner[part, start:end + 1] = k
+            if seg["shape"] == ARCH:
+                low[part, start:end + 1] = _per_measure(seg.get("min", 40), end - start + 1)
+                high[part, start:end + 1] = _per_measure(seg.get("max", 100), end - start + 1)
+            elif seg["shape"] not in (CRESCENDO, DECRESCENDO):
+                raise ValueError(f"Unknown curve shape {seg['shape']!r}.")
+
+    valid = data['measure'] >= 0
+    row_segment = np.full(len(data), -1)
+    row_segment[valid] = owner[data['part'][valid], data['measure'][valid]]
+    shapes = np.array([seg["shape"] for seg in segments])
+    jitters = np.array([seg.get("jitter", spec.get("jitter", 2 if seg["shape"] == ARCH else 0))
+                        for seg in segments])
+
+    # work per note or chord (its first row), then broadcast to every row of the chord
+    first_rows = np.nonzero((data['component'] <= 0) & (row_segment >= 0))[0]
+    if len(first_rows) == 0:
+        return velocities
+    element_segment = row_segment[first_rows]
+    element_value = np.zeros(len(first_rows))
+
+    is_arch = shapes[element_segment] == ARCH
+    if is_arch.any():
+        element_value[is_arch] = _arch_values(data, first_rows[is_arch], low, high)
+    if (~is_arch).any():
+        element_value[~is_arch] = _hairpin_values(data, first_rows[~is_arch], element_segment[~is_arch], segments)
+
+    noise_range = jitters[element_segment]
+    if noise_range.any():
+        bound = int(noise_range.max())
+        noise = measure_integers(spec.get("seed") if rng is None else rng, data['measure'][first_rows], -bound, bound)
+        element_value += np.clip(noise, -noise_range, noise_range)
+
+    by_chord = np.zeros(int(data['chord'].max()) + 1)
+    by_chord[data['chord'][first_rows]] = element_value
+    shaped = row_segment >= 0
+    velocities[shaped] = by_chord[data['chord'][shaped]]
+    return np.clip(velocities, 0, 127)
+
+
+def arch_shape(data: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """
+    Position of the elements starting at ``rows`` on the classical low - high - low shape,
+    from 0 (low) to 1 (high), measure by measure and part by part, in the order of
+    ``measure.flatten().notes``.
+    :param data: NoteTable data
+    :param rows: first row of each element
+    :return: np.ndarray of float, one value per row
+    """
+    part = data['part'][rows].astype(np.int64)
+    measure = data['measure'][rows].astype(np.int64)
+    offset = data['offset'][rows]
+    group = part * (1 << 32) + measure
+    # flatten() order: by offset, grace notes first, then insertion (recurse) order
+    order = np.lexsort((data['chord'][rows], data['duration'][rows] > 0, offset, group))
+    sorted_group = group[order]
+    starts = np.r_[0, np.nonzero(np.diff(sorted_group))[0] + 1]
+    group_id = np.cumsum(np.r_[0, np.diff(sorted_group) != 0])
+    counter = np.arange(len(order)) - starts[group_id]
+    # number of distinct offsets in each measure; offsets are sorted inside each group
+    sorted_offset = offset[order]
+    distinct = np.r_[True, (np.diff(sorted_group) != 0) | (np.diff(sorted_offset) != 0)]
+    offsets_per_group = np.bincount(group_id, weights=distinct).astype(np.int64)
+    half = np.maximum(np.ceil(offsets_per_group / 2).astype(np.int64), 1)[group_id]
+
+    rising = counter < half
+    x = np.where(rising, counter / half, (counter - half) / half)
+    shape = np.empty(len(rows))
+    shape[order] = np.where(rising, x ** 2, 1 - (1 - x) ** 2)
+    return shape
+
+
+def _arch_values(data: np.ndarray, rows: np.ndarray, low: np.ndarray, high: np.ndarray) -> np.ndarray:
+    """
+    Velocities of the classical low - high - low shape for the elements starting at ``rows``.
+    """
+    part = data['part'][rows].astype(np.int64)
+    measure = data['measure'][rows].astype(np.int64)
+    minimum = low[part, measure]
+    maximum = high[part, measure]
+    return np.trunc(minimum + (maximum - minimum) * arch_shape(data, rows))
+
+
+def _hairpin_values(data: np.ndarray, rows: np.ndarray, segment: np.ndarray, segments: list) -> np.ndarray:
+    """
+    Velocities of hairpins, interpolated on the note onsets of each segment and part.
+    """
+    onset = data['onset'][rows]
+    group = segment.astype(np.int64) * (1 << 16) + data['part'][rows]
+    _, group_id = np.unique(group, return_inverse=True)
+    first = np.full(group_id.max() + 1, np.inf)
+    last = np.full(group_id.max() + 1, -np.inf)
+    np.minimum.at(first, group_id, onset)
+    np.maximum.at(last, group_id, onset)
+    span = last - first
+    x = np.where(span[group_id] > 0, (onset - first[group_id]) / np.where(span > 0, span, 1)[group_id], 0.0)
+    start = np.array([dynamic_velocity(segments[k].get("start", "p" if segments[k]["shape"] == CRESCENDO else "f"))
+                      for k in segment])
+    end = np.array([dynamic_velocity(segments[k].get("end", "f" if segments[k]["shape"] == CRESCENDO else "p"))
+                    for k in segment])
+    return np.trunc(start + (end - start) * x)
+
+
+def apply_velocity_curve(my_stream, spec: dict, index: MeasureIndex = None, table: NoteTable = None, rng=None):
+    """
+    Apply a whole-piece velocity curve to a stream in one pass and write the velocities
+    back in bulk. See compute_velocities for the specification format.
+    :param my_stream: music21 stream
+    :param spec: dict, curve specification
+    :param index: optional measure index of my_stream, built once if not given
+    :param table: optional NoteTable of my_stream, built once if not given
+    :param rng: optional numpy.random.Generator or seed for the jitter
+    :return: stream
+    """
+    if table is None or table.source is not my_stream:
+        table = NoteTable.from_stream(my_stream, measure_index(my_stream, index))
+    table.data['velocity'] = compute_velocities(table, spec, rng)
+    return table.apply_to_stream()
+
+
+def arch_segment(start: int, end: int, min_volume=40, max_volume=100, **options) -> dict:
+    """
+    Build an ``arch`` segment of a curve specification.
+    :param start: first measure (inclusive)
+    :param end: last measure (inclusive)
+    :param min_volume: velocity, or list with one velocity per measure
+    :param max_volume: velocity, or list with one velocity per measure
+    :return: dict
+    """
+    return dict(shape=ARCH, measures=[start, end], min=min_volume, max=max_volume, **options)
+
+
+def hairpin_segment(shape: str, start: int, end: int, start_dynamic, end_dynamic, **options) -> dict:
+    """
+    Build a ``crescendo`` or ``decrescendo`` segment of a curve specification.
+    :param shape: CRESCENDO or DECRESCENDO
+    :param start: first measure (inclusive)
+    :param end: last measure (inclusive)
+    :param start_dynamic: dynamic mark or velocity at the first onset
+    :param end_dynamic: dynamic mark or velocity at the last onset
+    :return: dict
+    """
+    return dict(shape=shape, measures=[start, end], start=start_dynamic, end=end_dynamic, **options)
+
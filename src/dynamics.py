@@ -1,24 +1,36 @@
-import random
-
+import numpy as np
 from music21 import dynamics
 
+from .curves import CRESCENDO, DECRESCENDO, DYNAMIC_VELOCITIES, apply_velocity_curve, arch_segment, hairpin_segment
+from .index import MeasureIndex, measure_index
+from .instrument import instrumented
+from .musicxml import notated
+from .notetable import DEFAULT_VELOCITY, NoteTable
+from .seeding import measure_integers
 
+
+@instrumented("measure")
 def change_dynamics_decrescendo_measure(my_stream, measure: int, start_dynamic: str = "f",
-                                        end_dynamic: str = "p"):
+                                        end_dynamic: str = "p", index: MeasureIndex = None,
+                                        shape: bool = False):
     """
     Create a decrescendo in the given measure
     :param my_stream:
     :param measure:
     :param start_dynamic:
     :param end_dynamic:
+    :param index: optional measure index of my_stream, built once if not given
+    :param shape: also shape the velocities of the measure, the spanner alone does not
+        change the MIDI output
     :return:
     """
-    for part in my_stream.parts:
+    index = measure_index(my_stream, index)
+    for part_index, part in enumerate(my_stream.parts):
         # Calculate the total number of notes which have a different offset
-        full_measure = part.measure(measure)
+        full_measure = index.get(measure, part_index)
         if full_measure is None:
             continue
-        offsets = set([n.offset for n in full_measure.flatten().notes])
+        offsets = set([n.getOffsetInHierarchy(full_measure) for n in index.notes(measure, part_index)])
         number_of_notes = len(offsets)
 
         # Create a decrescendo
@@ -34,71 +46,54 @@ def change_dynamics_decrescendo_measure(my_stream, measure: int, start_dynamic:
 
         # Add the decrescendo to the stream
         part.insert(0, decrescendo)
-    return my_stream
-
 
-import math
-import numpy as np
+    if not shape:
+        return my_stream
+    segment = hairpin_segment(DECRESCENDO, measure, measure, start_dynamic, end_dynamic)
+    return apply_velocity_curve(my_stream, {"segments": [segment]}, index,
+                                NoteTable.from_stream(my_stream, index, measure, measure))
 
 
-def classical_dynamics_shape(my_stream, measure: int, min_volume: int = 40, max_volume: int = 100):
+@instrumented("measure")
+def classical_dynamics_shape(my_stream, measure: int, min_volume: int = 40, max_volume: int = 100,
+                             index: MeasureIndex = None, rng=None):
     """
     Create a classical dynamics shape for the given my_stream
     :param my_stream:
     :param measure:
     :param min_volume:
     :param max_volume:
+    :param index: optional measure index of my_stream, built once if not given
+    :param rng: numpy.random.Generator or seed for the jitter, a fresh generator if None
     :return:
     """
-    for part in my_stream.parts:
-        # Create a round shape for the dynamics low - high - low
-        full_measure = part.measure(measure)
-        if full_measure is None:
-            continue
-        offsets = set([n.offset for n in full_measure.flatten().notes])
-        number_of_notes = len(offsets)
-        half_notes = math.ceil(number_of_notes / 2)
+    # Round shape for the dynamics low - high - low, see curves.compute_velocities
+    segment = arch_segment(measure, measure, min_volume, max_volume)
+    return apply_velocity_curve(my_stream, {"segments": [segment]}, index,
+                                NoteTable.from_stream(my_stream, index, measure, measure), rng)
 
-        # Create a smoothed crescendo
-        def smoothed_crescendo(max_note, current_index, minimum_dynamic, maximum_dynamic):
-            x = current_index / max_note
-            return minimum_dynamic + (maximum_dynamic - minimum_dynamic) * x ** 2
 
-        # Create a smoothed decrescendo
-        def smoothed_decrescendo(max_note, current_index, minimum_dynamic, maximum_dynamic):
-            x = current_index / max_note
-            return minimum_dynamic + (maximum_dynamic - minimum_dynamic) * (1 - (1 - x) ** 2)
-
-        if half_notes == 0 and number_of_notes > 0:
-            half_notes = 1
-        elif half_notes == 0 and number_of_notes == 0:
-            continue
-
-        # Create a crescendo
-        for counter, n in enumerate(full_measure.flatten().notes):
-            if counter < half_notes:
-                n.volume.velocity = int(smoothed_crescendo(half_notes, counter, min_volume, max_volume))
-            else:
-                n.volume.velocity = int(smoothed_decrescendo(half_notes, counter - half_notes, min_volume, max_volume))
-            n.volume.velocity += np.random.randint(-2, 3)
-    return my_stream
-
-
-def change_dynamics_crescendo_measure(my_stream, measure: int, start_dynamic: str = "p", end_dynamic: str = "f"):
+@instrumented("measure")
+def change_dynamics_crescendo_measure(my_stream, measure: int, start_dynamic: str = "p", end_dynamic: str = "f",
+                                      index: MeasureIndex = None, shape: bool = False):
     """
     Create a crescendo in the given measure
     :param my_stream:
     :param measure:
     :param start_dynamic:
     :param end_dynamic:
+    :param index: optional measure index of my_stream, built once if not given
+    :param shape: also shape the velocities of the measure, the spanner alone does not
+        change the MIDI output
     :return:
     """
-    for part in my_stream.parts:
+    index = measure_index(my_stream, index)
+    for part_index, part in enumerate(my_stream.parts):
         # Calculate the total number of notes which have a different offset
-        full_measure = part.measure(measure)
+        full_measure = index.get(measure, part_index)
         if full_measure is None:
             continue
-        offsets = set([n.offset for n in full_measure.flatten().notes])
+        offsets = set([n.getOffsetInHierarchy(full_measure) for n in index.notes(measure, part_index)])
         number_of_notes = len(offsets)
 
         # Create a crescendo
@@ -114,68 +109,82 @@ def change_dynamics_crescendo_measure(my_stream, measure: int, start_dynamic: st
 
         # Add the crescendo to the my_stream
         part.insert(0, crescendo)
-    return my_stream
 
+    if not shape:
+        return my_stream
+    segment = hairpin_segment(CRESCENDO, measure, measure, start_dynamic, end_dynamic)
+    return apply_velocity_curve(my_stream, {"segments": [segment]}, index,
+                                NoteTable.from_stream(my_stream, index, measure, measure))
+
+
+# Hairpins notated by change_dynamics_for_whole_piece: (measure, shape, start dynamic, end dynamic)
+WHOLE_PIECE_HAIRPINS = ((19, DECRESCENDO, "f", "p"), (20, CRESCENDO, "p", "f"), (21, CRESCENDO, "p", "f"),
+                        (22, DECRESCENDO, "f", "p"), (23, DECRESCENDO, "f", "p"), (25, CRESCENDO, "p", "f"),
+                        (26, CRESCENDO, "p", "f"), (43, DECRESCENDO, "f", "p"), (44, DECRESCENDO, "f", "p"),
+                        (48, CRESCENDO, "p", "f"), (49, DECRESCENDO, "f", "p"), (53, DECRESCENDO, "mp", "p"),
+                        (68, DECRESCENDO, "mp", "p"), (69, DECRESCENDO, "pp", "ppp"))
 
-def change_dynamics_for_whole_piece(my_stream):
+
+def whole_piece_curve() -> dict:
+    """
+    Curve specification of the dynamics of the whole piece, see curves.compute_velocities.
+    The measures of WHOLE_PIECE_HAIRPINS keep their velocities.
+    :return: dict
+    """
+    segments = [arch_segment(0, 18, [20 + i * 2 for i in range(19)], [50 + i * 2 for i in range(19)]),
+                arch_segment(24, 24),
+                arch_segment(26, 41),
+                arch_segment(45, 47),
+                arch_segment(50, 51, 40, 60),
+                arch_segment(52, 52, 20, 30),
+                arch_segment(54, 67, [int(57 - j * 1.5) for j in range(14)], [100 - j * 2 for j in range(14)])]
+    return {"segments": segments}
+
+
+@instrumented()
+def change_dynamics_for_whole_piece(my_stream, index: MeasureIndex = None, spec: dict = None, rng=None,
+                                   hairpins=WHOLE_PIECE_HAIRPINS):
     """
     Change the dynamics for the whole piece
     :param my_stream:
+    :param index: optional measure index of my_stream, built once if not given
+    :param spec: curve specification, whole_piece_curve() if not given
+    :param rng: numpy.random.Generator or seed for the jitter, a fresh generator if None
+    :param hairpins: crescendo and decrescendo spanners to insert, see WHOLE_PIECE_HAIRPINS
     :return: stream
     """
-    for i in range(19):
-        my_stream = classical_dynamics_shape(my_stream, i, 20 + i * 2, 50 + i * 2)
-
-    my_stream = change_dynamics_decrescendo_measure(my_stream, 19)
-    my_stream = change_dynamics_crescendo_measure(my_stream, 20)
-    my_stream = change_dynamics_crescendo_measure(my_stream, 21)
-    my_stream = change_dynamics_decrescendo_measure(my_stream, 22)
-    my_stream = change_dynamics_decrescendo_measure(my_stream, 23)
-    my_stream = classical_dynamics_shape(my_stream, 24)
-    my_stream = change_dynamics_crescendo_measure(my_stream, 25)
-    my_stream = change_dynamics_crescendo_measure(my_stream, 26)
-    for i in range(26, 42):
-        my_stream = classical_dynamics_shape(my_stream, i)
-    my_stream = change_dynamics_decrescendo_measure(my_stream, 43)
-    my_stream = change_dynamics_decrescendo_measure(my_stream, 44)
-    for i in range(45, 48):
-        my_stream = classical_dynamics_shape(my_stream, i)
-    my_stream = change_dynamics_crescendo_measure(my_stream, 48)
-    my_stream = change_dynamics_decrescendo_measure(my_stream, 49)
-    for i in range(50, 52):
-        my_stream = classical_dynamics_shape(my_stream, i, 40, 60)
-    my_stream = classical_dynamics_shape(my_stream, 52, 20, 30)
-    my_stream = change_dynamics_decrescendo_measure(my_stream, 53, "mp", "p")
-    j = 0
-    for i in range(54, 68):
-        my_stream = classical_dynamics_shape(my_stream, i, int(57 - j * 1.5), 100 - j * 2)
-        j += 1
-    my_stream = change_dynamics_decrescendo_measure(my_stream, 68, "mp", "p")
-    my_stream = change_dynamics_decrescendo_measure(my_stream, 69, "pp", "ppp")
-
-    return my_stream
-
-
-def change_velocity_measures_in_stream(s, start_measure: int, end_measure: int, velocity_factor: float):
+    index = measure_index(my_stream, index)
+    for measure, shape, start_dynamic, end_dynamic in hairpins:
+        insert = change_dynamics_crescendo_measure if shape == CRESCENDO else change_dynamics_decrescendo_measure
+        my_stream = insert(my_stream, measure, start_dynamic, end_dynamic, index=index)
+    return apply_velocity_curve(my_stream, spec if spec is not None else whole_piece_curve(), index, rng=rng)
+
+
+@instrumented("start_measure", "end_measure")
+def change_velocity_measures_in_stream(s, start_measure: int, end_measure: int, velocity_factor: float,
+                                       index: MeasureIndex = None):
     """
     Change the velocity of notes in a stream for a range of measures.
     :param s:
     :param start_measure:
     :param end_measure:
     :param velocity_factor:
+    :param index: optional measure index of s, built once if not given
     :return:
     """
+    index = measure_index(s, index)
     for measure_number in range(start_measure, end_measure + 1):
-        measure = s.measure(measure_number)
-        if measure is not None:
+        if index.stack(measure_number):
             # modify intensity
-            for n in measure.recurse().notes:
+            for n in index.notes(measure_number, ordered=False):
                 # Calculate the new tone intensity and make sure it is in the range of the MIDI standard (0-127)
                 n.volume.velocity = min(max(int(n.volume.velocity * velocity_factor), 0), 127)
     return s
 
 
-def randomize_velocity_in_measures(s, start_measure: int, end_measure: int, delta_range: int):
+@instrumented("start_measure", "end_measure")
+def randomize_velocity_in_measures(s, start_measure: int, end_measure: int, delta_range: int,
+                                   index: MeasureIndex = None, rng=None):
     """
     Randomly adjusts the velocity of each note within a specified range in a music stream,
     limited to a specific range of measures.
@@ -185,19 +194,72 @@ def randomize_velocity_in_measures(s, start_measure: int, end_measure: int, delt
         start_measure (int): The starting measure number.
         end_measure (int): The ending measure number.
         delta_range (int): The maximum change (up or down) that can be applied to the velocity.
+        index (MeasureIndex): Optional measure index of s, built once if not given.
+        rng (numpy.random.Generator): Generator, step SeedSequence or seed drawing the changes, a fresh
+            generator if None.
 
     Returns:
         music21.stream.Stream: The modified music stream.
     """
-    for measure_number in range(start_measure, end_measure + 1):
-        measure = s.measure(measure_number)
-        if measure:
-            for n in measure.notes:  # Only adjust notes directly in the measure
-                if n.volume.velocity is not None:  # Check if velocity is defined
-                    change = random.randint(-delta_range, delta_range)  # Random change within the specified range
-                    new_velocity = max(0, min(127, n.volume.velocity + change))  # Apply the change and clamp the result
-                    n.volume.velocity = new_velocity  # Set the new velocity
-                else:
-                    n.volume.velocity = random.randint(64 - delta_range, 64 + delta_range)  # Default value if None
+    index = measure_index(s, index)
+    # Only adjust notes directly in the measures
+    numbered = [(measure_number, n) for measure_number in range(start_measure, end_measure + 1)
+                for measure in index.stack(measure_number) for n in measure.notes]
+    notes = [n for _, n in numbered]
+    # A change for each note, within the specified range, see seeding.measure_integers
+    changes = measure_integers(rng, [number for number, _ in numbered], -delta_range, delta_range).tolist()
+    for n, change in zip(notes, changes):
+        if n.volume.velocity is not None:  # Check if velocity is defined
+            n.volume.velocity = max(0, min(127, n.volume.velocity + change))  # Apply the change and clamp the result
+        else:
+            n.volume.velocity = 64 + change  # Default value if None
     return s
 
+
+def _hairpin_target(level: float, crescendo: bool) -> float:
+    """
+    Next dynamic level above (crescendo) or below a velocity, see DYNAMIC_VELOCITIES.
+    """
+    levels = sorted(DYNAMIC_VELOCITIES.values())
+    if crescendo:
+        return float(next((v for v in levels if v > level + 1), levels[-1]))
+    return float(next((v for v in reversed(levels) if v < level - 1), levels[0]))
+
+
+@instrumented()
+def apply_notated_hairpins(my_stream, index: MeasureIndex = None, parts=None):
+    """
+    Shape the velocities under the hairpins notated in a MusicXML score (see
+    musicxml.LazyMeasureIndex). The notes of a hairpin are scaled from the dynamic in force
+    at its start to the dynamic notated at its end, or in the next measure, or else to the
+    next level of DYNAMIC_VELOCITIES; the scale grows linearly with the onset, so accents
+    set by earlier transforms are kept. Scores read from MIDI have no hairpins, and are
+    left unchanged.
+    :param my_stream: music21 stream
+    :param index: optional measure index of my_stream, built once if not given
+    :param parts: part indices to shape, every part if None (the hairpins of a piano
+        staff apply to both hands)
+    :return: stream
+    """
+    index = measure_index(my_stream, index)
+    wedges = notated(index, "wedge")
+    if not len(wedges):
+        return my_stream
+    dynamic_marks = notated(index, "dynamic")
+    dynamic_marks = dynamic_marks[np.argsort(dynamic_marks['onset'], kind='stable')]
+    table = NoteTable.from_stream(my_stream, index, int(wedges['measure'].min()), int(wedges['end_measure'].max()))
+    data = table.data
+    shaped = np.ones(len(data), dtype=bool) if parts is None else np.isin(data['part'], list(parts))
+    scale = np.ones(len(data))
+    for wedge in wedges:
+        before = dynamic_marks[dynamic_marks['onset'] <= wedge['onset']]
+        start = float(before['value'][-1]) if len(before) else float(DEFAULT_VELOCITY)
+        after = dynamic_marks[(dynamic_marks['onset'] >= wedge['end_onset']) &
+                              (dynamic_marks['measure'] <= wedge['end_measure'] + 1)]
+        end = float(after['value'][0]) if len(after) else _hairpin_target(start, wedge['name'] == "crescendo")
+        rows = shaped & (data['onset'] >= wedge['onset'] - 1e-9) & (data['onset'] <= wedge['end_onset'] + 1e-9)
+        span = max(float(wedge['end_onset'] - wedge['onset']), 1e-9)
+        x = np.clip((data['onset'][rows] - wedge['onset']) / span, 0.0, 1.0)
+        scale[rows] = 1.0 + (end / start - 1.0) * x
+    data['velocity'] = np.clip(np.round(data['velocity'] * scale), 1, 127)
+    return table.apply_to_stream()
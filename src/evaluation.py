@@ -0,0 +1,359 @@
+"""
+Score a rendered MIDI file against the recorded renditions, measure by measure.
+
+The rendition is aligned to the score note by note like the recordings (see
+src.alignment), its tempo curve being estimated by alignments within narrower and
+narrower windows. Then, for every measure and every performer:
+
+- ``ioi_correlation``: correlation of the inter-onset intervals of the score onsets;
+- ``tempo_distance``: absolute log ratio of the tempi of the measure, 0 for the same tempo;
+- ``velocity_distance``: RMS difference of the velocities, each rendition standardized
+  over the whole piece so that only the profile counts;
+- ``accent_agreement``: share of chords and multi-voice onsets where both renditions
+  agree on whether the top voice is louder than the other notes.
+
+Each metric is one pass of grouped sums over all the measures. The recordings are aligned
+once per process (Reference), and the scores of a file are cached on disk by the content
+hash of the file, the score and the recordings.
+
+Usage: python -m src.evaluation rendered.mid [more.mid ...] [--measures] [--json scores.json]
+"""
+import argparse
+import bisect
+import functools
+import hashlib
+import json
+import os
+import warnings
+
+import numpy as np
+
+from . import midi_io
+from .alignment import DEFAULT_WINDOW, align, align_performer
+from .incremental import file_key
+from .tempo import ANNOTATION_DIR, PERFORMERS, TempoMap, annotation_path
+
+DEFAULT_SCORE = f"{ANNOTATION_DIR}/corrected_midi_score.mid"
+DEFAULT_EVALUATION_CACHE_DIR = os.environ.get(
+    "DM_EVALUATION_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "dm_assignment2", "evaluation"))
+
+# windows of the successive alignments of a rendition, before its tempo curve is known,
+# in seconds
+REFINE_WINDOWS = (60.0, 15.0, 4.0, 1.0)
+
+METRICS = ("ioi_correlation", "tempo_distance", "velocity_distance", "accent_agreement")
+
+# One row per measure of the score
+EVALUATION_DTYPE = np.dtype([
+    ('measure', 'i4'),
+    ('matched', 'f8'),  # share of the score notes matched in the rendition
+    ('ioi_correlation', 'f8'),
+    ('tempo_distance', 'f8'),
+    ('velocity_distance', 'f8'),
+    ('accent_agreement', 'f8'),
+])
+
+
+class Reference:
+    """
+    The score and the aligned recordings, prepared once for any number of renditions.
+
+    :param table: NoteTable of the score
+    :param performers: iterable of performer names, see tempo.PERFORMERS
+    :param directory: directory of the recordings and annotations
+    :param window: largest onset distance of a match, in seconds
+    """
+
+    def __init__(self, table, performers=PERFORMERS, directory: str = ANNOTATION_DIR,
+                 window: float = DEFAULT_WINDOW):
+        self.table = table
+        self.window = window
+        data = table.data
+        # score onsets shared by all parts, the unit of the timing metrics
+        keys = np.round(data['onset'] * 960).astype(np.int64)
+        self.onset_keys, self.group = np.unique(keys, return_inverse=True)
+        groups = len(self.onset_keys)
+        self.group_measure = np.zeros(groups, dtype=np.int64)
+        self.group_measure[self.group] = data['measure']
+        self.numbers, self.group_slot = np.unique(self.group_measure, return_inverse=True)
+        self.row_slot = self.group_slot[self.group]
+        # top voice of every onset
+        highest = np.full(groups, -1)
+        np.maximum.at(highest, self.group, data['pitch'])
+        self.top = data['pitch'] == highest[self.group]
+        first_part = table.measures[table.measures['part'] == table.measures['part'].min()]
+        bars = {int(row['number']): (row['offset'], row['offset'] + row['length']) for row in first_part}
+        self.bar_start = np.array([bars.get(int(n), (np.nan, np.nan))[0] for n in self.numbers])
+        self.bar_end = np.array([bars.get(int(n), (np.nan, np.nan))[1] for n in self.numbers])
+
+        self.performers = list(performers)
+        self.alignments = {}
+        self.tempo_maps = {}
+        for name in self.performers:
+            self.alignments[name] = align_performer(table, name, directory, window)[0]
+            self.tempo_maps[name] = TempoMap.from_annotations(annotation_path(name, directory))
+        self.features = {name: self.features_of(self.alignments[name], self.tempo_maps[name])
+                         for name in self.performers}
+        digest = hashlib.sha1(data.tobytes())
+        for name in self.performers:
+            for path in (f"{directory}/{name}.mid", annotation_path(name, directory)):
+                digest.update(file_key(path).encode())
+        digest.update(json.dumps([window, REFINE_WINDOWS]).encode())
+        self.key = digest.hexdigest()
+
+    def features_of(self, alignment: np.ndarray, tempo_map: TempoMap) -> dict:
+        """
+        Per-onset and per-measure features of an aligned rendition.
+        :param alignment: np.ndarray with alignment.ALIGNMENT_DTYPE
+        :param tempo_map: TempoMap of the rendition
+        :return: dict of arrays
+        """
+        matched = alignment['matched']
+        groups = len(self.onset_keys)
+        count = np.bincount(self.group[matched], minlength=groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            onset = np.bincount(self.group[matched], weights=alignment['onset'][matched], minlength=groups) / count
+        # inter-onset interval after each onset, inside its measure
+        ioi = np.full(groups, np.nan)
+        same_measure = self.group_measure[1:] == self.group_measure[:-1]
+        ioi[:-1] = np.where(same_measure, onset[1:] - onset[:-1], np.nan)
+
+        velocity = np.where(matched, alignment['velocity'], 0).astype(float)
+        spread = velocity[matched].std() if matched.sum() > 1 else 0.0
+        standard = np.where(matched, (velocity - velocity[matched].mean()) / (spread or 1.0), np.nan)
+
+        # top voice over the mean of the other matched notes of the onset
+        top = self.top & matched
+        others = ~self.top & matched
+        with np.errstate(divide='ignore', invalid='ignore'):
+            top_velocity = np.bincount(self.group[top], weights=velocity[top], minlength=groups) / \
+                np.bincount(self.group[top], minlength=groups)
+            other_velocity = np.bincount(self.group[others], weights=velocity[others], minlength=groups) / \
+                np.bincount(self.group[others], minlength=groups)
+        accent = np.sign(top_velocity - other_velocity)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tempo = (self.bar_end - self.bar_start) * 60.0 / \
+                (tempo_map.seconds(self.bar_end) - tempo_map.seconds(self.bar_start))
+        return {"matched": matched, "ioi": ioi, "velocity": standard, "accent": accent, "tempo": tempo}
+
+    def align_rendition(self, performed: np.ndarray) -> tuple:
+        """
+        Align a rendition of the score. Its tempo curve is unknown: the first alignment
+        stretches the score evenly over the rendition within a wide window, and each
+        alignment of REFINE_WINDOWS follows the tempo curve estimated from the previous one.
+        :param performed: np.ndarray with midi_io.PERFORMED_DTYPE
+        :return: (alignment, TempoMap)
+        """
+        onsets = self.table.data['onset']
+        tempo_map = TempoMap([onsets.min(), max(onsets.max(), onsets.min() + 1)],
+                             [performed['onset'].min(), max(performed['onset'].max(), performed['onset'].min() + 1)])
+        for window in REFINE_WINDOWS + (self.window,):
+            alignment = align(self.table, performed, tempo_map, window)
+            estimated = estimate_tempo_map(onsets, alignment)
+            if estimated is not None:
+                tempo_map = estimated
+        return alignment, tempo_map
+
+    def compare(self, features: dict, reference: dict) -> np.ndarray:
+        """
+        Per-measure metrics of a rendition against one recording.
+        :param features: dict, see features_of
+        :param reference: dict, features of the recording
+        :return: np.ndarray with EVALUATION_DTYPE
+        """
+        slots = len(self.numbers)
+        result = np.zeros(slots, dtype=EVALUATION_DTYPE)
+        result['measure'] = self.numbers
+        notes = np.bincount(self.row_slot, minlength=slots)
+        result['matched'] = np.bincount(self.row_slot, weights=features["matched"], minlength=slots) / \
+            np.maximum(notes, 1)
+        result['ioi_correlation'] = _grouped_correlation(self.group_slot, features["ioi"], reference["ioi"], slots)
+        result['tempo_distance'] = np.abs(np.log(features["tempo"] / reference["tempo"]))
+
+        both = np.isfinite(features["velocity"]) & np.isfinite(reference["velocity"])
+        squared = (features["velocity"] - reference["velocity"])[both] ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result['velocity_distance'] = np.sqrt(
+                np.bincount(self.row_slot[both], weights=squared, minlength=slots) /
+                np.bincount(self.row_slot[both], minlength=slots))
+        accents = np.isfinite(features["accent"]) & np.isfinite(reference["accent"]) & \
+            (features["accent"] != 0) & (reference["accent"] != 0)
+        agree = features["accent"][accents] == reference["accent"][accents]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result['accent_agreement'] = np.bincount(self.group_slot[accents], weights=agree, minlength=slots) / \
+                np.bincount(self.group_slot[accents], minlength=slots)
+        return result
+
+    def evaluate(self, performed: np.ndarray) -> dict:
+        """
+        Per-measure metrics of a rendition against every recording.
+        :param performed: np.ndarray with midi_io.PERFORMED_DTYPE
+        :return: dict performer -> np.ndarray with EVALUATION_DTYPE
+        """
+        alignment, tempo_map = self.align_rendition(performed)
+        features = self.features_of(alignment, tempo_map)
+        return {name: self.compare(features, self.features[name]) for name in self.performers}
+
+
+def _grouped_correlation(groups: np.ndarray, x: np.ndarray, y: np.ndarray, count: int) -> np.ndarray:
+    """
+    Pearson correlation of x and y in every group, over the pairs where both are finite.
+    """
+    valid = np.isfinite(x) & np.isfinite(y)
+    groups, x, y = groups[valid], x[valid], y[valid]
+    n = np.bincount(groups, minlength=count).astype(float)
+
+    def total(values):
+        return np.bincount(groups, weights=values, minlength=count)
+
+    sx, sy = total(x), total(y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = total(x * y) - sx * sy / n
+        variance = (total(x * x) - sx * sx / n) * (total(y * y) - sy * sy / n)
+        return np.where(variance > 1e-18, covariance / np.sqrt(np.maximum(variance, 1e-18)), np.nan)
+
+
+def estimate_tempo_map(score_onsets: np.ndarray, alignment: np.ndarray):
+    """
+    Tempo curve of a rendition through the median performed time of every matched score
+    onset. Onsets out of order, as left by wrong matches, are dropped: the curve goes
+    through the longest run of onsets whose performed times increase.
+    :param score_onsets: onset of every row of the table, in quarter lengths
+    :param alignment: np.ndarray with alignment.ALIGNMENT_DTYPE
+    :return: TempoMap, or None with fewer than two usable onsets
+    """
+    matched = alignment['matched']
+    positions, group = np.unique(score_onsets[matched], return_inverse=True)
+    onsets = alignment['onset'][matched]
+    order = np.lexsort((onsets, group))
+    low = np.searchsorted(group[order], np.arange(len(positions)))
+    count = np.bincount(group, minlength=len(positions))
+    times = (onsets[order[low + (count - 1) // 2]] + onsets[order[low + count // 2]]) / 2
+    kept = _increasing(times)
+    if len(kept) < 2:
+        return None
+    return TempoMap(positions[kept], times[kept])
+
+
+def _increasing(values: np.ndarray) -> np.ndarray:
+    """
+    Indices of a longest strictly increasing subsequence, O(n log n).
+    """
+    tails, tail_indices = [], []
+    previous = np.full(len(values), -1)
+    for i, value in enumerate(values):
+        k = bisect.bisect_left(tails, value)
+        if k == len(tails):
+            tails.append(value)
+            tail_indices.append(i)
+        else:
+            tails[k] = value
+            tail_indices[k] = i
+        previous[i] = tail_indices[k - 1] if k else -1
+    kept = []
+    i = tail_indices[-1] if tail_indices else -1
+    while i >= 0:
+        kept.append(i)
+        i = previous[i]
+    return np.array(kept[::-1], dtype=np.int64)
+
+
+def summarize(scores: dict) -> dict:
+    """
+    Mean of every metric over the measures, per performer and over all the performers.
+    :param scores: dict performer -> np.ndarray with EVALUATION_DTYPE
+    :return: dict performer (and "mean") -> dict metric -> float
+    """
+    summary = {name: {metric: float(np.nanmean(result[metric])) for metric in ('matched',) + METRICS}
+               for name, result in scores.items()}
+    summary["mean"] = {metric: float(np.mean([s[metric] for s in summary.values()]))
+                       for metric in ('matched',) + METRICS}
+    return summary
+
+
+@functools.lru_cache(maxsize=4)
+def reference(score: str = DEFAULT_SCORE, performers=PERFORMERS, directory: str = ANNOTATION_DIR) -> Reference:
+    """
+    Reference of a score, built once per process.
+    :param score: MIDI file of the score
+    :param performers: tuple of performer names
+    :param directory: directory of the recordings
+    :return: Reference
+    """
+    from .notetable import NoteTable
+    from .utils import get_stream
+
+    return Reference(NoteTable.from_stream(get_stream(score)), performers, directory)
+
+
+def evaluate_file(filename: str, ref: Reference = None, cache_dir: str = DEFAULT_EVALUATION_CACHE_DIR) -> dict:
+    """
+    Per-measure scores of a rendered MIDI file, read from the cache when the same file was
+    already scored against the same reference.
+    :param filename: rendered MIDI file
+    :param ref: Reference, the default score and recordings if not given
+    :param cache_dir: directory of the cached scores, None to disable the cache
+    :return: dict performer -> np.ndarray with EVALUATION_DTYPE
+    """
+    ref = ref if ref is not None else reference()
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, hashlib.sha1((file_key(filename) + ref.key).encode()).hexdigest() + ".npz")
+        if os.path.exists(path):
+            with np.load(path) as f:
+                return {name: f[name] for name in ref.performers}
+    scores = ref.evaluate(midi_io.read_notes(filename))
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = path + f".{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **scores)
+        os.replace(tmp, path)
+    return scores
+
+
+def format_scores(scores: dict) -> str:
+    """
+    Table of the per-measure scores, averaged over the performers.
+    """
+    lines = [f"{'measure':>8}{'matched':>9}" + "".join(f"{metric:>19}" for metric in METRICS)]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # measures without any value stay NaN
+        mean = {metric: np.nanmean(np.stack([s[metric] for s in scores.values()]), axis=0)
+                for metric in ('matched',) + METRICS}
+    for i, number in enumerate(next(iter(scores.values()))['measure']):
+        lines.append(f"{number:>8}{mean['matched'][i]:>9.2f}" +
+                     "".join(f"{mean[metric][i]:>19.3f}" for metric in METRICS))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.evaluation", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="rendered MIDI files")
+    parser.add_argument("--score", default=DEFAULT_SCORE, help="score the renditions were rendered from")
+    parser.add_argument("--directory", default=ANNOTATION_DIR, help="directory of the recordings")
+    parser.add_argument("--performers", nargs="+", default=list(PERFORMERS))
+    parser.add_argument("--measures", action="store_true", help="print the per-measure scores, averaged over "
+                                                                "the performers")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the score cache")
+    parser.add_argument("--json", help="write the summaries to this file")
+    args = parser.parse_args(argv)
+
+    ref = reference(args.score, tuple(args.performers), args.directory)
+    summaries = {}
+    for filename in args.inputs:
+        scores = evaluate_file(filename, ref, None if args.no_cache else DEFAULT_EVALUATION_CACHE_DIR)
+        summaries[filename] = summarize(scores)
+        print(filename)
+        for name, summary in summaries[filename].items():
+            print(f"  {name:<16}" + "".join(f"{metric} {value:.3f}  " for metric, value in summary.items()))
+        if args.measures:
+            print(format_scores(scores))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summaries, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+Incremental rendering: cache the MIDI events of every measure and only re-render the
+measures whose source or transforms changed.
+
+A measure's key is the hash of its source content and of the plan steps touching it (the
+arguments other than the measure range, in pass order). Steps with a measure range are
+re-run on the missing measures only; steps without one (e.g. change_dynamics_for_whole_piece)
+run on the whole score whenever a measure is missing, and their arguments are part of
+every key. The output is reassembled from the cached per-measure event blocks and written
+with midi_io.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from . import midi_io
+
+DEFAULT_MEASURE_CACHE_DIR = os.environ.get(
+    "DM_MEASURE_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "dm_assignment2", "measures"))
+
+
+class MeasureCache:
+    """
+    Per-measure event blocks (.npy) and per-file source hashes (.json) on disk.
+
+    :param directory: folder holding the cache
+    """
+
+    def __init__(self, directory: str = DEFAULT_MEASURE_CACHE_DIR):
+        self.directory = directory
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _write(self, name: str, write):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self._path(name + f".{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, self._path(name))
+
+    def get(self, key: str):
+        """
+        :param key: measure key
+        :return: np.ndarray with midi_io.EVENT_DTYPE, or None on a miss
+        """
+        path = self._path(key + ".npy")
+        if not os.path.exists(path):
+            return None
+        return np.load(path, allow_pickle=False)
+
+    def put(self, key: str, events: np.ndarray):
+        self._write(key + ".npy", lambda f: np.save(f, events, allow_pickle=False))
+
+    def get_source(self, file_key: str):
+        """
+        :param file_key: content hash of a source file
+        :return: dict with "numbers", "offsets", "lengths" and "hashes" lists, or None
+        """
+        path = self._path(file_key + ".json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def put_source(self, file_key: str, source: dict):
+        self._write(file_key + ".json", lambda f: f.write(json.dumps(source).encode()))
+
+
+def file_key(filename: str) -> str:
+    """
+    Content hash of a file.
+    :param filename: str
+    :return: str, hex digest
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_measures(table) -> dict:
+    """
+    Number, offset, length and content hash of every measure of a score, the hash
+    covering the notes and the measure rows of every part.
+    :param table: NoteTable of the unmodified score
+    :return: dict of lists, see MeasureCache.get_source
+    """
+    first_part = table.measures[table.measures['part'] == table.measures['part'].min()]
+    numbers = np.unique(table.measures['number'])
+    offsets = {int(row['number']): float(row['offset']) for row in first_part}
+    lengths = {int(row['number']): float(row['length']) for row in first_part}
+    hashes = []
+    for number in numbers:
+        digest = hashlib.sha1()
+        rows = table.data[table.data['measure'] == number]
+        # onsets are measure-relative through 'offset'; the absolute onset is left out
+        digest.update(rows[['part', 'offset', 'beat', 'duration', 'pitch', 'velocity', 'chord', 'component']]
+                      .tobytes())
+        digest.update(table.measures[table.measures['number'] == number][
+            ['part', 'length', 'numerator', 'denominator', 'sharps', 'has_key', 'tempo']].tobytes())
+        hashes.append(digest.hexdigest())
+    return {"numbers": numbers.tolist(), "offsets": [offsets.get(int(n), 0.0) for n in numbers],
+            "lengths": [lengths.get(int(n), 0.0) for n in numbers], "hashes": hashes}
+
+
+def measure_keys(source: dict, plan: dict, ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER) -> list:
+    """
+    Cache key of every measure of a source for a plan.
+    :param source: dict, see source_measures
+    :param plan: dict, performance plan
+    :param ticks_per_quarter: MIDI resolution of the blocks
+    :return: list of str, one per source measure
+    """
+    from .render import random_keys, schedule, step_fingerprint, step_measures
+
+    steps = [step for _, group in schedule(plan) for step in group]
+    ranges = [step_measures(step) for step in steps]
+    fingerprints = [[step_fingerprint(step), key] for step, key in zip(steps, random_keys(steps))]
+    keys = []
+    for number, content in zip(source["numbers"], source["hashes"]):
+        touching = [fingerprint for (start, end), fingerprint in zip(ranges, fingerprints)
+                    if start is None or start <= number <= end]
+        digest = hashlib.sha1(json.dumps([content, touching, ticks_per_quarter, plan.get("seed")]).encode())
+        keys.append(digest.hexdigest())
+    return keys
+
+
+def clip_plan(plan: dict, missing: list) -> dict:
+    """
+    Restrict the steps of a plan to a set of measures: range steps are cut to the runs of
+    missing measures they cover, steps without a range are kept whole. Randomized steps
+    keep the key of their random stream in the full plan (see render.random_keys), so the
+    measures draw the same numbers as in a full render.
+    :param plan: dict, performance plan
+    :param missing: sorted list of measure numbers
+    :return: dict, plan
+    """
+    from .render import TRANSFORMS, random_keys, schedule, step_measures
+
+    runs = []
+    for number in missing:
+        if runs and runs[-1][1] == number - 1:
+            runs[-1][1] = number
+        else:
+            runs.append([number, number])
+    scheduled = [step for _, group in schedule(plan) for step in group]
+    steps = []
+    for step, key in zip(scheduled, random_keys(scheduled)):
+        if key is not None:
+            step = dict(step, random_key=key)
+        start, end = step_measures(step)
+        if start is None:
+            steps.append(step)
+            continue
+        _, _, start_arg, end_arg = TRANSFORMS[step["transform"]]
+        for low, high in runs:
+            if high < start or low > end:
+                continue
+            args = dict(step.get("args", {}))
+            args[start_arg] = max(start, low)
+            if end_arg != start_arg:
+                args[end_arg] = min(end, high)
+            steps.append(dict(step, args=args))
+    return dict(plan, steps=steps)
+
+
+def measure_events(table, controllers, number: int, ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER):
+    """
+    MIDI events of one measure, ticks relative to the start of the measure. Program
+    changes are left to the assembly.
+    :param table: NoteTable of the rendered score
+    :param controllers: ControllerTrack of the rendered score, or None
+    :param number: measure number
+    :param ticks_per_quarter: MIDI resolution
+    :return: np.ndarray with midi_io.EVENT_DTYPE
+    """
+    from .controllers import ControllerTrack
+
+    events = midi_io.table_events(table, ticks_per_quarter, number, number, carry=False)
+    events = events[events['kind'] != midi_io.PROGRAM]
+    rows = table.measures[table.measures['number'] == number]
+    if controllers is not None and len(rows):
+        start = rows['offset'].min()
+        # up to the next measure: a measure lengthened by a timing step overlaps it
+        later = table.measures[table.measures['number'] > number]
+        window = ControllerTrack(controllers.between(start, later['offset'].min() if len(later) else np.inf))
+        events = np.concatenate([events, window.midi_events(ticks_per_quarter, start)])
+    return events
+
+
+def assemble(blocks: list, offsets: list, ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER) -> np.ndarray:
+    """
+    Concatenate per-measure event blocks at their measure offsets.
+    :param blocks: list of event arrays
+    :param offsets: list of measure offsets in quarter lengths
+    :param ticks_per_quarter: MIDI resolution
+    :return: np.ndarray with midi_io.EVENT_DTYPE
+    """
+    shifted = []
+    for block, offset in zip(blocks, offsets):
+        block = block.copy()
+        block['tick'] += int(round(offset * ticks_per_quarter))
+        shifted.append(block)
+    events = np.concatenate(shifted) if shifted else np.zeros(0, dtype=midi_io.EVENT_DTYPE)
+    # keep the write order of each block, then of the blocks
+    events['order'] = np.arange(len(events))
+    tracks = np.unique(events['track'][events['track'] > 0])
+    programs = midi_io.make_events(tracks, 0, midi_io.PROGRAM, np.minimum(tracks - 1, 15), 0)
+    return midi_io.sort_events(np.concatenate([events, programs]))
+
+
+def load_source(filename: str, cache: MeasureCache) -> tuple:
+    """
+    Measures of an input file, from the cache or parsed and stored.
+    :param filename: input MIDI file
+    :param cache: MeasureCache
+    :return: (source dict, see source_measures, and the stream parsed on the way or None)
+    """
+    key = file_key(filename)
+    source = cache.get_source(key)
+    my_stream = None
+    if source is None:
+        from .notetable import NoteTable
+        from .utils import get_stream
+
+        source = source_measures(NoteTable.from_stream(get_stream(filename)))
+        cache.put_source(key, source)
+        # building the table caches the measure durations, which the timing steps do not
+        # reset: render on an untouched copy
+        my_stream = get_stream(filename)
+    return source, my_stream
+
+
+def render_measures(filename: str, plan: dict, numbers: list, keys: dict, cache: MeasureCache, my_stream=None,
+                    ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER) -> dict:
+    """
+    Render the blocks of some measures on a fresh copy of the score, the plan clipped to
+    them, and store them in the cache.
+    :param filename: input MIDI file
+    :param plan: dict, performance plan
+    :param numbers: sorted list of measure numbers
+    :param keys: dict measure number -> cache key, see measure_keys
+    :param cache: MeasureCache
+    :param my_stream: optional unmodified stream of the file, parsed otherwise
+    :param ticks_per_quarter: MIDI resolution
+    :return: dict measure number -> np.ndarray with midi_io.EVENT_DTYPE
+    """
+    from .controllers import stored_controller_track
+    from .index import MeasureIndex
+    from .notetable import NoteTable
+    from .render import render
+    from .utils import get_stream
+
+    my_stream = my_stream if my_stream is not None else get_stream(filename)
+    index = MeasureIndex(my_stream)
+    my_stream = render(my_stream, clip_plan(plan, numbers), index)
+    table = NoteTable.from_stream(my_stream, index)
+    controllers = stored_controller_track(my_stream)
+    blocks = {}
+    for number in numbers:
+        blocks[number] = measure_events(table, controllers, number, ticks_per_quarter)
+        cache.put(keys[number], blocks[number])
+    return blocks
+
+
+def render_incremental(filename: str, plan: dict, output, cache: MeasureCache = None,
+                       ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER) -> dict:
+    """
+    Render a plan on a MIDI file, reusing the cached blocks of the measures whose source
+    content and steps did not change.
+    :param filename: input MIDI file
+    :param plan: dict, performance plan
+    :param output: file name or binary file object
+    :param cache: MeasureCache, the default directory if not given
+    :param ticks_per_quarter: MIDI resolution
+    :return: dict with "measures", "rendered" and "reused" counts
+    """
+    cache = cache if cache is not None else MeasureCache()
+    source, my_stream = load_source(filename, cache)
+    keys = measure_keys(source, plan, ticks_per_quarter)
+    blocks = [cache.get(k) for k in keys]
+    missing = [number for number, block in zip(source["numbers"], blocks) if block is None]
+    if missing:
+        rendered = render_measures(filename, plan, missing, dict(zip(source["numbers"], keys)), cache, my_stream,
+                                   ticks_per_quarter)
+        blocks = [rendered.get(number, block) for number, block in zip(source["numbers"], blocks)]
+
+    midi_io.write_midi(assemble(blocks, source["offsets"], ticks_per_quarter), output, ticks_per_quarter)
+    return {"measures": len(keys), "rendered": len(missing), "reused": len(keys) - len(missing)}
@@ -0,0 +1,261 @@
+import bisect
+from collections import namedtuple
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from music21 import stream
+
+    from .metric import MetricGrid
+
+# Highest sounding pitch at one onset of a measure: ``element`` is the owning Note or
+# Chord, ``note`` the Note carrying the pitch (the element itself, or the top component
+# of a chord), whose volume should be changed to accent it.
+TopNote = namedtuple('TopNote', ['offset', 'pitch', 'element', 'note'])
+
+
+class MeasureIndex:
+    """
+    Lookup table from (part, measure number) to the measures of a parsed score.
+
+    ``part.measure(n)`` searches the whole part on every call, so looping over a range of
+    measures costs O(N * M). The index walks the score once and then answers each lookup
+    from a dictionary. Flattened note lists are built lazily per measure and cached; call
+    ``invalidate`` after inserting or removing notes so the next lookup sees the change.
+    ``lookups`` counts the measure lookups (get and stack) answered so far.
+
+    :param s: music21 Score, Part or any stream holding measures
+    """
+
+    def __init__(self, s: 'stream.Stream'):
+        self.stream = s
+        self.lookups = 0
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        Walk the stream again and forget every cached note list.
+        """
+        from music21 import stream
+
+        parts = list(self.stream.parts) if isinstance(self.stream, stream.Score) else []
+        self.parts = parts if parts else [self.stream]
+        self._measures = {}
+        for part_index, part in enumerate(self.parts):
+            for m in part.getElementsByClass(stream.Measure):
+                # keep the first measure carrying a number, like part.measure(n)
+                self._measures.setdefault((part_index, m.number), m)
+        self._notes = {}
+        self._top_lines = {}
+        self._metric = None
+        self._contexts = {}
+
+    def get(self, number: int, part: int = 0):
+        """
+        Return the measure with the given number in one part.
+
+        :param number: measure number
+        :param part: part index (0-based)
+        :return: music21.stream.Measure or None
+        """
+        self.lookups += 1
+        return self._measures.get((part, number))
+
+    def peek(self, number: int, part: int = 0):
+        """
+        Like ``get``, without counting a lookup.
+
+        :param number: measure number
+        :param part: part index (0-based)
+        :return: music21.stream.Measure or None
+        """
+        return self._measures.get((part, number))
+
+    def stack(self, number: int) -> list:
+        """
+        Return the measures with the given number in every part, skipping missing ones.
+
+        :param number: measure number
+        :return: list of music21.stream.Measure
+        """
+        self.lookups += 1
+        measures = [self._measures.get((part, number)) for part in range(len(self.parts))]
+        return [m for m in measures if m is not None]
+
+    def numbers(self, part: int = 0) -> list:
+        """
+        Return the sorted measure numbers of one part.
+
+        :param part: part index (0-based)
+        :return: list of int
+        """
+        return sorted(number for p, number in self._measures if p == part)
+
+    def notes(self, number: int, part: int = None, ordered: bool = True) -> list:
+        """
+        Return the flattened notes and chords of a measure.
+
+        :param number: measure number
+        :param part: part index (0-based), or None to concatenate every part
+        :param ordered: True for ``measure.flatten().notes`` order (sorted by offset),
+            False for ``measure.recurse().notes`` order (voice by voice)
+        :return: list of music21.note.Note and music21.chord.Chord
+        """
+        if part is None:
+            return [n for p in range(len(self.parts)) for n in self.notes(number, p, ordered)]
+        key = (part, number, ordered)
+        if key not in self._notes:
+            m = self.get(number, part)
+            if m is None:
+                self._notes[key] = []
+            elif ordered:
+                self._notes[key] = list(m.flatten().notes)
+            else:
+                self._notes[key] = list(m.recurse().notes)
+        return self._notes[key]
+
+    def top_line(self, number: int, part: int = None) -> list:
+        """
+        Return the skyline of a measure: for each onset, the highest sounding pitch and the
+        note or chord owning it, looking inside chords and across voices. Grace notes are
+        left out. Built once per measure and cached like ``notes``.
+
+        :param number: measure number
+        :param part: part index (0-based), or None for the highest pitch over every part
+        :return: list of TopNote sorted by offset in the measure
+        """
+        key = (part, number)
+        if key not in self._top_lines:
+            parts = range(len(self.parts)) if part is None else [part]
+            top = {}
+            for p in parts:
+                m = self.get(number, p)
+                for element in self.notes(number, p):
+                    if element.duration.quarterLength == 0:
+                        continue
+                    if element.isChord:
+                        highest = max(element.notes, key=lambda n: n.pitch.midi)
+                    else:
+                        highest = element
+                    offset = element.getOffsetInHierarchy(m)
+                    if offset not in top or highest.pitch.midi > top[offset].pitch:
+                        top[offset] = TopNote(offset, highest.pitch.midi, element, highest)
+            self._top_lines[key] = [top[offset] for offset in sorted(top)]
+        return self._top_lines[key]
+
+    def metric(self, start_measure: int = None, end_measure: int = None) -> 'MetricGrid':
+        """
+        Return the beat, beat strength and position in the bar of every note and chord,
+        see metric.MetricGrid. Built on first use and dropped by ``invalidate``. With a
+        measure range and no grid built yet, a grid of the range alone is built and not
+        kept, so a call on a few measures does not walk the whole score.
+
+        :param start_measure: optional first measure number the caller needs
+        :param end_measure: optional last measure number the caller needs
+        :return: MetricGrid
+        """
+        from .metric import MetricGrid
+
+        if self._metric is None and (start_measure is not None or end_measure is not None):
+            return MetricGrid(self, start_measure, end_measure)
+        if self._metric is None:
+            self._metric = MetricGrid(self)
+        return self._metric
+
+    def context(self, number: int, part: int = 0) -> tuple:
+        """
+        Return the time signature, key signature and metronome mark in force in a measure:
+        the last ones set by that measure or an earlier measure of the part. Resolved for
+        the whole part on first use, so a lookup does not walk back over the measures.
+
+        :param number: measure number, need not exist (e.g. the measure before a range)
+        :param part: part index (0-based)
+        :return: (TimeSignature, KeySignature, MetronomeMark), each None if not set yet
+        """
+        if part not in self._contexts:
+            numbers = self.numbers(part)
+            contexts = []
+            current = (None, None, None)
+            for n in numbers:
+                current = tuple(new if new is not None else old
+                                for new, old in zip(self._measure_context(n, part), current))
+                contexts.append(current)
+            self._contexts[part] = (numbers, contexts)
+        numbers, contexts = self._contexts[part]
+        position = bisect.bisect_right(numbers, number)
+        return contexts[position - 1] if position else (None, None, None)
+
+    def time_signature(self, number: int, part: int = 0):
+        """
+        Return the time signature in force in a measure, walking back only to the last
+        measure that sets one (``context`` resolves the whole part at once).
+
+        :param number: measure number, need not exist
+        :param part: part index (0-based)
+        :return: music21.meter.TimeSignature, or None before the first one
+        """
+        if part in self._contexts:
+            return self.context(number, part)[0]
+        numbers = self.numbers(part)
+        for n in reversed(numbers[:bisect.bisect_right(numbers, number)]):
+            ts = self._time_signature(n, part)
+            if ts is not None:
+                return ts
+        return None
+
+    def _time_signature(self, number: int, part: int):
+        return self._measures[(part, number)].timeSignature
+
+    def _measure_context(self, number: int, part: int) -> tuple:
+        from music21 import tempo
+
+        m = self._measures[(part, number)]
+        marks = m.getElementsByClass(tempo.MetronomeMark)
+        return m.timeSignature, m.keySignature, marks[0] if marks else None
+
+    def invalidate(self, number: int, part: int = None):
+        """
+        Drop the cached note lists of a measure after notes were inserted, removed or
+        transposed.
+
+        :param number: measure number
+        :param part: part index (0-based), or None for every part
+        """
+        parts = range(len(self.parts)) if part is None else [part]
+        for p in parts:
+            self._notes.pop((p, number, True), None)
+            self._notes.pop((p, number, False), None)
+            self._top_lines.pop((p, number), None)
+        self._top_lines.pop((None, number), None)
+        self._metric = None
+
+
+def rhythmic_cells(top_line: list, size: int, quarter_length: float, triplets: bool = False) -> list:
+    """
+    Consecutive runs of ``size`` onsets of a top line spaced by ``quarter_length``, e.g.
+    the pairs of sixteenths (2, 0.25) or triples of thirty-seconds (3, 0.125) of a
+    measure. Onsets are compared rather than durations, which the MIDI parser shortens.
+    Runs overlap, as a sliding window.
+
+    :param top_line: list of TopNote, see MeasureIndex.top_line
+    :param size: number of onsets in a cell
+    :param quarter_length: spacing of the onsets of a cell
+    :param triplets: also accept the triplet spacing (2/3 of ``quarter_length``)
+    :return: list of lists of TopNote
+    """
+    spacings = (quarter_length, quarter_length * 2 / 3) if triplets else (quarter_length,)
+    spaced = [min(abs(float(b.offset - a.offset) - spacing) for spacing in spacings) < 1e-6
+              for a, b in zip(top_line[:-1], top_line[1:])]
+    return [top_line[j:j + size] for j in range(len(top_line) - size + 1) if all(spaced[j:j + size - 1])]
+
+
+def measure_index(s: 'stream.Stream', index: MeasureIndex = None) -> MeasureIndex:
+    """
+    Return ``index`` if one was given for ``s``, otherwise build a new one.
+
+    :param s: music21 stream
+    :param index: optional existing MeasureIndex
+    :return: MeasureIndex
+    """
+    if index is not None and index.stream is s:
+        return index
+    return MeasureIndex(s)
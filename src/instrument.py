@@ -0,0 +1,216 @@
+"""
+Instrumentation of the transforms.
+
+Every public transform is wrapped by ``instrumented``. While the registry is enabled
+(``registry.enable()``, or ``--profile`` in src.render), each call records its wall time,
+the number of notes it changed (pitch, velocity or duration, added or removed), the
+measure lookups it made through the MeasureIndex and the measures it covered. When the
+registry is disabled, the wrapper only forwards the call.
+
+The registry reports per transform and per measure totals as JSON, or as folded stacks
+(``render;<pass>;<transform>;m<measure> <microseconds>``) for flame graph tools.
+Progress messages of the transforms go to the ``src`` loggers, at DEBUG level.
+"""
+import functools
+import inspect
+import json
+import time
+from collections import defaultdict
+
+from .index import measure_index
+
+
+class Registry:
+    """
+    In-memory record of the instrumented calls.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.calls = []
+        self._stack = []
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self.calls = []
+        self._stack = []
+
+    def push(self, name: str) -> dict:
+        """
+        Open a frame, e.g. a render pass, under which the next calls are recorded.
+        :param name: str
+        :return: dict, the frame, to pass to pop
+        """
+        frame = {"name": name, "stack": [f["name"] for f in self._stack] + [name], "children": 0.0,
+                 "start": time.perf_counter()}
+        self._stack.append(frame)
+        return frame
+
+    def pop(self, frame: dict) -> float:
+        """
+        Close a frame and charge its time to the enclosing one.
+        :param frame: dict returned by push
+        :return: float, inclusive seconds of the frame
+        """
+        seconds = time.perf_counter() - frame["start"]
+        self._stack.remove(frame)
+        if self._stack:
+            self._stack[-1]["children"] += seconds
+        return seconds
+
+    def frame(self, name: str):
+        """
+        Context manager around push and pop, for non-transform frames.
+        """
+        return _Frame(self, name)
+
+    def record(self, frame: dict, seconds: float, notes: int, lookups: int, measures: dict):
+        self.calls.append({"transform": frame["name"], "stack": frame["stack"], "seconds": seconds,
+                           "self_seconds": max(seconds - frame["children"], 0.0), "notes": notes,
+                           "lookups": lookups, "measures": measures})
+
+    def transforms(self) -> dict:
+        """
+        Totals per transform: calls, inclusive seconds, notes changed and measure lookups.
+        :return: dict name -> dict
+        """
+        totals = defaultdict(lambda: {"calls": 0, "seconds": 0.0, "notes": 0, "lookups": 0})
+        for call in self.calls:
+            total = totals[call["transform"]]
+            total["calls"] += 1
+            total["seconds"] += call["seconds"]
+            total["notes"] += call["notes"]
+            total["lookups"] += call["lookups"]
+        return dict(totals)
+
+    def measures(self) -> dict:
+        """
+        Totals per measure number: self time of the calls covering it, split evenly over
+        the measures of each call, and notes changed in it.
+        :return: dict number -> dict
+        """
+        totals = defaultdict(lambda: {"seconds": 0.0, "notes": 0})
+        for call in self.calls:
+            share = call["self_seconds"] / max(len(call["measures"]), 1)
+            for number, notes in call["measures"].items():
+                totals[number]["seconds"] += share
+                totals[number]["notes"] += notes
+        return dict(sorted(totals.items()))
+
+    def report(self) -> dict:
+        return {"transforms": self.transforms(), "measures": self.measures()}
+
+    def folded(self) -> list:
+        """
+        Folded stacks of the self time, in microseconds, one line per stack and measure.
+        :return: list of str
+        """
+        lines = defaultdict(float)
+        for call in self.calls:
+            stack = ";".join(["render"] + call["stack"])
+            measures = call["measures"] or {None: 0}
+            share = call["self_seconds"] * 1e6 / len(measures)
+            for number in measures:
+                lines[stack if number is None else f"{stack};m{number}"] += share
+        return [f"{stack} {int(round(value))}" for stack, value in lines.items()]
+
+    def dump(self, filename: str):
+        """
+        Write the report, as folded stacks for a .folded or .txt file and as JSON otherwise.
+        :param filename: str
+        """
+        with open(filename, "w") as f:
+            if filename.endswith((".folded", ".txt")):
+                f.write("\n".join(self.folded()) + "\n")
+            else:
+                json.dump(self.report(), f, indent=1)
+
+
+class _Frame:
+    def __init__(self, registry: Registry, name: str):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        if self.registry.enabled:
+            self.frame = self.registry.push(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        if self.registry.enabled:
+            self.registry.pop(self.frame)
+        return False
+
+
+registry = Registry()
+
+
+def _note_state(index, numbers) -> dict:
+    """
+    Pitch, velocity and duration of every note of some measures, keyed by measure and note
+    identity. Chord components are listed one by one.
+    """
+    state = {}
+    for number in numbers:
+        for part in range(len(index.parts)):
+            m = index.peek(number, part)
+            if m is None:
+                continue
+            for element in m.recurse().notes:
+                length = float(element.duration.quarterLength)
+                for n in (element.notes if element.isChord else [element]):
+                    state[(number, id(n))] = (n.pitch.midi, n.volume.velocity, length)
+    return state
+
+
+def instrumented(start_arg: str = None, end_arg: str = None):
+    """
+    Decorator recording the calls of a transform in the registry.
+    :param start_arg: name of the argument holding the first measure, None if the
+        transform covers the whole score
+    :param end_arg: name of the argument holding the last measure, start_arg by default
+    :return: decorator
+    """
+    end_arg = end_arg or start_arg
+
+    def decorate(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return function(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            s = next(iter(bound.arguments.values()))
+            # share the index with the transform to count its lookups
+            index = measure_index(s, bound.arguments.get("index"))
+            bound.arguments["index"] = index
+            if start_arg is None:
+                numbers = sorted({number for part in range(len(index.parts)) for number in index.numbers(part)})
+            else:
+                numbers = range(bound.arguments[start_arg], bound.arguments[end_arg] + 1)
+            before = _note_state(index, numbers)
+            frame = registry.push(function.__name__)
+            lookups = index.lookups
+            try:
+                result = function(*bound.args, **bound.kwargs)
+            finally:
+                seconds = registry.pop(frame)
+            lookups = index.lookups - lookups
+            after = _note_state(index, numbers)
+            changed = defaultdict(int)
+            for key in before.keys() | after.keys():
+                if before.get(key) != after.get(key):
+                    changed[key[0]] += 1
+            registry.record(frame, seconds, sum(changed.values()), lookups,
+                            {number: changed.get(number, 0) for number in numbers})
+            return result
+
+        return wrapper
+
+    return decorate
@@ -0,0 +1,132 @@
+"""
+Metric positions of the notes: beat, beat strength and position in the bar.
+
+music21's ``beat`` and ``beatStrength`` properties walk up to the context time signature
+on every access. Here the time signature map is resolved once per part and the beat
+strengths are computed once per (time signature, offset) pair, then kept as arrays so
+beat-targeted transforms select their notes with a vectorized mask.
+"""
+import bisect
+
+import numpy as np
+
+from .index import MeasureIndex
+
+# One row per note or chord of a score, in the order of MetricGrid.elements
+METRIC_DTYPE = np.dtype([
+    ('part', 'i2'),
+    ('measure', 'i4'),
+    ('offset', 'f8'),  # position in the bar, quarter lengths from the start of the measure
+    ('beat', 'f8'),  # 1-based, as music21's ``beat``
+    ('strength', 'f8'),  # as music21's ``beatStrength``
+])
+
+
+def time_signature_map(index: MeasureIndex, part: int = 0) -> dict:
+    """
+    Resolve the time signature in force in every measure of a part, carrying the last
+    signature forward over measures where ``measure.timeSignature`` is None.
+    :param index: MeasureIndex
+    :param part: part index
+    :return: dict measure number -> music21.meter.TimeSignature (None before the first one)
+    """
+    current = None
+    signatures = {}
+    for number in index.numbers(part):
+        m = index.get(number, part)
+        if m.timeSignature is not None:
+            current = m.timeSignature
+        signatures[number] = current
+    return signatures
+
+
+def beat_strength(time_signature, offset: float, cache: dict = None) -> float:
+    """
+    Beat strength of a position in a bar, as music21's ``beatStrength``.
+    :param time_signature: music21.meter.TimeSignature, or None (strength 0)
+    :param offset: position in the bar, in quarter lengths
+    :param cache: optional dict reused between calls, keyed by signature and offset
+    :return: float
+    """
+    if time_signature is None:
+        return 0.0
+    key = (time_signature.ratioString, offset)
+    if cache is not None and key in cache:
+        return cache[key]
+    if offset >= time_signature.barDuration.quarterLength:
+        # offsets past the bar (overfull measures) have no accent
+        strength = 0.0
+    else:
+        strength = float(time_signature.getAccentWeight(offset, forcePositionMatch=True))
+    if cache is not None:
+        cache[key] = strength
+    return strength
+
+
+class MetricGrid:
+    """
+    Metric position of every note and chord of a score, built in one walk over a
+    MeasureIndex. ``positions`` is a structured array with METRIC_DTYPE and ``elements``
+    the notes and chords of its rows, in ``measure.recurse().notes`` order per measure.
+
+    :param index: MeasureIndex of the score
+    :param start_measure: optional first measure number, the grid covers the whole score by default
+    :param end_measure: optional last measure number
+    """
+
+    def __init__(self, index: MeasureIndex, start_measure: int = None, end_measure: int = None):
+        rows = []
+        self.elements = []
+        strengths = {}
+        for part in range(len(index.parts)):
+            numbers = index.numbers(part)
+            if start_measure is not None:
+                numbers = numbers[bisect.bisect_left(numbers, start_measure):]
+            if end_measure is not None:
+                numbers = numbers[:bisect.bisect_right(numbers, end_measure)]
+            # walk back to the signature in force before the range once, then carry it
+            ts = index.time_signature(numbers[0] - 1, part) if len(numbers) else None
+            for number in numbers:
+                m = index.get(number, part)
+                if m.timeSignature is not None:
+                    ts = m.timeSignature
+                length = ts.beatDuration.quarterLength if ts is not None else 1.0
+                for n in index.notes(number, part, ordered=False):
+                    offset = float(n.getOffsetInHierarchy(m))
+                    rows.append((part, number, offset, 1.0 + offset / length, beat_strength(ts, offset, strengths)))
+                    self.elements.append(n)
+        self.positions = np.array(rows, dtype=METRIC_DTYPE)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def select(self, start_measure: int, end_measure: int, beats=None, parts=None,
+               min_strength: float = None) -> np.ndarray:
+        """
+        Boolean mask of the elements in a measure range, optionally on some beats only.
+        :param start_measure: first measure number (inclusive)
+        :param end_measure: last measure number (inclusive)
+        :param beats: optional list of beats, e.g. [1, 3]
+        :param parts: optional iterable of part indices
+        :param min_strength: optional lowest beat strength
+        :return: np.ndarray of bool
+        """
+        positions = self.positions
+        mask = (positions['measure'] >= start_measure) & (positions['measure'] <= end_measure)
+        if beats is not None:
+            mask &= on_beats(positions['beat'], beats)
+        if parts is not None:
+            mask &= np.isin(positions['part'], list(parts))
+        if min_strength is not None:
+            mask &= positions['strength'] >= min_strength
+        return mask
+
+
+def on_beats(beat: np.ndarray, beats) -> np.ndarray:
+    """
+    Mask of the beat values equal to one of ``beats``.
+    :param beat: array of beats
+    :param beats: list of beats
+    :return: np.ndarray of bool
+    """
+    return np.isclose(np.asarray(beat)[:, None], np.asarray(list(beats), dtype=float)[None, :]).any(axis=1)
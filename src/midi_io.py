@@ -0,0 +1,399 @@
+import io
+import struct
+
+import numpy as np
+
+TICKS_PER_QUARTER = 480
+
+# Event kinds, in the order events sharing a tick are written
+TEMPO = 0  # data2: microseconds per quarter note
+TIME_SIGNATURE = 1  # data1: numerator, data2: denominator
+KEY_SIGNATURE = 2  # data1: sharps (negative for flats)
+PROGRAM = 3  # data1: program number
+NOTE_OFF = 4  # data1: pitch
+CONTROL = 5  # data1: controller number, data2: value
+NOTE_ON = 6  # data1: pitch, data2: velocity
+
+# Flat event list: track 0 is the conductor track, parts start at track 1. ``order``
+# breaks ties between events of the same kind at the same tick (insertion order).
+EVENT_DTYPE = np.dtype([
+    ('track', 'i2'),
+    ('tick', 'i8'),
+    ('kind', 'u1'),
+    ('order', 'i8'),
+    ('channel', 'u1'),  # 0-based MIDI channel
+    ('data1', 'i4'),
+    ('data2', 'i4'),
+])
+
+
+def make_events(track, tick, kind, channel=0, data1=0, data2=0) -> np.ndarray:
+    """
+    Build an event array from columns, broadcasting scalars.
+    :return: np.ndarray with EVENT_DTYPE
+    """
+    columns = np.broadcast_arrays(np.asarray(track), np.asarray(tick), np.asarray(kind), np.asarray(channel),
+                                  np.asarray(data1), np.asarray(data2))
+    events = np.zeros(columns[0].shape, dtype=EVENT_DTYPE).ravel()
+    for name, column in zip(('track', 'tick', 'kind', 'channel', 'data1', 'data2'), columns):
+        events[name] = column.ravel()
+    events['order'] = np.arange(len(events))
+    return events
+
+
+def sort_events(events: np.ndarray) -> np.ndarray:
+    """
+    Sort events by track, tick, kind and insertion order.
+    :param events: np.ndarray with EVENT_DTYPE
+    :return: np.ndarray
+    """
+    return events[np.lexsort((events['order'], events['kind'], events['tick'], events['track']))]
+
+
+def table_events(table, ticks_per_quarter: int = TICKS_PER_QUARTER, start_measure: int = None,
+                 end_measure: int = None, carry: bool = True) -> np.ndarray:
+    """
+    Build the MIDI events of a NoteTable: conductor events from the measure table and one
+    note on / note off pair per row. With a measure range, only that range is exported
+    and it is shifted to start at tick 0. Notes shorter than a tick last one tick.
+    :param table: NoteTable
+    :param ticks_per_quarter: MIDI resolution
+    :param start_measure: optional first measure number
+    :param end_measure: optional last measure number
+    :param carry: bool, repeat the time signature, key and tempo in force at the start of
+        the range (see carry_context)
+    :return: np.ndarray with EVENT_DTYPE
+    """
+    data = table.data
+    measures = table.measures
+    if start_measure is not None or end_measure is not None:
+        low = start_measure if start_measure is not None else np.iinfo(np.int32).min
+        high = end_measure if end_measure is not None else np.iinfo(np.int32).max
+        data = data[(data['measure'] >= low) & (data['measure'] <= high)]
+        # carry the context in force at the first exported measure
+        before = measures[measures['number'] < low]
+        measures = measures[(measures['number'] >= low) & (measures['number'] <= high)]
+        if carry:
+            measures = carry_context(before, measures)
+    # ticks are rounded on the absolute time, so a range gets the ticks of the whole score
+    origin = np.round(measures['offset'].min() * ticks_per_quarter) if len(measures) else 0.0
+
+    chunks = []
+    conductor = measures[measures['part'] == (measures['part'].min() if len(measures) else 0)]
+    ticks = (np.round(conductor['offset'] * ticks_per_quarter) - origin).astype(np.int64)
+    has_tempo = conductor['tempo'] > 0
+    chunks.append(make_events(0, ticks[has_tempo], TEMPO,
+                              data2=np.round(60_000_000 / conductor['tempo'][has_tempo]).astype(np.int64)))
+    has_meter = conductor['numerator'] > 0
+    chunks.append(make_events(0, ticks[has_meter], TIME_SIGNATURE, data1=conductor['numerator'][has_meter],
+                              data2=conductor['denominator'][has_meter]))
+    has_key = conductor['has_key']
+    chunks.append(make_events(0, ticks[has_key], KEY_SIGNATURE, data1=conductor['sharps'][has_key]))
+
+    track = data['part'].astype(np.int64) + 1
+    channel = np.minimum(data['part'], 15)
+    on = (np.round(data['onset'] * ticks_per_quarter) - origin).astype(np.int64)
+    # a note lasts at least one tick: at the same tick its note off would be written
+    # before its note on (see the event kinds) and the note would never be released
+    off = np.maximum((np.round((data['onset'] + data['duration']) * ticks_per_quarter) - origin).astype(np.int64),
+                     on + 1)
+    chunks.append(make_events(track, on, NOTE_ON, channel, data['pitch'], np.clip(data['velocity'], 1, 127)))
+    chunks.append(make_events(track, off, NOTE_OFF, channel, data['pitch'], 0))
+    for part in np.unique(measures['part']):
+        chunks.append(make_events(int(part) + 1, 0, PROGRAM, min(int(part), 15), 0))
+    return sort_events(np.concatenate(chunks))
+
+
+def carry_context(before: np.ndarray, measures: np.ndarray) -> np.ndarray:
+    """
+    Copy the last time signature, key and tempo seen before a measure range onto the first
+    measure of the range when that measure does not set them itself.
+    :param before: measure table rows preceding the range
+    :param measures: measure table rows of the range
+    :return: np.ndarray, copy of measures
+    """
+    measures = measures.copy()
+    for part in np.unique(measures['part']):
+        rows = np.nonzero(measures['part'] == part)[0]
+        if len(rows) == 0:
+            continue
+        first = rows[0]
+        earlier = before[before['part'] == part]
+        for flag, fields in (('numerator', ('numerator', 'denominator')), ('has_key', ('sharps', 'has_key')),
+                             ('tempo', ('tempo',))):
+            if measures[first][flag]:
+                continue
+            set_before = earlier[earlier[flag] > 0] if flag != 'has_key' else earlier[earlier[flag]]
+            if len(set_before):
+                for field in fields:
+                    measures[field][first] = set_before[field][-1]
+    return measures
+
+
+def _variable_length(value: int) -> bytes:
+    out = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        out.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(out)
+
+
+def encode_message(kind: int, channel: int, data1: int, data2: int) -> bytes:
+    """
+    Encode one event as MIDI bytes, status byte first (a meta event for the conductor kinds).
+    :param kind: event kind, e.g. NOTE_ON
+    :param channel: 0-based MIDI channel
+    :param data1: see the event kinds
+    :param data2: see the event kinds
+    :return: bytes
+    """
+    if kind == NOTE_ON:
+        return bytes((0x90 | channel, data1, data2))
+    if kind == NOTE_OFF:
+        return bytes((0x80 | channel, data1, 0))
+    if kind == CONTROL:
+        return bytes((0xB0 | channel, data1, data2))
+    if kind == PROGRAM:
+        return bytes((0xC0 | channel, data1))
+    if kind == TEMPO:
+        return b'\xff\x51\x03' + data2.to_bytes(3, 'big')
+    if kind == TIME_SIGNATURE:
+        return b'\xff\x58\x04' + bytes((data1, data2.bit_length() - 1, 24, 8))
+    if kind == KEY_SIGNATURE:
+        return b'\xff\x59\x02' + struct.pack('>bB', data1, 0)
+    raise ValueError(f"Unknown event kind {kind}.")
+
+
+def write_midi(events: np.ndarray, fp, ticks_per_quarter: int = TICKS_PER_QUARTER):
+    """
+    Write an event list as a format 1 Standard MIDI File, one track chunk at a time.
+    :param events: np.ndarray with EVENT_DTYPE
+    :param fp: file name or binary file object (e.g. io.BytesIO)
+    :param ticks_per_quarter: MIDI resolution
+    """
+    if isinstance(fp, (str, bytes)) or hasattr(fp, '__fspath__'):
+        with open(fp, 'wb') as f:
+            return write_midi(events, f, ticks_per_quarter)
+    events = sort_events(events)
+    tracks = np.unique(np.r_[0, events['track']])
+    fp.write(b'MThd' + struct.pack('>IHHH', 6, 1, len(tracks), ticks_per_quarter))
+    bounds = np.searchsorted(events['track'], tracks, side='left')
+    ends = np.searchsorted(events['track'], tracks, side='right')
+    for start, end in zip(bounds, ends):
+        chunk = bytearray()
+        previous = 0
+        for _, tick, kind, _, channel, data1, data2 in events[start:end].tolist():
+            chunk += _variable_length(tick - previous)
+            chunk += encode_message(kind, channel, data1, data2)
+            previous = tick
+        chunk += b'\x00\xff\x2f\x00'  # end of track
+        fp.write(b'MTrk' + struct.pack('>I', len(chunk)))
+        fp.write(chunk)
+
+
+def midi_bytes(events: np.ndarray, ticks_per_quarter: int = TICKS_PER_QUARTER) -> bytes:
+    """
+    Serialize an event list to the bytes of a MIDI file.
+    :param events: np.ndarray with EVENT_DTYPE
+    :param ticks_per_quarter: MIDI resolution
+    :return: bytes
+    """
+    buffer = io.BytesIO()
+    write_midi(events, buffer, ticks_per_quarter)
+    return buffer.getvalue()
+
+
+def write_stream(s, fp, start_measure: int = None, end_measure: int = None, index=None,
+                 ticks_per_quarter: int = TICKS_PER_QUARTER):
+    """
+    Write a parsed score, or a measure range of it, straight to MIDI without going
+    through music21's ``write('midi')``.
+    :param s: music21 Score or Part
+    :param fp: file name or binary file object
+    :param start_measure: optional first measure number
+    :param end_measure: optional last measure number
+    :param index: optional MeasureIndex of s
+    :param ticks_per_quarter: MIDI resolution
+    """
+    from .controllers import ControllerTrack, stored_controller_track
+    from .notetable import NoteTable
+
+    table = NoteTable.from_stream(s, index, start_measure, end_measure)
+    events = table_events(table, ticks_per_quarter, start_measure, end_measure)
+    controllers = stored_controller_track(s)
+    if controllers is not None and len(table.measures):
+        # merge the pedal and other controller events of the exported range
+        origin = table.measures['offset'].min()
+        end = (table.measures['offset'] + table.measures['length']).max() if end_measure is not None else np.inf
+        window = ControllerTrack(controllers.between(origin, end))
+        events = np.concatenate([events, window.midi_events(ticks_per_quarter, origin)])
+    write_midi(events, fp, ticks_per_quarter)
+
+
+# Notes read back from a MIDI file, in seconds, sorted by onset
+PERFORMED_DTYPE = np.dtype([
+    ('onset', 'f8'),
+    ('offset', 'f8'),
+    ('pitch', 'i2'),
+    ('velocity', 'i2'),
+    ('track', 'i2'),
+    ('channel', 'u1'),
+])
+
+
+def _read_variable_length(data: bytes, position: int) -> tuple:
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, position
+
+
+# Controller events read back from a MIDI file, in seconds, sorted by time
+PERFORMED_CONTROL_DTYPE = np.dtype([
+    ('time', 'f8'),
+    ('track', 'i2'),
+    ('channel', 'u1'),
+    ('control', 'u1'),
+    ('value', 'u1'),
+])
+
+
+def _read_track(data: bytes, track: int, notes: list, tempos: list, controls: list = None):
+    """
+    Collect the notes (track, channel, pitch, velocity, on tick, off tick), tempo changes
+    (tick, microseconds per quarter) and, if a list is given, controller events (track,
+    channel, tick, control, value) of one track chunk.
+    """
+    position = 0
+    tick = 0
+    status = 0
+    sounding = {}
+    while position < len(data):
+        delta, position = _read_variable_length(data, position)
+        tick += delta
+        if data[position] & 0x80:
+            status = data[position]
+            position += 1
+        if status == 0xFF:
+            kind = data[position]
+            length, position = _read_variable_length(data, position + 1)
+            if kind == 0x51:
+                tempos.append((tick, int.from_bytes(data[position:position + 3], 'big')))
+            elif kind == 0x2F:
+                break
+            position += length
+            continue
+        if status in (0xF0, 0xF7):
+            length, position = _read_variable_length(data, position)
+            position += length
+            continue
+        kind = status & 0xF0
+        channel = status & 0x0F
+        if kind in (0xC0, 0xD0):
+            position += 1
+            continue
+        data1, data2 = data[position], data[position + 1]
+        position += 2
+        if kind == 0xB0 and controls is not None:
+            controls.append((track, channel, tick, data1, data2))
+        elif kind == 0x90 and data2 > 0:
+            sounding.setdefault((channel, data1), []).append((tick, data2))
+        elif kind in (0x80, 0x90):
+            started = sounding.get((channel, data1))
+            if started:
+                on, velocity = started.pop(0)
+                notes.append((track, channel, data1, velocity, on, tick))
+    # notes never released end with the track
+    for (channel, pitch), started in sounding.items():
+        for on, velocity in started:
+            notes.append((track, channel, pitch, velocity, on, tick))
+
+
+def ticks_to_seconds(ticks, tempos: list, ticks_per_quarter: int) -> np.ndarray:
+    """
+    Convert ticks to seconds through a tempo map.
+    :param ticks: array of ticks
+    :param tempos: list of (tick, microseconds per quarter), 120 bpm before the first one
+    :param ticks_per_quarter: MIDI resolution
+    :return: np.ndarray of seconds
+    """
+    tempos = sorted(tempos)
+    if not tempos or tempos[0][0] > 0:
+        tempos.insert(0, (0, 500_000))
+    change_ticks = np.array([tick for tick, _ in tempos], dtype=float)
+    rates = np.array([value for _, value in tempos], dtype=float) / 1e6 / ticks_per_quarter
+    change_seconds = np.concatenate([[0.0], np.cumsum(np.diff(change_ticks) * rates[:-1])])
+    ticks = np.asarray(ticks, dtype=float)
+    segment = np.searchsorted(change_ticks, ticks, side='right') - 1
+    return change_seconds[segment] + (ticks - change_ticks[segment]) * rates[segment]
+
+
+def _read_file(fp, controls: list = None) -> tuple:
+    """
+    Notes and tempo changes of every track of a Standard MIDI File, see _read_track.
+    :return: (notes, tempos, ticks per quarter)
+    """
+    if isinstance(fp, (str, bytes)) or hasattr(fp, '__fspath__'):
+        with open(fp, 'rb') as f:
+            return _read_file(f, controls)
+    data = fp.read()
+    if data[:4] != b'MThd':
+        raise ValueError("Not a Standard MIDI File.")
+    header_length, _, _, division = struct.unpack('>IHHH', data[4:14])
+    if division & 0x8000:
+        raise ValueError("SMPTE time division is not supported.")
+    position = 8 + header_length
+    notes = []
+    tempos = []
+    track = 0
+    while position + 8 <= len(data):
+        kind, length = data[position:position + 4], struct.unpack('>I', data[position + 4:position + 8])[0]
+        position += 8
+        if kind == b'MTrk':
+            _read_track(data[position:position + length], track, notes, tempos, controls)
+            track += 1
+        position += length
+    return notes, tempos, division
+
+
+def read_notes(fp) -> np.ndarray:
+    """
+    Read the notes of a Standard MIDI File, e.g. a recorded performance, without going
+    through music21's parser. Times are in seconds; a note on with velocity 0 is a note off.
+    :param fp: file name or binary file object
+    :return: np.ndarray with PERFORMED_DTYPE, sorted by onset and pitch
+    """
+    return read_performance(fp)[0]
+
+
+def read_performance(fp) -> tuple:
+    """
+    Read the notes and the controller events (pedals, ...) of a Standard MIDI File, see
+    read_notes.
+    :param fp: file name or binary file object
+    :return: (np.ndarray with PERFORMED_DTYPE, np.ndarray with PERFORMED_CONTROL_DTYPE,
+        ticks per quarter of the file)
+    """
+    controls = []
+    notes, tempos, division = _read_file(fp, controls)
+    columns = np.array(notes, dtype=np.int64).reshape(-1, 6)
+    performed = np.zeros(len(columns), dtype=PERFORMED_DTYPE)
+    performed['track'] = columns[:, 0]
+    performed['channel'] = columns[:, 1]
+    performed['pitch'] = columns[:, 2]
+    performed['velocity'] = columns[:, 3]
+    performed['onset'] = ticks_to_seconds(columns[:, 4], tempos, division)
+    performed['offset'] = ticks_to_seconds(columns[:, 5], tempos, division)
+    columns = np.array(controls, dtype=np.int64).reshape(-1, 5)
+    control = np.zeros(len(columns), dtype=PERFORMED_CONTROL_DTYPE)
+    control['track'] = columns[:, 0]
+    control['channel'] = columns[:, 1]
+    control['time'] = ticks_to_seconds(columns[:, 2], tempos, division)
+    control['control'] = columns[:, 3]
+    control['value'] = columns[:, 4]
+    return (performed[np.lexsort((performed['pitch'], performed['onset']))],
+            control[np.argsort(control['time'], kind='stable')], division)
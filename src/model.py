@@ -0,0 +1,281 @@
+"""
+Expressive model fitted on the recorded renditions.
+
+The model holds, for every measure of every part, the velocity arch (the ``min`` and
+``max`` of classical_dynamics_shape), the accent of the highest notes and the
+``accelerate_rate`` of accelerate_measure, plus the averaged beat timings of the
+performers. It is fitted once by least squares on the note alignments, saved as a small
+.npz file and then applied to a score in one batched pass.
+
+Usage: python -m src.model fit model.npz
+       python -m src.model render model.npz in.mid out.mid
+"""
+import argparse
+
+import numpy as np
+
+from . import notetable
+from .alignment import align_performers
+from .curves import arch_segment, arch_shape, compute_velocities
+from .index import MeasureIndex, measure_index
+from .notetable import NoteTable
+from .tempo import ANNOTATION_DIR, PERFORMERS, TempoMap, apply_tempo_map
+
+# One row per (part, measure)
+PARAMETER_DTYPE = np.dtype([
+    ('part', 'i2'),
+    ('measure', 'i4'),
+    ('velocity_min', 'f8'),
+    ('velocity_max', 'f8'),
+    ('accent_factor', 'f8'),
+    ('accelerate_rate', 'f8'),
+])
+
+ACCENT_RANGE = (0.5, 2.0)
+ACCELERATE_RANGE = (0.5, 2.0)
+
+
+class ExpressiveModel:
+    """
+    Per-measure transform parameters and a tempo map, see the module docstring.
+
+    :param parameters: structured array with PARAMETER_DTYPE
+    :param positions: beat positions of the tempo map, in quarter lengths
+    :param times: beat times of the tempo map, in seconds
+    """
+
+    def __init__(self, parameters: np.ndarray, positions=None, times=None):
+        self.parameters = parameters
+        self.positions = np.zeros(0) if positions is None else np.asarray(positions, dtype=float)
+        self.times = np.zeros(0) if times is None else np.asarray(times, dtype=float)
+
+    def save(self, filename: str):
+        """
+        Save the model as a compressed .npz file.
+        :param filename: str
+        """
+        np.savez_compressed(filename, parameters=self.parameters, positions=self.positions, times=self.times)
+
+    @classmethod
+    def load(cls, filename: str) -> 'ExpressiveModel':
+        """
+        Load a model saved by save.
+        :param filename: str
+        :return: ExpressiveModel
+        """
+        with np.load(filename) as f:
+            return cls(f['parameters'], f['positions'], f['times'])
+
+    def tempo_map(self):
+        """
+        :return: TempoMap, or None if the model has no timing
+        """
+        return TempoMap(self.positions, self.times) if len(self.positions) >= 2 else None
+
+    def curve(self) -> dict:
+        """
+        Velocity curve specification of the model, one arch segment per run of
+        consecutive measures of each part, see curves.compute_velocities.
+        :return: dict
+        """
+        segments = []
+        for part in np.unique(self.parameters['part']):
+            rows = self.parameters[self.parameters['part'] == part]
+            rows = rows[np.argsort(rows['measure'])]
+            breaks = np.nonzero(np.diff(rows['measure']) != 1)[0] + 1
+            for run in np.split(rows, breaks):
+                segments.append(arch_segment(int(run['measure'][0]), int(run['measure'][-1]),
+                                             np.round(run['velocity_min']).tolist(),
+                                             np.round(run['velocity_max']).tolist(), parts=[int(part)], jitter=0))
+        return {"segments": segments}
+
+
+def _group_regression(groups: np.ndarray, x: np.ndarray, y: np.ndarray, count: int) -> tuple:
+    """
+    Least squares fit of y = intercept + slope * x separately in every group, in one pass.
+    Groups with a single distinct x get slope 0.
+    :return: (intercept, slope, points), arrays of length count
+    """
+    points = np.bincount(groups, minlength=count).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = np.bincount(groups, weights=x, minlength=count) / points
+        mean_y = np.bincount(groups, weights=y, minlength=count) / points
+        dx = x - mean_x[groups]
+        covariance = np.bincount(groups, weights=dx * (y - mean_y[groups]), minlength=count)
+        variance = np.bincount(groups, weights=dx * dx, minlength=count)
+        slope = np.where(variance > 1e-12, covariance / np.where(variance > 1e-12, variance, 1), 0.0)
+    return mean_y - slope * mean_x, slope, points
+
+
+def fit(table: NoteTable, alignments, tempo_map: TempoMap = None) -> ExpressiveModel:
+    """
+    Fit the per-measure parameters on aligned performances of a score.
+
+    - velocity arch: velocity = min + (max - min) * shape, where shape is the position of
+      each note on the low - high - low arch of classical_dynamics_shape;
+    - accent: mean velocity of the highest pitch of the measure over the arch prediction;
+    - acceleration: log(performed / expected duration) = c - x * log(rate), where
+      x = (i + 1) / n is the position of the note in the measure as in accelerate_measure.
+
+    Every fit pools the matched notes of all the performances and is solved per measure
+    with closed-form least squares over grouped sums.
+    :param table: NoteTable of the score
+    :param alignments: iterable of alignment arrays of that table, see alignment.align
+    :param tempo_map: optional TempoMap stored with the model
+    :return: ExpressiveModel
+    """
+    data = table.data
+    alignments = list(alignments)
+    keys = data['part'].astype(np.int64) * (1 << 32) + data['measure']
+    unique_keys, group = np.unique(keys, return_inverse=True)
+    count = len(unique_keys)
+
+    first_rows = np.nonzero(data['component'] <= 0)[0]
+    element_shape = np.zeros(int(data['chord'].max()) + 1 if len(data) else 0)
+    element_shape[data['chord'][first_rows]] = arch_shape(data, first_rows)
+    shape = element_shape[data['chord']]
+
+    # pooled observations of all the performances
+    matched = np.concatenate([a['matched'] for a in alignments])
+    rows = np.concatenate([a['row'] for a in alignments])[matched]
+    velocity = np.concatenate([a['velocity'] for a in alignments])[matched].astype(float)
+    articulation = np.concatenate([a['articulation'] for a in alignments])[matched]
+
+    intercept, slope, _ = _group_regression(group[rows], shape[rows], velocity, count)
+    velocity_min = np.clip(np.nan_to_num(intercept, nan=64.0), 1, 127)
+    velocity_max = np.clip(np.nan_to_num(intercept + slope, nan=64.0), 1, 127)
+
+    highest = np.full(count, -1)
+    np.maximum.at(highest, group, data['pitch'])
+    top = data['pitch'][rows] == highest[group[rows]]
+    predicted = velocity_min[group[rows]] + (velocity_max - velocity_min)[group[rows]] * shape[rows]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.bincount(group[rows][top], weights=velocity[top], minlength=count) / \
+            np.bincount(group[rows][top], weights=predicted[top], minlength=count)
+    accent = np.clip(np.nan_to_num(ratio, nan=1.0), *ACCENT_RANGE)
+
+    # position of each element in its measure, as accelerate_measure counts them
+    chord = data['chord'].astype(np.int64)
+    first_chord = np.full(count, np.iinfo(np.int64).max)
+    np.minimum.at(first_chord, group, chord)
+    position = chord - first_chord[group]
+    last = np.zeros(count, dtype=np.int64)
+    np.maximum.at(last, group, position)
+    x = (position + 1) / (last[group] + 1)
+    usable = np.isfinite(articulation) & (articulation > 0)
+    _, log_slope, _ = _group_regression(group[rows][usable], x[rows][usable], np.log(articulation[usable]), count)
+    rate = np.clip(np.exp(-log_slope), *ACCELERATE_RANGE)
+
+    parameters = np.zeros(count, dtype=PARAMETER_DTYPE)
+    parameters['part'] = unique_keys >> 32
+    parameters['measure'] = unique_keys & 0xFFFFFFFF
+    parameters['velocity_min'] = velocity_min
+    parameters['velocity_max'] = velocity_max
+    parameters['accent_factor'] = accent
+    parameters['accelerate_rate'] = rate
+    if tempo_map is None:
+        return ExpressiveModel(parameters)
+    return ExpressiveModel(parameters, tempo_map.positions, tempo_map.times)
+
+
+def fit_performers(table: NoteTable, performers=PERFORMERS, directory: str = ANNOTATION_DIR) -> ExpressiveModel:
+    """
+    Align the recorded renditions to a score and fit a model on them, with their averaged
+    tempo map.
+    :param table: NoteTable of the score
+    :param performers: iterable of performer names, see tempo.PERFORMERS
+    :param directory: str
+    :return: ExpressiveModel
+    """
+    alignments = align_performers(table, performers, directory)
+    return fit(table, alignments.values(), TempoMap.mean_performance(directory, performers))
+
+
+def apply_model_to_table(table: NoteTable, model: ExpressiveModel) -> NoteTable:
+    """
+    Apply the velocities, accents and accelerations of a model to a note table, in one
+    batched pass per parameter. Measures missing from the model are left unchanged.
+    :param table: NoteTable, modified in place
+    :param model: ExpressiveModel
+    :return: table
+    """
+    data = table.data
+    parameters = model.parameters
+    data['velocity'] = compute_velocities(table, model.curve())
+
+    keys = parameters['part'].astype(np.int64) * (1 << 32) + parameters['measure']
+    order = np.argsort(keys)
+    row_keys = data['part'].astype(np.int64) * (1 << 32) + data['measure']
+    found = np.searchsorted(keys[order], row_keys)
+    found = np.minimum(found, len(keys) - 1)
+    known = keys[order][found] == row_keys
+    row_parameter = order[found]
+
+    # accent the highest pitch of every measure
+    group_keys, group = np.unique(row_keys, return_inverse=True)
+    highest = np.full(len(group_keys), -1)
+    np.maximum.at(highest, group, data['pitch'])
+    accent = known & (data['pitch'] == highest[group])
+    accented = data['velocity'][accent] * parameters['accent_factor'][row_parameter[accent]]
+    data['velocity'][accent] = np.clip(accented.astype(np.int64), 0, 127)
+
+    for part in np.unique(parameters['part']):
+        rows = parameters[parameters['part'] == part]
+        notetable.accelerate_measure(table, rows['measure'], rows['accelerate_rate'], track_numbers=(int(part),))
+    return table
+
+
+def apply_model(s, model: ExpressiveModel, index: MeasureIndex = None):
+    """
+    Apply a fitted model to a stream and write the changes back in bulk.
+    :param s: music21 stream
+    :param model: ExpressiveModel
+    :param index: optional measure index of s, built once if not given
+    :return: stream
+    """
+    table = NoteTable.from_stream(s, measure_index(s, index))
+    return apply_model_to_table(table, model).apply_to_stream()
+
+
+def render_model(s, model: ExpressiveModel, fp, index: MeasureIndex = None):
+    """
+    Write a rendition of a score by a model straight to MIDI, with the model's timing.
+    The stream itself is not modified.
+    :param s: music21 stream
+    :param model: ExpressiveModel
+    :param fp: file name or binary file object
+    :param index: optional measure index of s
+    """
+    table = apply_model_to_table(NoteTable.from_stream(s, measure_index(s, index)), model)
+    tempo_map = model.tempo_map()
+    if tempo_map is not None:
+        apply_tempo_map(table, tempo_map)
+    table.to_midi(fp)
+
+
+def main(argv=None):
+    from .utils import get_stream
+
+    parser = argparse.ArgumentParser(prog="python -m src.model", description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    fit_parser = commands.add_parser("fit", help="fit a model on the recorded renditions")
+    fit_parser.add_argument("model", help="output .npz file")
+    fit_parser.add_argument("--score", default=f"{ANNOTATION_DIR}/corrected_midi_score.mid",
+                            help="score the renditions are aligned to")
+    fit_parser.add_argument("--directory", default=ANNOTATION_DIR, help="directory of the renditions")
+    fit_parser.add_argument("--performers", nargs="+", default=list(PERFORMERS))
+    render_parser = commands.add_parser("render", help="render a score with a fitted model")
+    render_parser.add_argument("model", help=".npz file written by fit")
+    render_parser.add_argument("input", help="input MIDI file")
+    render_parser.add_argument("output", help="output MIDI file")
+    args = parser.parse_args(argv)
+
+    if args.command == "fit":
+        table = NoteTable.from_stream(get_stream(args.score))
+        fit_performers(table, args.performers, args.directory).save(args.model)
+    else:
+        render_model(get_stream(args.input), ExpressiveModel.load(args.model), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,580 @@
+"""
+Streaming MusicXML reader.
+
+music21's MusicXML parser builds the whole document tree, then the whole stream, before
+anything can be read. ``read_musicxml`` walks the file with ElementTree's iterparse, one
+``<measure>`` at a time (each one is dropped once read), straight into the arrays of a
+NoteTable, plus the notated markings: dynamics, hairpins, slurs, ornaments, articulations
+and pedal marks (see MARKING_DTYPE). No music21 object is built here; LazyMeasureIndex
+builds the music21 measures one by one, when a transform looks them up.
+
+As in music21, a part with several staves (a piano part) becomes one part per staff, the
+notes of a measure are listed voice by voice, grace notes have no duration and tied notes
+stay separate notes. Notated dynamics set the velocity of the following notes of their
+part: the ``<sound dynamics>`` value when there is one (a percentage of velocity 90, as in
+MusicXML), the velocity of the mark otherwise (curves.DYNAMIC_VELOCITIES). The built
+measures therefore carry no Dynamic objects, which music21 would apply a second time.
+"""
+import xml.etree.ElementTree as ET
+import zipfile
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from .curves import DYNAMIC_VELOCITIES
+from .index import MeasureIndex
+from .metric import beat_strength
+from .notetable import DEFAULT_VELOCITY, MEASURE_DTYPE, NOTE_DTYPE, NoteTable, _build_element, _build_measure
+from .tempo import beat_length
+
+if TYPE_CHECKING:
+    from music21 import stream
+
+MUSICXML_EXTENSIONS = (".musicxml", ".xml", ".mxl")
+
+# One row per notated marking. Spans (hairpins, slurs, pedal) end at ``end_*``; the other
+# markings end where they start. ``row`` is the note row a marking is attached to, -1 for
+# markings of the staff (dynamics, hairpins, pedal).
+MARKING_DTYPE = np.dtype([
+    ('part', 'i2'),
+    ('measure', 'i4'),
+    ('offset', 'f8'),
+    ('onset', 'f8'),
+    ('kind', 'U12'),  # dynamic, wedge, slur, ornament, articulation, pedal
+    ('name', 'U20'),  # e.g. "pp", "crescendo", "trill-mark", "accent"
+    ('value', 'f8'),  # velocity of a dynamic, number of a span
+    ('end_measure', 'i4'),
+    ('end_offset', 'f8'),
+    ('end_onset', 'f8'),
+    ('row', 'i4'),
+])
+
+# Voice and tie of every note row, next to NOTE_DTYPE
+NOTATION_DTYPE = np.dtype([
+    ('voice', 'i2'),
+    ('tie', 'U8'),  # start, stop, continue or empty
+])
+
+_STEPS = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+
+def _pitch(element) -> int:
+    octave = int(element.findtext("octave"))
+    alter = float(element.findtext("alter") or 0)
+    return (octave + 1) * 12 + _STEPS[element.findtext("step")] + int(round(alter))
+
+
+def _open(filename: str):
+    """
+    File object of the score of a .musicxml / .xml file or of a compressed .mxl archive.
+    """
+    if not str(filename).lower().endswith(".mxl"):
+        return open(filename, "rb")
+    archive = zipfile.ZipFile(filename)
+    container = ET.fromstring(archive.read("META-INF/container.xml"))
+    rootfile = next(e for e in container.iter() if e.tag.endswith("rootfile"))
+    return archive.open(rootfile.get("full-path"))
+
+
+class _PartReader:
+    """
+    State of one ``<part>`` while its measures are read.
+    """
+
+    def __init__(self, reader: 'MusicXMLScore', base: int):
+        self.reader = reader
+        self.base = base  # part index of the first staff
+        self.staves = 1
+        self.divisions = 1.0
+        self.offset = 0.0  # of the current measure, quarter lengths
+        self.spans = {}  # (kind, number) -> marking row index
+
+    def measure(self, element, number: int):
+        reader = self.reader
+        cursor = 0.0
+        furthest = 0.0
+        last_start = 0.0
+        contexts = {}  # staff -> dict of numerator, denominator, sharps, tempo
+        for child in element:
+            tag = child.tag
+            if tag == "attributes":
+                self._attributes(child, contexts)
+            elif tag == "direction":
+                staff = int(child.findtext("staff") or 1)
+                position = cursor + float(child.findtext("offset") or 0) / self.divisions
+                self._direction(child, number, staff, position, contexts)
+            elif tag == "note":
+                duration = float(child.findtext("duration") or 0) / self.divisions
+                grace = child.find("grace") is not None
+                if child.find("chord") is not None:
+                    start = last_start
+                else:
+                    start = last_start = cursor
+                    if not grace:
+                        cursor += duration
+                furthest = max(furthest, cursor)
+                if child.find("rest") is not None:
+                    continue
+                self._note(child, number, start, 0.0 if grace else duration, grace)
+            elif tag == "backup":
+                cursor -= float(child.findtext("duration")) / self.divisions
+            elif tag == "forward":
+                cursor += float(child.findtext("duration")) / self.divisions
+                furthest = max(furthest, cursor)
+        length = furthest
+        for staff in range(1, self.staves + 1):
+            context = contexts.get(staff, {})
+            reader._measure_rows.append((self.base + staff - 1, number, self.offset, length,
+                                         context.get("numerator", 0), context.get("denominator", 0),
+                                         context.get("sharps", 0), "sharps" in context, context.get("tempo", 0.0)))
+        self.offset += length
+
+    def _attributes(self, element, contexts: dict):
+        divisions = element.findtext("divisions")
+        if divisions:
+            self.divisions = float(divisions)
+        staves = element.findtext("staves")
+        if staves:
+            self.staves = int(staves)
+            self.reader._staves(self.base, self.staves)
+        for key in element.findall("key"):
+            staves = [int(key.get("number"))] if key.get("number") else range(1, self.staves + 1)
+            for staff in staves:
+                contexts.setdefault(staff, {})["sharps"] = int(key.findtext("fifths") or 0)
+        for time_signature in element.findall("time"):
+            staves = [int(time_signature.get("number"))] if time_signature.get("number") else \
+                range(1, self.staves + 1)
+            for staff in staves:
+                contexts.setdefault(staff, {}).update(numerator=int(time_signature.findtext("beats")),
+                                                      denominator=int(time_signature.findtext("beat-type")))
+
+    def _direction(self, element, number: int, staff: int, position: float, contexts: dict):
+        reader = self.reader
+        part = self.base + staff - 1
+        sound = element.find("sound")
+        for direction_type in element.findall("direction-type"):
+            for child in direction_type:
+                if child.tag == "dynamics":
+                    for mark in child:
+                        velocity = DYNAMIC_VELOCITIES.get(mark.tag, DEFAULT_VELOCITY)
+                        if sound is not None and sound.get("dynamics"):
+                            velocity = float(sound.get("dynamics")) * 0.9
+                        reader._dynamics.append((self.base, self.offset + position, velocity))
+                        reader._mark(part, number, position, self.offset, "dynamic", mark.tag, velocity)
+                elif child.tag in ("wedge", "pedal"):
+                    self._span(child.tag, child.get("type"), child.get("number", "1"), part, number, position,
+                               child.get("type") if child.tag == "wedge" else "pedal", -1)
+        if sound is not None and sound.get("tempo"):
+            contexts.setdefault(staff, {})["tempo"] = float(sound.get("tempo"))
+        if sound is not None and sound.get("dynamics") and element.find("direction-type/dynamics") is None:
+            reader._dynamics.append((self.base, self.offset + position, float(sound.get("dynamics")) * 0.9))
+
+    def _span(self, kind: str, span_type: str, span_number: str, part: int, number: int, position: float,
+              name: str, row: int):
+        reader = self.reader
+        key = (kind, span_number)
+        if span_type in ("start", "crescendo", "diminuendo"):
+            self.spans[key] = len(reader._markings)
+            reader._mark(part, number, position, self.offset, "wedge" if kind == "wedge" else kind, name,
+                         float(span_number), row)
+        elif span_type in ("stop", "change") and key in self.spans:
+            start = self.spans.pop(key)
+            reader._markings[start][7:10] = [number, position, self.offset + position]
+            if span_type == "change":
+                self.spans[key] = len(reader._markings)
+                reader._mark(part, number, position, self.offset, kind, name, float(span_number), row)
+
+    def _note(self, element, number: int, start: float, duration: float, grace: bool):
+        reader = self.reader
+        staff = int(element.findtext("staff") or 1)
+        part = self.base + staff - 1
+        row = len(reader._rows)
+        chord = element.find("chord") is not None
+        ties = [tie.get("type") for tie in element.findall("tie")]
+        tie = "continue" if len(ties) > 1 else (ties[0] if ties else "")
+        reader._rows.append([part, number, start, self.offset + start, duration,
+                             _pitch(element.find("pitch")) if element.find("pitch") is not None else
+                             _pitch_unpitched(element), int(element.findtext("voice") or 1), tie, chord, grace])
+        notations = element.find("notations")
+        if notations is None:
+            return
+        for child in notations:
+            if child.tag == "slur":
+                self._span("slur", child.get("type"), child.get("number", "1"), part, number, start, "slur", row)
+            elif child.tag == "ornaments":
+                for ornament in child:
+                    if ornament.tag != "accidental-mark":
+                        reader._mark(part, number, start, self.offset, "ornament", ornament.tag, 0.0, row)
+            elif child.tag == "articulations":
+                for articulation in child:
+                    reader._mark(part, number, start, self.offset, "articulation", articulation.tag, 0.0, row)
+            elif child.tag == "fermata":
+                reader._mark(part, number, start, self.offset, "articulation", "fermata", 0.0, row)
+
+
+def _pitch_unpitched(element) -> int:
+    unpitched = element.find("unpitched")
+    if unpitched is None:
+        return 60
+    return (int(unpitched.findtext("display-octave")) + 1) * 12 + _STEPS[unpitched.findtext("display-step")]
+
+
+class MusicXMLScore:
+    """
+    Notes, measures and markings of a MusicXML score, see the module docstring.
+
+    ``data`` has NOTE_DTYPE and ``measures`` MEASURE_DTYPE, as in a NoteTable, the beat
+    strengths aside (see ``table``);
+    ``notation`` (NOTATION_DTYPE) holds the voice and tie of every row of ``data`` and
+    ``markings`` has MARKING_DTYPE.
+
+    :param fp: file name (.musicxml, .xml or compressed .mxl) or binary file object
+    """
+
+    def __init__(self, fp):
+        self._rows = []
+        self._measure_rows = []
+        self._markings = []
+        self._dynamics = []  # (first part of the xml part, onset, velocity)
+        self._parts = {}  # xml part id -> _PartReader
+        self._part_count = 0
+        close = False
+        if isinstance(fp, (str, bytes)) or hasattr(fp, '__fspath__'):
+            fp, close = _open(fp), True
+        try:
+            self._read(fp)
+        finally:
+            if close:
+                fp.close()
+        self._finish()
+
+    def _staves(self, base: int, staves: int):
+        self._part_count = max(self._part_count, base + staves)
+
+    def _mark(self, part, number, position, measure_offset, kind, name, value, row=-1):
+        self._markings.append([part, number, position, measure_offset + position, kind, name, value,
+                               number, position, measure_offset + position, row])
+
+    def _read(self, fp):
+        reader = None
+        previous_number = {}
+        depth = 0
+        for event, element in ET.iterparse(fp, events=("start", "end")):
+            tag = element.tag
+            if event == "start":
+                depth += 1
+                if tag == "part" and depth == 2:
+                    part_id = element.get("id")
+                    if part_id not in self._parts:
+                        self._parts[part_id] = _PartReader(self, self._part_count)
+                        self._part_count += 1
+                    reader = self._parts[part_id]
+                elif tag == "score-timewise":
+                    raise ValueError("Timewise MusicXML is not supported, convert it to partwise.")
+                continue
+            depth -= 1
+            if tag == "measure" and reader is not None:
+                text = element.get("number", "")
+                number = int(text) if text.lstrip("-").isdigit() else previous_number.get(reader, 0) + 1
+                previous_number[reader] = number
+                reader.measure(element, number)
+                element.clear()
+            elif tag == "part" and depth == 1:
+                element.clear()
+
+    def _finish(self):
+        rows = self._rows
+        count = len(rows)
+        part = np.array([r[0] for r in rows], dtype=np.int64)
+        number = np.array([r[1] for r in rows], dtype=np.int64)
+        offset = np.array([r[2] for r in rows], dtype=float)
+        voice = np.array([r[6] for r in rows], dtype=np.int64)
+        grace = np.array([r[9] for r in rows], dtype=bool)
+        # chord ids: a note without <chord/> starts a new one
+        chord = np.cumsum([not r[8] for r in rows]) - 1 if count else np.zeros(0, dtype=np.int64)
+        # voices in order of appearance in each measure, then onsets, grace notes first
+        first_seen = {}
+        voice_rank = np.array([first_seen.setdefault((p, n, v), len(first_seen))
+                               for p, n, v in zip(part.tolist(), number.tolist(), voice.tolist())], dtype=np.int64)
+        order = np.lexsort((np.arange(count), ~grace, offset, voice_rank, number, part))
+        data = np.zeros(count, dtype=NOTE_DTYPE)
+        data['part'] = part
+        data['measure'] = number
+        data['offset'] = offset
+        data['onset'] = [r[3] for r in rows]
+        data['duration'] = [r[4] for r in rows]
+        data['pitch'] = [r[5] for r in rows]
+        data['chord'] = chord
+        sizes = np.bincount(chord) if count else np.zeros(0, dtype=np.int64)
+        starts = np.r_[0, np.cumsum(sizes)[:-1]] if count else sizes
+        data['component'] = np.where(sizes[chord] > 1, np.arange(count) - starts[chord], -1)
+        data['velocity'] = self._velocities(part, data['onset'])
+        notation = np.zeros(count, dtype=NOTATION_DTYPE)
+        notation['voice'] = voice
+        notation['tie'] = [r[7] for r in rows]
+
+        # renumber the chords in row order, so chord ids index the elements of the table
+        data, notation = data[order], notation[order]
+        _, first_rows = np.unique(data['chord'], return_index=True)
+        renumber = np.empty(len(first_rows), dtype=np.int64)
+        renumber[np.argsort(first_rows)] = np.arange(len(first_rows))
+        data['chord'] = renumber[data['chord']] if count else data['chord']
+        position = np.empty(count, dtype=np.int64)
+        position[order] = np.arange(count)
+
+        markings = np.array([tuple(m) for m in self._markings], dtype=MARKING_DTYPE)
+        attached = markings['row'] >= 0
+        markings['row'][attached] = position[markings['row'][attached]]
+        measures = np.array(self._measure_rows, dtype=MEASURE_DTYPE)
+        measures = measures[np.lexsort((measures['number'], measures['part']))]
+        self._fill_beats(data, measures)
+        self.data, self.notation, self.markings, self.measures = data, notation, markings, measures
+        del self._rows, self._measure_rows, self._markings, self._dynamics
+
+    def _velocities(self, part: np.ndarray, onset: np.ndarray) -> np.ndarray:
+        """
+        Velocity of every note: the last dynamic of its xml part at or before its onset.
+        """
+        velocities = np.full(len(part), DEFAULT_VELOCITY, dtype=float)
+        for reader in self._parts.values():
+            marks = sorted((o, v) for base, o, v in self._dynamics if base == reader.base)
+            rows = (part >= reader.base) & (part < reader.base + reader.staves)
+            if not marks or not rows.any():
+                continue
+            times = np.array([o for o, _ in marks])
+            values = np.array([v for _, v in marks])
+            position = np.searchsorted(times, onset[rows] + 1e-9, side='right') - 1
+            velocities[rows] = np.where(position >= 0, values[np.maximum(position, 0)], DEFAULT_VELOCITY)
+        return np.clip(np.round(velocities), 1, 127).astype(np.int16)
+
+    @staticmethod
+    def _signatures(measures: np.ndarray) -> dict:
+        """
+        Time signature (numerator, denominator) in force in every measure, (0, 0) before
+        the first one.
+        """
+        signatures = {}
+        for part in np.unique(measures['part']):
+            current = (0, 0)
+            for row in measures[measures['part'] == part]:
+                if row['numerator']:
+                    current = (int(row['numerator']), int(row['denominator']))
+                signatures[(int(part), int(row['number']))] = current
+        return signatures
+
+    @classmethod
+    def _fill_beats(cls, data: np.ndarray, measures: np.ndarray):
+        for (part, number), (numerator, denominator) in cls._signatures(measures).items():
+            rows = (data['part'] == part) & (data['measure'] == number)
+            length = beat_length(numerator, denominator) if numerator else 1.0
+            data['beat'][rows] = 1.0 + data['offset'][rows] / length
+
+    def table(self) -> NoteTable:
+        """
+        NoteTable of the score, not tied to a stream. The beat strengths, left at 0 in
+        ``data``, are filled in here as they need music21's meters.
+        :return: NoteTable
+        """
+        from music21 import meter
+
+        data = self.data.copy()
+        signatures = {}
+        strengths = {}
+        for (part, number), signature in self._signatures(self.measures).items():
+            rows = np.nonzero((data['part'] == part) & (data['measure'] == number))[0]
+            if not len(rows) or not signature[0]:
+                continue
+            if signature not in signatures:
+                signatures[signature] = meter.TimeSignature("%d/%d" % signature)
+            data['strength'][rows] = [beat_strength(signatures[signature], offset, strengths)
+                                      for offset in data['offset'][rows].tolist()]
+        return NoteTable(data, self.measures.copy())
+
+    def index(self) -> 'LazyMeasureIndex':
+        """
+        Measure index building the music21 measures on demand, see LazyMeasureIndex.
+        :return: LazyMeasureIndex
+        """
+        return LazyMeasureIndex(self)
+
+
+def read_musicxml(fp) -> MusicXMLScore:
+    """
+    Read a MusicXML score, see the module docstring.
+    :param fp: file name (.musicxml, .xml or compressed .mxl) or binary file object
+    :return: MusicXMLScore
+    """
+    return MusicXMLScore(fp)
+
+
+def is_musicxml(filename) -> bool:
+    return str(filename).lower().endswith(MUSICXML_EXTENSIONS)
+
+
+class LazyMeasureIndex(MeasureIndex):
+    """
+    MeasureIndex of a MusicXMLScore whose music21 measures are built on their first
+    lookup. ``stream`` is a Score holding one empty Part per part at first; each built
+    measure is inserted into its part, so the changes made through the index stay in the
+    stream. ``materialize`` builds the measures never looked up, e.g. before writing the
+    stream. ``markings`` are the notated markings of the score, see MARKING_DTYPE, and
+    ``element(row)`` the note or chord built for a row of ``score.data``.
+
+    :param score: MusicXMLScore
+    """
+
+    def __init__(self, score: MusicXMLScore):
+        from music21 import stream
+
+        self.score = score
+        self.markings = score.markings
+        parts = [stream.Part() for _ in range(int(score.measures['part'].max()) + 1 if len(score.measures) else 0)]
+        s = stream.Score()
+        for part in parts:
+            s.insert(0, part)
+        self._measure_rows = {(int(row['part']), int(row['number'])): row for row in score.measures}
+        data = score.data
+        keys = data['part'].astype(np.int64) * (1 << 32) + data['measure']
+        order = np.argsort(keys, kind='stable')
+        bounds = np.searchsorted(keys[order], sorted(set(keys.tolist())))
+        self._rows = {}
+        for low, high in zip(bounds, np.r_[bounds[1:], len(order)]):
+            rows = order[low:high]
+            self._rows[(int(data['part'][rows[0]]), int(data['measure'][rows[0]]))] = rows
+        self._elements = {}
+        self._built = {}
+        super().__init__(s)
+
+    def rebuild(self):
+        """
+        Forget the cached note lists; the measures built so far are kept.
+        """
+        self.parts = list(self.stream.parts)
+        self._measures = self._built
+        self._notes = {}
+        self._top_lines = {}
+        self._metric = None
+        self._contexts = {}
+
+    def get(self, number: int, part: int = 0):
+        self.lookups += 1
+        return self.peek(number, part)
+
+    def _time_signature(self, number: int, part: int):
+        return self._measure_context(number, part)[0]
+
+    def _measure_context(self, number: int, part: int) -> tuple:
+        # from the measure table, so resolving a context builds no measure
+        from music21 import key, meter, tempo
+
+        row = self._measure_rows[(part, number)]
+        return (meter.TimeSignature(f"{row['numerator']}/{row['denominator']}") if row['numerator'] else None,
+                key.KeySignature(int(row['sharps'])) if row['has_key'] else None,
+                tempo.MetronomeMark(number=float(row['tempo'])) if row['tempo'] else None)
+
+    def peek(self, number: int, part: int = 0):
+        m = self._built.get((part, number))
+        if m is None and (part, number) in self._measure_rows:
+            m = self._build(part, number)
+        return m
+
+    def stack(self, number: int) -> list:
+        self.lookups += 1
+        measures = [self.peek(number, part) for part in range(len(self.parts))]
+        return [m for m in measures if m is not None]
+
+    def numbers(self, part: int = 0) -> list:
+        return sorted(number for p, number in self._measure_rows if p == part)
+
+    def element(self, row: int):
+        """
+        Note or chord built for a row of the score's data, building its measure if needed.
+        :param row: int
+        :return: music21 Note or Chord
+        """
+        data = self.score.data
+        self.peek(int(data['measure'][row]), int(data['part'][row]))
+        return self._elements[int(data['chord'][row])]
+
+    def _build(self, part: int, number: int):
+        from music21 import articulations, common, expressions, note, stream, tie
+
+        row = self._measure_rows[(part, number)]
+        m = _build_measure(row)
+        rows = self._rows.get((part, number), np.zeros(0, dtype=np.int64))
+        data = self.score.data[rows]
+        notation = self.score.notation[rows]
+        voices = list(dict.fromkeys(notation['voice'].tolist()))
+        containers = {voice: m for voice in voices}
+        if len(voices) > 1:
+            for voice in voices:
+                containers[voice] = stream.Voice(id=str(voice))
+                m.insert(0, containers[voice])
+        chord_ids, starts = np.unique(data['chord'], return_index=True)
+        for chord_id, start in sorted(zip(chord_ids.tolist(), starts.tolist()), key=lambda pair: pair[1]):
+            members = np.nonzero(data['chord'] == chord_id)[0]
+            element = _build_element(data[members])
+            components = element.notes if element.isChord else [element]
+            for component, member in zip(components, members[np.argsort(data['component'][members])]):
+                if notation['tie'][member]:
+                    component.tie = tie.Tie(str(notation['tie'][member]))
+            containers[int(notation['voice'][start])].insert(common.opFrac(float(data['offset'][start])), element)
+            self._elements[chord_id] = element
+        for marking in self.markings[(self.markings['part'] == part) & (self.markings['measure'] == number) &
+                                     (self.markings['row'] >= 0)]:
+            element = self._elements[int(self.score.data['chord'][marking['row']])]
+            name = str(marking['name'])
+            if marking['kind'] == "ornament" and name in _ORNAMENTS:
+                element.expressions.append(getattr(expressions, _ORNAMENTS[name])())
+            elif marking['kind'] == "articulation" and name == "fermata":
+                element.expressions.append(expressions.Fermata())
+            elif marking['kind'] == "articulation" and name in _ARTICULATIONS:
+                element.articulations.append(getattr(articulations, _ARTICULATIONS[name])())
+        end = float((data['offset'] + data['duration']).max()) if len(data) else 0.0
+        if row['length'] - end > 1e-6:
+            # the rests are not in the table, only the length of the measure is kept
+            m.insert(common.opFrac(end), note.Rest(quarterLength=common.opFrac(float(row['length']) - end)))
+        self.parts[part].insert(common.opFrac(float(row['offset'])), m)
+        self._built[(part, number)] = m
+        return m
+
+    def materialize(self) -> 'stream.Score':
+        """
+        Build every measure not built yet.
+        :return: music21.stream.Score, the index's stream
+        """
+        for part, number in self._measure_rows:
+            self.peek(number, part)
+        return self.stream
+
+
+# music21 classes of the MusicXML ornaments and articulations
+_ORNAMENTS = {"trill-mark": "Trill", "mordent": "Mordent", "inverted-mordent": "InvertedMordent",
+              "turn": "Turn", "inverted-turn": "InvertedTurn", "tremolo": "Tremolo"}
+_ARTICULATIONS = {"accent": "Accent", "strong-accent": "StrongAccent", "staccato": "Staccato",
+                  "staccatissimo": "Staccatissimo", "tenuto": "Tenuto", "detached-legato": "DetachedLegato",
+                  "spiccato": "Spiccato"}
+
+
+def notated(index: MeasureIndex, kind: str = None, start_measure: int = None, end_measure: int = None,
+            parts=None) -> np.ndarray:
+    """
+    Notated markings of the score of an index, empty for a score read from MIDI.
+    :param index: MeasureIndex
+    :param kind: optional kind, e.g. "ornament" or "wedge"
+    :param start_measure: optional first measure number
+    :param end_measure: optional last measure number
+    :param parts: optional iterable of part indices
+    :return: np.ndarray with MARKING_DTYPE
+    """
+    markings = getattr(index, "markings", np.zeros(0, dtype=MARKING_DTYPE))
+    mask = np.ones(len(markings), dtype=bool)
+    if kind is not None:
+        mask &= markings['kind'] == kind
+    if start_measure is not None:
+        mask &= markings['measure'] >= start_measure
+    if end_measure is not None:
+        mask &= markings['measure'] <= end_measure
+    if parts is not None:
+        mask &= np.isin(markings['part'], list(parts))
+    return markings[mask]
@@ -0,0 +1,372 @@
+import bisect
+import os
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from . import midi_io
+from .index import MeasureIndex, measure_index
+from .metric import beat_strength, on_beats
+
+if TYPE_CHECKING:
+    from music21 import stream
+
+# One row per sounding pitch. Rows of a chord share the same ``chord`` id, which indexes
+# NoteTable.elements, and carry their position inside the chord in ``component``
+# (-1 for a plain note).
+NOTE_DTYPE = np.dtype([
+    ('part', 'i2'),
+    ('measure', 'i4'),
+    ('offset', 'f8'),  # quarter lengths from the start of the measure
+    ('onset', 'f8'),  # quarter lengths from the start of the part
+    ('beat', 'f8'),  # 1-based, in beats of the time signature in force
+    ('strength', 'f8'),  # beat strength, as music21's beatStrength
+    ('duration', 'f8'),
+    ('pitch', 'i2'),
+    ('velocity', 'i2'),
+    ('chord', 'i4'),
+    ('component', 'i2'),
+])
+
+# One row per measure of every part, with the context needed to rebuild a stream.
+MEASURE_DTYPE = np.dtype([
+    ('part', 'i2'),
+    ('number', 'i4'),
+    ('offset', 'f8'),
+    ('length', 'f8'),
+    ('numerator', 'i2'),  # 0 if the measure carries no time signature
+    ('denominator', 'i2'),
+    ('sharps', 'i2'),
+    ('has_key', '?'),
+    ('tempo', 'f8'),  # quarter notes per minute, 0 if the measure carries no metronome mark
+])
+
+DEFAULT_VELOCITY = 64
+
+
+class NoteTable:
+    """
+    Compact array view of the notes of a score.
+
+    ``data`` is a NumPy structured array (see NOTE_DTYPE) built once from a stream; edits
+    are column operations on it. ``apply_to_stream`` writes changed rows back into the
+    music21 objects the table was built from, ``to_stream`` builds a fresh Score and
+    ``to_midi`` writes a MIDI file without going through a stream at all.
+
+    :param data: structured array with NOTE_DTYPE
+    :param measures: structured array with MEASURE_DTYPE
+    :param elements: music21 Note or Chord owning each chord id, or None for a table
+        not built from a stream
+    :param source: the stream the table was built from, if any
+    """
+
+    def __init__(self, data: np.ndarray, measures: np.ndarray, elements: list = None,
+                 source: 'stream.Stream' = None):
+        self.data = data
+        self.measures = measures
+        self.elements = elements
+        self.source = source
+        # only tables built from a stream write changes back, the others skip the copy
+        self._snapshot = data.copy() if source is not None else None
+
+    def __len__(self):
+        return len(self.data)
+
+    @classmethod
+    def from_stream(cls, s: 'stream.Stream', index: MeasureIndex = None, start_measure: int = None,
+                    end_measure: int = None) -> 'NoteTable':
+        """
+        Build a note table from a music21 stream.
+        :param s: music21 Score or Part
+        :param index: optional measure index of s, built once if not given
+        :param start_measure: optional first measure number to include
+        :param end_measure: optional last measure number to include
+        :return: NoteTable
+        """
+        index = measure_index(s, index)
+        rows = []
+        measure_rows = []
+        skipped_rows = []
+        elements = []
+        strengths = {}
+        for part_index in range(len(index.parts)):
+            numbers = index.numbers(part_index)
+            time_signature = None
+            if start_measure is not None:
+                numbers = numbers[bisect.bisect_left(numbers, start_measure):]
+                # the context in force before the range, resolved once per index
+                time_signature, key_signature, mark = index.context(start_measure - 1, part_index)
+                skipped_rows.append(_context_row(part_index, start_measure - 1, 0.0, 0.0,
+                                                 time_signature, key_signature, mark))
+            if end_measure is not None:
+                numbers = numbers[:bisect.bisect_right(numbers, end_measure)]
+            for number in numbers:
+                m = index.get(number, part_index)
+                if m.timeSignature is not None:
+                    time_signature = m.timeSignature
+                measure_rows.append(_measure_row(part_index, m))
+                beat_length = time_signature.beatDuration.quarterLength if time_signature is not None else 1.0
+                for n in index.notes(number, part_index, ordered=False):
+                    offset = float(n.getOffsetInHierarchy(m))
+                    onset = float(m.offset) + offset
+                    beat = 1.0 + offset / beat_length
+                    strength = beat_strength(time_signature, offset, strengths)
+                    length = float(n.duration.quarterLength)
+                    chord_id = len(elements)
+                    elements.append(n)
+                    if n.isChord:
+                        for component_index, component in enumerate(n.notes):
+                            rows.append((part_index, number, offset, onset, beat, strength, length, component.pitch.midi,
+                                         _velocity(component, n), chord_id, component_index))
+                    else:
+                        rows.append((part_index, number, offset, onset, beat, strength, length, n.pitch.midi,
+                                     _velocity(n), chord_id, -1))
+        data = np.array(rows, dtype=NOTE_DTYPE)
+        measures = np.array(measure_rows, dtype=MEASURE_DTYPE)
+        if skipped_rows:
+            # keep the time signature, key and tempo in force at the first measure
+            measures = midi_io.carry_context(np.array(skipped_rows, dtype=MEASURE_DTYPE), measures)
+        return cls(data, measures, elements, s)
+
+    def save(self, prefix: str):
+        """
+        Write the note and measure arrays to ``<prefix>.notes.npy`` and
+        ``<prefix>.measures.npy``. The music21 elements are not saved.
+        :param prefix: str, path without extension
+        """
+        for suffix, array in ((".notes.npy", self.data), (".measures.npy", self.measures)):
+            tmp = prefix + suffix + ".tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, np.ascontiguousarray(array), allow_pickle=False)
+            os.replace(tmp, prefix + suffix)
+
+    @classmethod
+    def load(cls, prefix: str, mmap_mode: str = 'r') -> 'NoteTable':
+        """
+        Load a table written by save, memory-mapped by default so only the rows used are read.
+        :param prefix: str, path without extension
+        :param mmap_mode: passed to np.load, None to read the arrays into memory
+        :return: NoteTable not tied to a stream
+        """
+        return cls(np.load(prefix + ".notes.npy", mmap_mode=mmap_mode, allow_pickle=False),
+                   np.load(prefix + ".measures.npy", mmap_mode=mmap_mode, allow_pickle=False))
+
+    def select(self, start_measure: int, end_measure: int, parts=None) -> np.ndarray:
+        """
+        Boolean mask of the rows in a measure range.
+        :param start_measure: first measure number (inclusive)
+        :param end_measure: last measure number (inclusive)
+        :param parts: iterable of part indices, or None for every part
+        :return: np.ndarray of bool
+        """
+        mask = (self.data['measure'] >= start_measure) & (self.data['measure'] <= end_measure)
+        if parts is not None:
+            mask &= np.isin(self.data['part'], list(parts))
+        return mask
+
+    def apply_to_stream(self) -> 'stream.Stream':
+        """
+        Write the rows changed since the table was built (or last applied) back into the
+        source stream.
+        :return: music21.stream.Stream, the source stream
+        """
+        if self.source is None:
+            raise ValueError("This note table was not built from a stream; use to_stream instead.")
+        from music21 import common
+
+        changed = np.nonzero(self.data != self._snapshot)[0]
+        for row in self.data[changed]:
+            element = self.elements[row['chord']]
+            target = element.notes[row['component']] if row['component'] >= 0 else element
+            target.volume.velocity = int(row['velocity'])
+            if target.pitch.midi != row['pitch']:
+                target.pitch.midi = int(row['pitch'])
+            if float(element.duration.quarterLength) != row['duration']:
+                element.duration.quarterLength = common.opFrac(float(row['duration']))
+        self._snapshot = self.data.copy()
+        return self.source
+
+    def to_stream(self) -> 'stream.Score':
+        """
+        Build a new Score holding the measures and notes of the table, the voices of a
+        measure merged into one.
+        :return: music21.stream.Score
+        """
+        from music21 import common, note, stream
+
+        score = stream.Score()
+        for part_index in np.unique(self.measures['part']):
+            part = stream.Part()
+            part_rows = self.data[self.data['part'] == part_index]
+            for measure_row in self.measures[self.measures['part'] == part_index]:
+                m = _build_measure(measure_row)
+                rows = part_rows[part_rows['measure'] == measure_row['number']]
+                _, starts = np.unique(rows['chord'], return_index=True)
+                for group in np.split(rows, np.sort(starts)[1:]) if len(rows) else []:
+                    m.insert(common.opFrac(float(group['offset'][0])), _build_element(group))
+                end = float((rows['offset'] + rows['duration']).max()) if len(rows) else 0.0
+                if measure_row['length'] - end > 1e-6:
+                    # the rests are not in the table, only the length of the measure is kept
+                    rest = note.Rest(quarterLength=common.opFrac(float(measure_row['length']) - end))
+                    m.insert(common.opFrac(end), rest)
+                part.insert(common.opFrac(float(measure_row['offset'])), m)
+            score.insert(0, part)
+        return score
+
+    def to_midi(self, fp, ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER):
+        """
+        Write the table to a MIDI file, one track per part, without building a stream.
+        :param fp: file name or binary file object
+        :param ticks_per_quarter: MIDI resolution
+        """
+        midi_io.write_midi(midi_io.table_events(self, ticks_per_quarter), fp, ticks_per_quarter)
+
+
+def _velocity(n, owner=None) -> int:
+    velocity = n.volume.velocity
+    if velocity is None and owner is not None:
+        velocity = owner.volume.velocity
+    return DEFAULT_VELOCITY if velocity is None else int(velocity)
+
+
+def _measure_row(part_index, m):
+    from music21 import tempo
+
+    marks = m.getElementsByClass(tempo.MetronomeMark)
+    return _context_row(part_index, m.number, float(m.offset), float(m.quarterLength), m.timeSignature,
+                        m.keySignature, marks[0] if marks else None)
+
+
+def _context_row(part_index, number, offset, length, ts, ks, mark):
+    qpm = mark.getQuarterBPM() if mark is not None else 0.0
+    return (part_index, number, offset, length,
+            ts.numerator if ts is not None else 0, ts.denominator if ts is not None else 0,
+            ks.sharps if ks is not None else 0, ks is not None, qpm or 0.0)
+
+
+def _build_measure(measure_row):
+    from music21 import key, meter, stream, tempo
+
+    m = stream.Measure(number=int(measure_row['number']))
+    if measure_row['numerator']:
+        m.timeSignature = meter.TimeSignature(f"{measure_row['numerator']}/{measure_row['denominator']}")
+    if measure_row['has_key']:
+        m.keySignature = key.KeySignature(int(measure_row['sharps']))
+    if measure_row['tempo']:
+        m.insert(0, tempo.MetronomeMark(number=float(measure_row['tempo'])))
+    return m
+
+
+def _build_element(group):
+    from music21 import chord, common, note
+
+    length = common.opFrac(float(group['duration'][0]))
+    if group['component'][0] < 0:
+        element = note.Note(int(group['pitch'][0]))
+        element.volume.velocity = int(group['velocity'][0])
+    else:
+        components = []
+        for row in group[np.argsort(group['component'])]:
+            component = note.Note(int(row['pitch']))
+            component.volume.velocity = int(row['velocity'])
+            components.append(component)
+        element = chord.Chord(components)
+    if length == 0:
+        # zero-length notes come out of the MIDI parser as grace notes
+        return element.getGrace()
+    element.duration.quarterLength = length
+    return element
+
+
+def change_velocity_measures(table: NoteTable, start_measure: int, end_measure: int,
+                             velocity_factor: float) -> NoteTable:
+    """
+    Vectorized counterpart of dynamics.change_velocity_measures_in_stream.
+    :param table: NoteTable
+    :param start_measure: int
+    :param end_measure: int
+    :param velocity_factor: float
+    :return: NoteTable
+    """
+    mask = table.select(start_measure, end_measure)
+    velocities = (table.data['velocity'][mask] * velocity_factor).astype(np.int64)
+    table.data['velocity'][mask] = np.clip(velocities, 0, 127)
+    return table
+
+
+def change_duration_specific_beats(table: NoteTable, start_measure: int, end_measure: int, target_beats: list,
+                                   duration_factor: float) -> NoteTable:
+    """
+    Vectorized counterpart of timings.change_duration_specific_beats_in_stream.
+    :param table: NoteTable
+    :param start_measure: int
+    :param end_measure: int
+    :param target_beats: list of beats, e.g. [1, 3]
+    :param duration_factor: float
+    :return: NoteTable
+    """
+    mask = table.select(start_measure, end_measure) & on_beats(table.data['beat'], target_beats)
+    table.data['duration'][mask] *= duration_factor
+    return table
+
+
+def change_duration_in_measures(table: NoteTable, start_measure: int, end_measure: int, target_duration: float,
+                                new_duration: float, track_number: int = 0, tolerance: float = 0.05) -> NoteTable:
+    """
+    Vectorized counterpart of timings.change_duration_in_measure over a measure range.
+    :param table: NoteTable
+    :param start_measure: int
+    :param end_measure: int
+    :param target_duration: float, duration of the notes to change
+    :param new_duration: float
+    :param track_number: int, part index (0-indexed)
+    :param tolerance: float, relative tolerance of the duration match, as in
+        timings.change_duration_in_measure
+    :return: NoteTable
+    """
+    mask = table.select(start_measure, end_measure, [track_number])
+    mask &= np.isclose(table.data['duration'], target_duration, rtol=tolerance)
+    table.data['duration'][mask] = new_duration
+    return table
+
+
+def accelerate_measure(table: NoteTable, measure_number, accelerate_rate, track_numbers=(0, 1)) -> NoteTable:
+    """
+    Vectorized counterpart of timings.accelerate_measure.
+
+    ``measure_number`` and ``accelerate_rate`` may be sequences of the same length to
+    accelerate several measures in one call. Each note or chord gets the duration
+    ``base / accelerate_rate ** ((i + 1) / n)``, where ``base`` is the duration of the first
+    element of its measure, ``i`` its position and ``n`` the element count.
+    :param table: NoteTable
+    :param measure_number: int or sequence of int
+    :param accelerate_rate: float or sequence of float
+    :param track_numbers: part indices to process
+    :return: NoteTable
+    """
+    measure_numbers = np.atleast_1d(measure_number)
+    rates = np.broadcast_to(np.asarray(accelerate_rate, dtype=float), measure_numbers.shape)
+    data = table.data
+    mask = np.isin(data['measure'], measure_numbers) & np.isin(data['part'], list(track_numbers))
+    rows = np.nonzero(mask)[0]
+    if len(rows) == 0:
+        return table
+    # group rows by (part, measure); chord ids are consecutive inside a measure
+    group_keys = data['part'][rows].astype(np.int64) * (1 << 32) + data['measure'][rows]
+    _, groups = np.unique(group_keys, return_inverse=True)
+    chord_ids = data['chord'][rows]
+    first = np.full(groups.max() + 1, np.iinfo(np.int64).max)
+    np.minimum.at(first, groups, chord_ids)
+    position = chord_ids - first[groups]
+    last = np.zeros_like(first)
+    np.maximum.at(last, groups, position)
+    count = last + 1
+    base = np.zeros(len(first))
+    base[groups[position == 0]] = data['duration'][rows][position == 0]
+    order = np.argsort(measure_numbers)
+    rate = rates[order][np.searchsorted(measure_numbers[order], data['measure'][rows])]
+    factor = rate ** ((position + 1) / count[groups])
+    durations = base[groups] / factor
+    durations[position == 0] = data['duration'][rows][position == 0]
+    data['duration'][rows] = durations
+    return table
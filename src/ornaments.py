@@ -0,0 +1,278 @@
+"""
+Ornaments: trills, mordents, turns and grace-note groups.
+
+Each ornament is played from an event template: the offsets, durations, pitch steps (in
+semitones from the ornamented note) and velocity scales of its notes. Templates are built
+once per kind, speed, duration and interval and reused. An ornament list is applied in
+one pass, either to a stream (the new notes of each measure or voice go in with a single
+bulk insert) or to a NoteTable (the rows are spliced into the arrays).
+
+An ornament is a dict::
+
+    {"kind": "trill", "part": 0, "measure": 43, "note_index": -2, "semitones": 1,
+     "speed": 0.25, "duration": 1}
+
+``note_index`` counts the notes and chords of the measure in offset order. On a chord,
+the highest note is ornamented and the other notes are held. ``duration`` defaults to the
+length of the note; when the note is longer than the ornament, its last note is held to
+the end of the note. The ornament notes keep the velocity of the note, shaped by the
+template.
+"""
+import functools
+
+import numpy as np
+
+from .index import MeasureIndex, measure_index
+from .instrument import instrumented
+from .musicxml import notated
+from .notetable import DEFAULT_VELOCITY, NoteTable
+from .tempo import beat_length
+
+KINDS = ("trill", "mordent", "turn", "grace")
+
+TEMPLATE_DTYPE = np.dtype([
+    ('offset', 'f8'),  # quarter lengths from the start of the ornamented note
+    ('duration', 'f8'),
+    ('step', 'i2'),  # semitones from the ornamented note
+    ('velocity', 'f8'),  # scale of the ornamented note's velocity
+])
+
+# velocity scales of the notes of each kind, the trill repeating its pair
+VELOCITY_SHAPES = {
+    "trill": (0.9, 0.8),
+    "mordent": (1.0, 0.8, 0.9),
+    "turn": (0.9, 0.8, 0.8, 1.0),
+    "grace": (0.7, 1.0),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def ornament_template(kind: str, speed: float, duration: float, semitones: int = 1, count: int = 1) -> np.ndarray:
+    """
+    Event template of an ornament, built once for every set of arguments.
+    :param kind: one of KINDS
+    :param speed: length of each ornament note, in quarter lengths
+    :param duration: total length of the ornament, in quarter lengths
+    :param semitones: interval to the upper (and, for a turn, lower) neighbour; the grace
+        notes step down to the note by this interval
+    :param count: number of grace notes
+    :return: read-only np.ndarray with TEMPLATE_DTYPE
+    """
+    if kind == "trill":
+        number = max(int(duration / speed), 1)
+        steps = [semitones * (i % 2) for i in range(number)]
+        velocities = [1.0] + [VELOCITY_SHAPES[kind][i % 2] for i in range(1, number)]
+    elif kind == "mordent":
+        steps = [0, semitones, 0]
+        velocities = VELOCITY_SHAPES[kind]
+    elif kind == "turn":
+        steps = [semitones, 0, -semitones, 0]
+        velocities = VELOCITY_SHAPES[kind]
+    elif kind == "grace":
+        steps = [semitones * (count - i) for i in range(count)] + [0]
+        velocities = [VELOCITY_SHAPES[kind][0]] * count + [VELOCITY_SHAPES[kind][1]]
+    else:
+        raise ValueError(f"Unknown ornament {kind!r}, expected one of {KINDS}.")
+    template = np.zeros(len(steps), dtype=TEMPLATE_DTYPE)
+    template['offset'] = np.arange(len(steps)) * speed
+    template['duration'] = speed
+    # the last note takes what is left of the ornament
+    template['duration'][-1] = max(duration - template['offset'][-1], speed)
+    template['step'] = steps
+    template['velocity'] = velocities
+    template.flags.writeable = False
+    return template
+
+
+def _template(ornament: dict, length: float) -> np.ndarray:
+    """
+    Template of an ornament on a note of the given length, the last ornament note held to
+    the end of the note.
+    """
+    speed = float(ornament.get("speed", 0.125))
+    duration = float(ornament.get("duration") or length)
+    template = ornament_template(ornament["kind"], speed, duration, int(ornament.get("semitones", 1)),
+                                 int(ornament.get("count", 1)))
+    end = template['offset'][-1] + template['duration'][-1]
+    if end < length:
+        template = template.copy()
+        template['duration'][-1] += length - end
+    return template
+
+
+def _velocities(template: np.ndarray, velocity) -> np.ndarray:
+    velocity = DEFAULT_VELOCITY if velocity is None else velocity
+    return np.clip(np.round(template['velocity'] * velocity), 1, 127).astype(int)
+
+
+@instrumented()
+def apply_ornaments(s, ornaments: list, index: MeasureIndex = None):
+    """
+    Apply a list of ornaments to a stream, see the module docstring. The new notes of every
+    measure or voice are inserted at once.
+    :param s: music21 stream
+    :param ornaments: list of ornament dicts
+    :param index: optional measure index of s, built once if not given
+    :return: stream
+    """
+    from music21 import common, note
+
+    index = measure_index(s, index)
+    inserts = {}  # id(container) -> (container, [offset, note, offset, note, ...])
+    touched = set()
+    for ornament in ornaments:
+        part, number = int(ornament.get("part", 0)), int(ornament["measure"])
+        elements = index.notes(number, part)
+        note_index = int(ornament.get("note_index", 0))
+        if not -len(elements) <= note_index < len(elements):
+            continue
+        element = elements[note_index]
+        # the measure or voice holding the note, and the note's offset in it
+        m = index.get(number, part)
+        container = next(c for c in [m] + list(m.recurse().getElementsByClass('Voice'))
+                         if any(e is element for e in c.elements))
+        offset = container.elementOffset(element)
+        target = max(element.notes, key=lambda n: n.pitch.midi) if element.isChord else element
+        template = _template(ornament, float(element.duration.quarterLength))
+        velocities = _velocities(template, target.volume.velocity)
+        midi = target.pitch.midi
+        new_notes = []
+        first = 0
+        if element.isChord and len(element.notes) > 1:
+            # the other notes of the chord are held, the top note becomes the ornament
+            element.remove(target)
+        else:
+            if template['step'][0]:
+                element.pitch.midi = midi + int(template['step'][0])
+            element.duration.quarterLength = common.opFrac(float(template['duration'][0]))
+            element.volume.velocity = int(velocities[0])
+            first = 1
+        for event, velocity in zip(template[first:], velocities[first:]):
+            n = note.Note(midi + int(event['step']), quarterLength=common.opFrac(float(event['duration'])))
+            n.volume.velocity = int(velocity)
+            new_notes += [common.opFrac(float(offset + event['offset'])), n]
+        inserts.setdefault(id(container), (container, []))[1].extend(new_notes)
+        touched.add((number, part))
+    for container, items in inserts.values():
+        if items:
+            container.insert(items)
+    for number, part in touched:
+        index.invalidate(number, part)
+    return s
+
+
+# MusicXML ornament -> (kind, direction of the neighbour note)
+NOTATED_ORNAMENTS = {
+    "trill-mark": ("trill", 1),
+    "inverted-mordent": ("mordent", 1),
+    "mordent": ("mordent", -1),
+    "turn": ("turn", 1),
+    "inverted-turn": ("turn", -1),
+}
+
+# pitch classes of the major scale
+_MAJOR = (0, 2, 4, 5, 7, 9, 11)
+
+
+def diatonic_step(pitch: int, sharps: int, direction: int = 1) -> int:
+    """
+    Semitones to the neighbour note of a pitch in a key, e.g. 1 from E and 2 from D in
+    C major. Pitches outside the key step to the nearest degree.
+    :param pitch: MIDI pitch
+    :param sharps: key signature, negative for flats
+    :param direction: 1 for the upper neighbour, -1 for the lower one
+    :return: int, signed
+    """
+    tonic = (7 * sharps) % 12
+    scale = {(tonic + degree) % 12 for degree in _MAJOR}
+    for step in range(1, 3):
+        if (pitch + direction * step) % 12 in scale:
+            return direction * step
+    return direction
+
+
+@instrumented()
+def apply_notated_ornaments(s, index: MeasureIndex = None, speed: float = 0.125):
+    """
+    Play the ornaments notated in a MusicXML score (see musicxml.LazyMeasureIndex): trills,
+    mordents and turns, with the neighbour note taken in the key. Notes shorter than two
+    ornament notes are left as written. Scores read from MIDI have no notated ornaments,
+    and are left unchanged.
+    :param s: music21 stream
+    :param index: optional measure index of s, built once if not given
+    :param speed: length of each ornament note, in quarter lengths
+    :return: stream
+    """
+    index = measure_index(s, index)
+    marks = notated(index, "ornament")
+    ornaments = []
+    for mark in marks[np.isin(marks['name'], list(NOTATED_ORNAMENTS))]:
+        part, number = int(mark['part']), int(mark['measure'])
+        element = index.element(int(mark['row']))
+        if element.duration.quarterLength < 2 * speed:
+            # too short to ornament, usually the first note of a written-out trill
+            continue
+        elements = index.notes(number, part)
+        note_index = next(i for i, e in enumerate(elements) if e is element)
+        target = max(element.notes, key=lambda n: n.pitch.midi) if element.isChord else element
+        kind, direction = NOTATED_ORNAMENTS[str(mark['name'])]
+        measures = index.score.measures
+        keys = measures[(measures['part'] == part) & (measures['number'] <= number) & measures['has_key']]
+        sharps = int(keys['sharps'][np.argmax(keys['number'])]) if len(keys) else 0
+        ornaments.append({"kind": kind, "part": part, "measure": number, "note_index": note_index, "speed": speed,
+                          "semitones": diatonic_step(target.pitch.midi, sharps, direction)})
+    return apply_ornaments(s, ornaments, index=index)
+
+
+def _beat_length(measures: np.ndarray, part: int, number: int) -> float:
+    """
+    Beat length of the time signature in force at a measure, like music21's beatDuration.
+    """
+    rows = measures[(measures['part'] == part) & (measures['number'] <= number) & (measures['numerator'] > 0)]
+    if not len(rows):
+        return 1.0
+    row = rows[np.argmax(rows['number'])]
+    return beat_length(int(row['numerator']), int(row['denominator']))
+
+
+def ornament_table(table: NoteTable, ornaments: list) -> NoteTable:
+    """
+    Apply a list of ornaments to a note table, see the module docstring. The rows of the
+    ornamented notes are replaced by the template rows in one splice.
+    :param table: NoteTable
+    :param ornaments: list of ornament dicts
+    :return: NoteTable, new and not tied to a stream
+    """
+    data = table.data
+    removed = np.zeros(len(data), dtype=bool)
+    blocks = []
+    next_chord = int(data['chord'].max()) + 1 if len(data) else 0
+    for ornament in ornaments:
+        part, number = int(ornament.get("part", 0)), int(ornament["measure"])
+        rows = np.nonzero((data['part'] == part) & (data['measure'] == number))[0]
+        # chord ids of the measure in offset order
+        chords, first_rows = np.unique(data['chord'][rows], return_index=True)
+        chords = chords[np.lexsort((chords, data['offset'][rows][first_rows]))]
+        note_index = int(ornament.get("note_index", 0))
+        if not -len(chords) <= note_index < len(chords):
+            continue
+        members = rows[data['chord'][rows] == chords[note_index]]
+        target = data[members[np.argmax(data['pitch'][members])]]
+        template = _template(ornament, float(target['duration']))
+        block = np.repeat(target[np.newaxis], len(template))
+        block['offset'] = target['offset'] + template['offset']
+        block['onset'] = target['onset'] + template['offset']
+        block['beat'] = target['beat'] + template['offset'] / _beat_length(table.measures, part, number)
+        block['strength'][1:] = 0.0  # the ornament notes fall between the metric levels
+        block['duration'] = template['duration']
+        block['pitch'] = target['pitch'] + template['step']
+        block['velocity'] = _velocities(template, int(target['velocity']))
+        block['chord'] = np.arange(next_chord, next_chord + len(template))
+        block['component'] = -1
+        next_chord += len(template)
+        removed[members[np.argmax(data['pitch'][members])]] = True
+        blocks.append(block)
+    spliced = np.concatenate([data[~removed]] + blocks)
+    spliced = spliced[np.lexsort((spliced['component'], spliced['chord'], spliced['offset'], spliced['measure'],
+                                  spliced['part']))]
+    return NoteTable(spliced, table.measures.copy())
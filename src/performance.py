@@ -0,0 +1,267 @@
+"""
+Performance-time layer: performed time of the notes, kept apart from the score time.
+
+The timing transforms of src.timings edit ``duration.quarterLength`` in place, which
+leaves the following offsets where they were: measures overlap or leave gaps. Here the
+score grid of a NoteTable (onsets, durations and barlines in quarter lengths) is never
+edited. A PerformedTime holds a tempo curve (a TempoMap from score position to seconds)
+and, per note, an articulation (performed over written length) and an onset deviation.
+Rubato and accelerations warp the tempo curve, which moves every later note of every part
+together; legato and staccato edits change the articulation only. Every transform is a
+handful of array operations, and the MIDI ticks are computed from the layer in one pass.
+
+Usage: python -m src.render --performance-time plan.json in.mid out.mid
+"""
+import numpy as np
+
+from . import midi_io
+from .metric import on_beats
+from .notetable import NoteTable
+from .tempo import TempoMap, apply_tempo_map
+
+
+class PerformedTime:
+    """
+    Performed onsets and offsets of the notes of a NoteTable.
+
+    :param table: NoteTable, left untouched
+    :param tempo_map: TempoMap of the performance, a constant tempo (the score's first
+        metronome mark, or ``qpm``) if not given
+    :param qpm: tempo of the constant tempo map, in quarter notes per minute
+    """
+
+    def __init__(self, table: NoteTable, tempo_map: TempoMap = None, qpm: float = None):
+        self.table = table
+        if tempo_map is None:
+            tempos = table.measures['tempo'][table.measures['tempo'] > 0]
+            qpm = qpm or (float(tempos[0]) if len(tempos) else 60.0)
+            end = float((table.measures['offset'] + table.measures['length']).max()) if len(table.measures) else 1.0
+            tempo_map = TempoMap([0.0, max(end, 1.0)], [0.0, max(end, 1.0) * 60.0 / qpm])
+        self.tempo_map = tempo_map
+        self.articulation = np.ones(len(table))  # performed over written length
+        self.deviation = np.zeros(len(table))  # onset shift, seconds
+
+    def onsets(self) -> np.ndarray:
+        """
+        :return: performed onset of every row of the table, in seconds
+        """
+        return self.tempo_map.seconds(self.table.data['onset']) + self.deviation
+
+    def offsets(self) -> np.ndarray:
+        """
+        :return: performed release of every row of the table, in seconds
+        """
+        data = self.table.data
+        start = self.tempo_map.seconds(data['onset'])
+        written = self.tempo_map.seconds(data['onset'] + data['duration']) - start
+        return start + self.deviation + np.maximum(written * self.articulation, 0.0)
+
+    def warp(self, starts, ends, factors) -> 'PerformedTime':
+        """
+        Multiply the performed length of score spans by factors, moving everything after
+        each span by the time gained or lost. The spans must not overlap.
+        :param starts: score positions where the spans begin, in quarter lengths
+        :param ends: score positions where the spans end
+        :param factors: performed length factors (below 1 is faster)
+        :return: self
+        """
+        starts, ends, factors = (np.atleast_1d(np.asarray(a, dtype=float)) for a in (starts, ends, factors))
+        if not len(starts):
+            return self
+        knots = np.union1d(self.tempo_map.positions, np.concatenate([starts, ends]))
+        times = self.tempo_map.seconds(knots)
+        order = np.argsort(starts)
+        middles = (knots[:-1] + knots[1:]) / 2
+        span = np.searchsorted(starts[order], middles, side='right') - 1
+        inside = (span >= 0) & (middles < ends[order][np.maximum(span, 0)])
+        scale = np.where(inside, factors[order][np.maximum(span, 0)], 1.0)
+        times = times[0] + np.concatenate([[0.0], np.cumsum(np.diff(times) * scale)])
+        self.tempo_map = TempoMap(knots, times)
+        return self
+
+    def to_table(self, qpm: float = 60.0) -> NoteTable:
+        """
+        Copy of the table in performed time, see tempo.apply_tempo_map: onsets and
+        durations in quarter lengths at the single tempo ``qpm``.
+        :param qpm: reference tempo in quarter notes per minute
+        :return: NoteTable
+        """
+        scale = qpm / 60.0
+        table = apply_tempo_map(NoteTable(self.table.data.copy(), self.table.measures.copy()), self.tempo_map, qpm)
+        onsets = self.onsets()
+        table.data['onset'] = onsets * scale
+        table.data['duration'] = (self.offsets() - onsets) * scale
+        return table
+
+    def midi_events(self, controllers=None, qpm: float = 60.0,
+                    ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER) -> np.ndarray:
+        """
+        MIDI events of the performance, controller events moved through the tempo curve.
+        :param controllers: optional ControllerTrack in score time
+        :param qpm: reference tempo in quarter notes per minute
+        :param ticks_per_quarter: MIDI resolution
+        :return: np.ndarray with midi_io.EVENT_DTYPE
+        """
+        events = midi_io.table_events(self.to_table(qpm), ticks_per_quarter)
+        if controllers is not None and len(controllers):
+            from .controllers import ControllerTrack
+
+            moved = controllers.events.copy()
+            moved['time'] = self.tempo_map.seconds(moved['time']) * qpm / 60.0
+            events = np.concatenate([events, ControllerTrack(moved).midi_events(ticks_per_quarter)])
+        return events
+
+    def to_midi(self, fp, controllers=None, qpm: float = 60.0, ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER):
+        """
+        Write the performance to a MIDI file.
+        :param fp: file name or binary file object
+        :param controllers: optional ControllerTrack in score time
+        :param qpm: reference tempo in quarter notes per minute
+        :param ticks_per_quarter: MIDI resolution
+        """
+        midi_io.write_midi(self.midi_events(controllers, qpm, ticks_per_quarter), fp, ticks_per_quarter)
+
+
+def _element_onsets(data: np.ndarray, parts, number: int) -> np.ndarray:
+    """
+    Sorted distinct onsets of the notes and chords of a measure in some parts.
+    """
+    mask = (data['measure'] == number) & np.isin(data['part'], list(parts))
+    return np.unique(data['onset'][mask])
+
+
+def _measure_end(table: NoteTable, number: int) -> float:
+    rows = table.measures[table.measures['number'] == number]
+    return float((rows['offset'] + rows['length']).max()) if len(rows) else 0.0
+
+
+def _onset_spans(performance: PerformedTime, number: int, parts) -> tuple:
+    """
+    Spans between consecutive element onsets of a measure, the last one to the barline.
+    :return: (starts, ends)
+    """
+    onsets = _element_onsets(performance.table.data, parts, number)
+    if not len(onsets):
+        return onsets, onsets
+    ends = np.append(onsets[1:], max(_measure_end(performance.table, number), onsets[-1]))
+    keep = ends > onsets
+    return onsets[keep], ends[keep]
+
+
+def change_duration_specific_beats_in_stream(performance: PerformedTime, start_measure: int, end_measure: int,
+                                             target_beats: list, duration_factor: float) -> PerformedTime:
+    """
+    Performance-time counterpart of timings.change_duration_specific_beats_in_stream: the
+    notes on the target beats sound ``duration_factor`` times their written length.
+    :return: performance
+    """
+    on_beat = on_beats(performance.table.data['beat'], target_beats)
+    performance.articulation[performance.table.select(start_measure, end_measure) & on_beat] *= duration_factor
+    return performance
+
+
+def adjust_durations_for_specific_measure(performance: PerformedTime, measure_number, track1_new_durations=None) -> PerformedTime:
+    """
+    Performance-time counterpart of timings.adjust_durations_for_specific_measure: the
+    inter-onset intervals of the left hand (part 1) become ``track1_new_durations``, and
+    the right hand follows the same tempo curve. ``measure_number`` may be a sequence.
+    :return: performance
+    """
+    if track1_new_durations is None:
+        track1_new_durations = [0.75, 0.4, 0.3, 0.3, 1.25]
+    new = np.asarray(track1_new_durations, dtype=float)
+    all_starts, all_ends, all_factors = [], [], []
+    for number in np.atleast_1d(measure_number):
+        starts, ends = _onset_spans(performance, int(number), [1])
+        count = min(len(starts), len(new))
+        all_starts.append(starts[:count])
+        all_ends.append(ends[:count])
+        all_factors.append(new[:count] / (ends[:count] - starts[:count]))
+    return performance.warp(np.concatenate(all_starts), np.concatenate(all_ends), np.concatenate(all_factors))
+
+
+def execute_adjust_durations_for_specific_measure(performance: PerformedTime, start_measure_number,
+                                                  end_measure_number) -> PerformedTime:
+    return adjust_durations_for_specific_measure(performance, np.arange(start_measure_number, end_measure_number + 1))
+
+
+def change_duration_in_measure(performance: PerformedTime, measure_number, target_duration=0.5, new_duration=0.3,
+                               track_number=0, tolerance: float = 0.05) -> PerformedTime:
+    """
+    Performance-time counterpart of timings.change_duration_in_measure: the notes written
+    ``target_duration`` long sound ``new_duration`` long. The MIDI parser shortens the
+    written durations slightly, so they match within a relative ``tolerance``.
+    ``measure_number`` may be a sequence.
+    :return: performance
+    """
+    data = performance.table.data
+    mask = np.isin(data['measure'], np.atleast_1d(measure_number)) & (data['part'] == track_number)
+    mask &= np.isclose(data['duration'], target_duration, rtol=tolerance)
+    performance.articulation[mask] *= new_duration / target_duration
+    return performance
+
+
+def execute_change_duration_in_measure(performance: PerformedTime, start_measure_number, end_measure_number) -> PerformedTime:
+    return change_duration_in_measure(performance, np.arange(start_measure_number, end_measure_number + 1))
+
+
+def accelerate_measure(performance: PerformedTime, measure_number, accelerate_rate, track_numbers=(0, 1)) -> PerformedTime:
+    """
+    Performance-time counterpart of timings.accelerate_measure: the interval after the
+    i-th onset of the measure (over the given parts) is played ``accelerate_rate ** ((i + 1) / n)``
+    times faster, the first one unchanged, and the rest of the piece moves up by the time
+    gained. ``measure_number`` and ``accelerate_rate`` may be sequences of the same length.
+    :return: performance
+    """
+    numbers = np.atleast_1d(measure_number)
+    rates = np.broadcast_to(np.asarray(accelerate_rate, dtype=float), numbers.shape)
+    all_starts, all_ends, all_factors = [], [], []
+    for number, rate in zip(numbers, rates):
+        starts, ends = _onset_spans(performance, int(number), track_numbers)
+        position = np.arange(len(starts))
+        factors = np.where(position == 0, 1.0, rate ** (-(position + 1) / max(len(starts), 1)))
+        all_starts.append(starts)
+        all_ends.append(ends)
+        all_factors.append(factors)
+    return performance.warp(np.concatenate(all_starts), np.concatenate(all_ends), np.concatenate(all_factors))
+
+
+# plan transform -> counterpart on a PerformedTime
+TIMING_TRANSFORMS = {
+    "change_duration_specific_beats_in_stream": change_duration_specific_beats_in_stream,
+    "adjust_durations_for_specific_measure": adjust_durations_for_specific_measure,
+    "execute_adjust_durations_for_specific_measure": execute_adjust_durations_for_specific_measure,
+    "change_duration_in_measure": change_duration_in_measure,
+    "execute_change_duration_in_measure": execute_change_duration_in_measure,
+    "accelerate_measure": accelerate_measure,
+}
+
+
+def render_performed(my_stream, plan: dict, fp, index=None, rng=None, tempo_map: TempoMap = None,
+                     qpm: float = 60.0):
+    """
+    Render a plan with its timing steps on a performance-time layer: the other steps run on
+    the stream (see render.render), then the timing steps warp the layer built from the
+    resulting note table, and the MIDI file is written from the layer.
+    :param my_stream: music21 stream, modified in place by the non-timing steps
+    :param plan: dict, performance plan
+    :param fp: file name or binary file object
+    :param index: optional measure index of my_stream
+    :param rng: numpy.random.Generator or seed, see render.render
+    :param tempo_map: optional TempoMap to start from, see PerformedTime
+    :param qpm: reference tempo of the MIDI file
+    :return: PerformedTime
+    """
+    from .controllers import stored_controller_track
+    from .index import MeasureIndex
+    from .render import render, schedule
+
+    timing = [step for pass_name, steps in schedule(plan) if pass_name == "timing" for step in steps]
+    others = [step for pass_name, steps in schedule(plan) if pass_name != "timing" for step in steps]
+    index = index if index is not None and index.stream is my_stream else MeasureIndex(my_stream)
+    my_stream = render(my_stream, dict(plan, steps=others), index, rng=rng)
+    performance = PerformedTime(NoteTable.from_stream(my_stream, index), tempo_map)
+    for step in timing:
+        TIMING_TRANSFORMS[step["transform"]](performance, **step.get("args", {}))
+    performance.to_midi(fp, stored_controller_track(my_stream), qpm)
+    return performance
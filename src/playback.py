@@ -0,0 +1,422 @@
+"""
+Real-time playback of a performance plan.
+
+``play`` streams the MIDI messages of a plan rendered on a score to a sink while the
+later measures are still being rendered. The score is cut into chunks of measures; each
+chunk is rendered shortly before it is due (in a worker process, through the measure cache
+of src.incremental, so the measures rendered before are read back instead), and an
+asyncio scheduler sends every message at its time. The first chunk holds one measure, so
+playback starts after one short render, and the chunks then double up to
+``chunk_measures``. Rendering stays ``lookahead`` seconds ahead of the playhead; if it
+falls behind, playback waits for it and the stall is reported.
+
+A sink receives each message with its time in seconds from the start of the playback:
+
+- RecorderSink keeps them in memory, e.g. to check the timing of a plan;
+- SocketSink writes them to a TCP connection, one frame per message;
+- PortSink sends them to a MIDI output port (requires mido).
+
+The scheduler sleeps until each message is due and reports how late it woke up. Messages
+due within ``tolerance`` of each other are sent together.
+
+Usage: python -m src.playback plan.json input.mid [--port NAME | --connect HOST:PORT] [--seed N]
+"""
+import abc
+import argparse
+import asyncio
+import heapq
+import json
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import midi_io
+from .incremental import MeasureCache, load_source, measure_keys, render_measures
+
+DEFAULT_LOOKAHEAD = 4.0
+DEFAULT_CHUNK_MEASURES = 8
+DEFAULT_TOLERANCE = 0.001
+
+_ALL_NOTES_OFF = 123
+_SUSTAIN = 64
+
+
+class Sink(abc.ABC):
+    """
+    Destination of the messages. ``send`` gets the time of the message in seconds from the
+    start of the playback and the raw MIDI bytes (status byte first).
+    """
+
+    async def open(self):
+        pass
+
+    @abc.abstractmethod
+    async def send(self, seconds: float, message: bytes):
+        pass
+
+    async def close(self):
+        pass
+
+
+class RecorderSink(Sink):
+    """
+    Keeps every message with its due time and the time it was actually sent.
+    """
+
+    def __init__(self):
+        self.messages = []  # (due seconds, sent seconds, bytes)
+        self._start = None
+
+    async def send(self, seconds: float, message: bytes):
+        now = time.perf_counter()
+        if self._start is None:
+            self._start = now - seconds
+        self.messages.append((seconds, now - self._start, message))
+
+
+class SocketSink(Sink):
+    """
+    Writes each message to a TCP connection as a frame: due time in seconds (little-endian
+    double), message length (one byte), message bytes.
+    :param host: str
+    :param port: int
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._writer = None
+
+    async def open(self):
+        _, self._writer = await asyncio.open_connection(self.host, self.port)
+
+    async def send(self, seconds: float, message: bytes):
+        self._writer.write(struct.pack('<dB', seconds, len(message)) + message)
+        await self._writer.drain()
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+
+
+class PortSink(Sink):
+    """
+    Sends the messages to a MIDI output port, e.g. a synthesizer or a virtual port.
+    :param name: port name, the default port if None
+    :param virtual: open a virtual port other programs can connect to
+    """
+
+    def __init__(self, name: str = None, virtual: bool = False):
+        self.name = name
+        self.virtual = virtual
+        self._port = None
+
+    async def open(self):
+        try:
+            import mido
+        except ImportError as e:
+            raise ImportError("Playing to a MIDI port requires mido (pip install mido python-rtmidi).") from e
+        self._mido = mido
+        self._port = mido.open_output(self.name, virtual=self.virtual)
+
+    async def send(self, seconds: float, message: bytes):
+        self._port.send(self._mido.Message.from_bytes(message))
+
+    async def close(self):
+        if self._port is not None:
+            self._port.close()
+
+
+def chunk_source(filename: str, directory: str) -> dict:
+    """
+    Measures of an input file, see incremental.source_measures. Runs in the rendering process.
+    """
+    return load_source(filename, MeasureCache(directory))[0]
+
+
+def render_chunk(filename: str, plan: dict, numbers: list, directory: str,
+                 ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER) -> tuple:
+    """
+    Events of some measures, read from the measure cache or rendered. Runs in the rendering
+    process.
+    :param filename: input MIDI file
+    :param plan: dict, performance plan
+    :param numbers: sorted list of measure numbers
+    :param directory: folder of the MeasureCache
+    :param ticks_per_quarter: MIDI resolution
+    :return: (np.ndarray with midi_io.EVENT_DTYPE, ticks from the start of the piece, and the
+        number of measures that had to be rendered)
+    """
+    cache = MeasureCache(directory)
+    source, my_stream = load_source(filename, cache)
+    keys = dict(zip(source["numbers"], measure_keys(source, plan, ticks_per_quarter)))
+    blocks = {number: cache.get(keys[number]) for number in numbers}
+    missing = [number for number in numbers if blocks[number] is None]
+    if missing:
+        blocks.update(render_measures(filename, plan, missing, keys, cache, my_stream, ticks_per_quarter))
+    offsets = dict(zip(source["numbers"], source["offsets"]))
+    events = []
+    for number in numbers:
+        block = blocks[number].copy()
+        block['tick'] += int(round(offsets[number] * ticks_per_quarter))
+        events.append(block)
+    return np.concatenate(events), len(missing)
+
+
+def chunks(numbers: list, chunk_measures: int = DEFAULT_CHUNK_MEASURES) -> list:
+    """
+    Cut the measure numbers into chunks of 1, 2, 4, ... measures, up to chunk_measures.
+    :param numbers: list of measure numbers
+    :param chunk_measures: largest chunk
+    :return: list of lists
+    """
+    result = []
+    size = 1
+    position = 0
+    while position < len(numbers):
+        result.append(numbers[position:position + size])
+        position += size
+        size = min(size * 2, chunk_measures)
+    return result
+
+
+class Player:
+    """
+    Plays a plan on a score to a sink, see the module docstring.
+    :param filename: input MIDI file
+    :param plan: dict, performance plan
+    :param sink: Sink
+    :param lookahead: seconds of music rendered ahead of the playhead
+    :param chunk_measures: largest number of measures rendered at once
+    :param tolerance: messages due within this many seconds are sent together
+    :param speed: playback speed, 2 playing twice as fast
+    :param cache: MeasureCache, the default directory if not given
+    :param ticks_per_quarter: MIDI resolution of the rendered blocks
+    """
+
+    def __init__(self, filename: str, plan: dict, sink: Sink, lookahead: float = DEFAULT_LOOKAHEAD,
+                 chunk_measures: int = DEFAULT_CHUNK_MEASURES, tolerance: float = DEFAULT_TOLERANCE,
+                 speed: float = 1.0, cache: MeasureCache = None, ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER):
+        self.filename = filename
+        self.plan = plan
+        self.sink = sink
+        self.lookahead = lookahead
+        self.chunk_measures = chunk_measures
+        self.tolerance = tolerance
+        self.speed = speed
+        self.cache = cache if cache is not None else MeasureCache()
+        self.ticks_per_quarter = ticks_per_quarter
+        self._heap = []  # (tick, kind, sequence, channel, data1, data2)
+        self._sequence = 0
+        self._horizon = 0  # tick up to which every event is known
+        self._finished = False
+        self._rendered = None
+        self._tracks = set()
+        self._sounding = {}  # (channel, pitch) -> count
+        # tempo state: playback seconds at a tick, and seconds per tick from there
+        self._tick = 0
+        self._seconds = 0.0
+        self._rate = 500_000 / 1e6 / ticks_per_quarter / speed
+        self.stats = {"messages": 0, "late": [], "stalls": 0, "stalled_seconds": 0.0, "chunks": [],
+                      "first_message_seconds": None}
+
+    def _seconds_at(self, tick: int) -> float:
+        return self._seconds + (tick - self._tick) * self._rate
+
+    def _set_tempo(self, tick: int, microseconds: int):
+        self._seconds = self._seconds_at(tick)
+        self._tick = tick
+        self._rate = microseconds / 1e6 / self.ticks_per_quarter / self.speed
+
+    def _push(self, events: np.ndarray, start_tick: int):
+        """
+        Queue the events of a chunk, with a program change for every new track.
+        """
+        new_tracks = np.setdiff1d(np.unique(events['track'][events['track'] > 0]), list(self._tracks))
+        for track in new_tracks.tolist():
+            self._tracks.add(track)
+            heapq.heappush(self._heap, (start_tick, midi_io.PROGRAM, self._sequence, min(track - 1, 15), 0, 0))
+            self._sequence += 1
+        for _, tick, kind, _, channel, data1, data2 in events.tolist():
+            heapq.heappush(self._heap, (tick, kind, self._sequence, channel, data1, data2))
+            self._sequence += 1
+
+    async def _produce(self, loop, executor):
+        source = await loop.run_in_executor(executor, chunk_source, self.filename, self.cache.directory)
+        ends = {number: offset + length for number, offset, length in
+                zip(source["numbers"], source["offsets"], source["lengths"])}
+        for numbers in chunks(source["numbers"], self.chunk_measures):
+            # wait until the chunk is within the lookahead of the playhead
+            while self._start is not None and \
+                    self._seconds_at(self._horizon) - (loop.time() - self._start) > self.lookahead:
+                await asyncio.sleep(min(self.lookahead / 4, 0.25))
+            began = time.perf_counter()
+            events, rendered = await loop.run_in_executor(executor, render_chunk, self.filename, self.plan, numbers,
+                                                          self.cache.directory, self.ticks_per_quarter)
+            self._push(events, self._horizon)
+            self._horizon = int(round(max(ends[number] for number in numbers) * self.ticks_per_quarter))
+            self.stats["chunks"].append({"measures": [numbers[0], numbers[-1]], "rendered": rendered,
+                                         "seconds": time.perf_counter() - began})
+            self._rendered.set()
+        self._finished = True
+        self._rendered.set()
+
+    def _ready(self) -> bool:
+        return bool(self._heap) and (self._finished or self._heap[0][0] < self._horizon)
+
+    async def _consume(self, loop):
+        while True:
+            if not self._ready():
+                if self._finished and not self._heap:
+                    return
+                # rendering fell behind: hold the playhead until the next chunk is in
+                self._rendered.clear()
+                stalled = loop.time()
+                await self._rendered.wait()
+                if self._start is None:
+                    self._start = loop.time()
+                else:
+                    self.stats["stalls"] += 1
+                    self.stats["stalled_seconds"] += loop.time() - stalled
+                    self._start += loop.time() - stalled
+                continue
+            due = self._seconds_at(self._heap[0][0])
+            delay = self._start + due - loop.time()
+            if delay > self.tolerance:
+                await asyncio.sleep(delay)
+            # send everything due by now, plus the tolerance
+            now = loop.time() - self._start
+            while self._ready() and self._seconds_at(self._heap[0][0]) <= now + self.tolerance:
+                tick, kind, _, channel, data1, data2 = heapq.heappop(self._heap)
+                if kind == midi_io.TEMPO:
+                    self._set_tempo(tick, data2)
+                    continue
+                if kind in (midi_io.TIME_SIGNATURE, midi_io.KEY_SIGNATURE):
+                    continue
+                seconds = self._seconds_at(tick)
+                self._track_note(kind, channel, data1)
+                await self.sink.send(seconds, midi_io.encode_message(kind, channel, data1, data2))
+                self.stats["late"].append(max(loop.time() - self._start - seconds, 0.0))
+                self.stats["messages"] += 1
+                if self.stats["first_message_seconds"] is None:
+                    self.stats["first_message_seconds"] = time.perf_counter() - self._began
+
+    def _track_note(self, kind: int, channel: int, pitch: int):
+        key = (channel, pitch)
+        if kind == midi_io.NOTE_ON:
+            self._sounding[key] = self._sounding.get(key, 0) + 1
+        elif kind == midi_io.NOTE_OFF and self._sounding.get(key):
+            self._sounding[key] -= 1
+
+    async def _silence(self):
+        """
+        Release the notes still sounding and the pedal, e.g. after an interruption.
+        """
+        seconds = 0.0 if self._start is None else asyncio.get_running_loop().time() - self._start
+        sounding = {key: count for key, count in self._sounding.items() if count}
+        for (channel, pitch), count in sounding.items():
+            for _ in range(count):
+                await self.sink.send(seconds, midi_io.encode_message(midi_io.NOTE_OFF, channel, pitch, 0))
+        for channel in sorted({channel for channel, _ in sounding}):
+            await self.sink.send(seconds, midi_io.encode_message(midi_io.CONTROL, channel, _SUSTAIN, 0))
+            await self.sink.send(seconds, midi_io.encode_message(midi_io.CONTROL, channel, _ALL_NOTES_OFF, 0))
+        self._sounding.clear()
+
+    async def play(self, executor=None) -> dict:
+        """
+        Play the whole plan.
+        :param executor: concurrent.futures executor rendering the chunks, a single worker
+            process if None
+        :return: dict, timing report, see format_stats
+        """
+        loop = asyncio.get_running_loop()
+        self._began = time.perf_counter()
+        self._start = None
+        self._rendered = asyncio.Event()
+        owned = executor is None
+        if owned:
+            # a process rather than a thread: parsing and copying streams hold the interpreter
+            # for hundreds of milliseconds at a time, which would delay the scheduler
+            executor = ProcessPoolExecutor(max_workers=1)
+        await self.sink.open()
+        tasks = [asyncio.ensure_future(self._produce(loop, executor)), asyncio.ensure_future(self._consume(loop))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if owned:
+                executor.shutdown(wait=False, cancel_futures=True)
+            await self._silence()
+            await self.sink.close()
+        late = np.array(self.stats["late"]) if self.stats["late"] else np.zeros(1)
+        return {"messages": self.stats["messages"], "first_message_seconds": self.stats["first_message_seconds"],
+                "late_mean": float(late.mean()), "late_p99": float(np.percentile(late, 99)),
+                "late_max": float(late.max()), "stalls": self.stats["stalls"],
+                "stalled_seconds": self.stats["stalled_seconds"], "chunks": self.stats["chunks"]}
+
+
+def play(filename: str, plan: dict, sink: Sink = None, **kwargs) -> dict:
+    """
+    Play a plan on a score, see Player.
+    :param filename: input MIDI file
+    :param plan: dict, performance plan
+    :param sink: Sink, a RecorderSink if None
+    :return: dict, timing report
+    """
+    return asyncio.run(Player(filename, plan, sink if sink is not None else RecorderSink(), **kwargs).play())
+
+
+def format_stats(stats: dict) -> str:
+    return (f"{stats['messages']} messages, first after {stats['first_message_seconds']:.2f}s; "
+            f"late by {stats['late_mean'] * 1000:.2f} ms on average, {stats['late_p99'] * 1000:.2f} ms at the "
+            f"99th percentile, {stats['late_max'] * 1000:.2f} ms at most; {stats['stalls']} stalls "
+            f"({stats['stalled_seconds']:.2f}s); {len(stats['chunks'])} chunks, "
+            f"{sum(c['rendered'] for c in stats['chunks'])} measures rendered")
+
+
+def main(argv=None):
+    from .render import load_plan
+
+    parser = argparse.ArgumentParser(prog="python -m src.playback", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("plan", help="performance plan, JSON or YAML")
+    parser.add_argument("input", help="input MIDI file")
+    parser.add_argument("--port", help="MIDI output port (requires mido)")
+    parser.add_argument("--virtual", action="store_true", help="open --port as a virtual port")
+    parser.add_argument("--connect", help="HOST:PORT to stream the messages to")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the randomized transforms")
+    parser.add_argument("--lookahead", type=float, default=DEFAULT_LOOKAHEAD,
+                        help="seconds rendered ahead of the playhead")
+    parser.add_argument("--chunk-measures", type=int, default=DEFAULT_CHUNK_MEASURES,
+                        help="largest number of measures rendered at once")
+    parser.add_argument("--speed", type=float, default=1.0, help="playback speed, 2 playing twice as fast")
+    parser.add_argument("--json", help="write the timing report to this file")
+    args = parser.parse_args(argv)
+
+    plan = load_plan(args.plan)
+    if args.seed is not None:
+        plan["seed"] = args.seed
+    if args.port is not None or args.virtual:
+        sink = PortSink(args.port, args.virtual)
+    elif args.connect:
+        host, port = args.connect.rsplit(":", 1)
+        sink = SocketSink(host, int(port))
+    else:
+        sink = RecorderSink()
+    try:
+        stats = play(args.input, plan, sink, lookahead=args.lookahead, chunk_measures=args.chunk_measures,
+                     speed=args.speed)
+    except KeyboardInterrupt:
+        return
+    print(format_stats(stats), file=sys.stderr)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(stats, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+Render an expressive performance from a declarative plan.
+
+A plan is a JSON or YAML file with a ``steps`` list; each step names a transform and its
+keyword arguments (without the stream), e.g.
+
+    {"steps": [{"transform": "accelerate_measure", "args": {"measure_number": 19, "accelerate_rate": 1.2}},
+               {"transform": "change_dynamics_for_whole_piece"}]}
+
+An optional top-level ``seed`` makes the randomized transforms reproducible.
+
+Usage: python -m src.render plan.yaml in.mid out.mid
+
+The input may also be a MusicXML score (.musicxml, .xml or .mxl): its measures are then
+built only when a step looks them up, and the notated ornaments and hairpins can be played
+with the apply_notated_ornaments and apply_notated_hairpins steps.
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+
+from .index import MeasureIndex
+from .instrument import registry
+from .seeding import root_sequence, step_sequence
+
+# Passes run in this order; steps keep their plan order inside a pass.
+PASS_ORDER = ("timing", "articulation", "velocity", "pedal", "ornament", "dynamics")
+
+# name -> (module.function, pass, argument holding the first measure, argument holding the last measure).
+# Functions are imported on first use, so loading and scheduling a plan does not import music21.
+TRANSFORMS = {
+    "adjust_note_in_measures": ("articulations.adjust_note_in_measures", "articulation",
+                                "start_measure", "end_measure"),
+    "accentuate_highest_note_in_measure": ("articulations.accentuate_highest_note_in_measure", "articulation",
+                                           "measure_number", "measure_number"),
+    "increase_volume_of_highest_note_in_triples": ("articulations.increase_volume_of_highest_note_in_triples",
+                                                   "articulation", "start_measure_number", "end_measure_number"),
+    "increase_volume_of_higher_notes_in_track": ("articulations.increase_volume_of_higher_notes_in_track",
+                                                 "articulation", "start_measure_number", "end_measure_number"),
+    "accentuate_melody": ("articulations.accentuate_melody", "articulation", "start_measure", "end_measure"),
+    "apply_pedal_to_measures": ("articulations.apply_pedal_to_measures", "pedal", "start_measure", "end_measure"),
+    "apply_trill_to_hand_note": ("articulations.apply_trill_to_hand_note", "ornament",
+                                 "measure_number", "measure_number"),
+    "apply_ornaments": ("ornaments.apply_ornaments", "ornament", None, None),
+    "apply_notated_ornaments": ("ornaments.apply_notated_ornaments", "ornament", None, None),
+    "change_dynamics_decrescendo_measure": ("dynamics.change_dynamics_decrescendo_measure", "dynamics",
+                                            "measure", "measure"),
+    "change_dynamics_crescendo_measure": ("dynamics.change_dynamics_crescendo_measure", "dynamics",
+                                          "measure", "measure"),
+    "classical_dynamics_shape": ("dynamics.classical_dynamics_shape", "dynamics", "measure", "measure"),
+    "change_dynamics_for_whole_piece": ("dynamics.change_dynamics_for_whole_piece", "dynamics", None, None),
+    "apply_notated_hairpins": ("dynamics.apply_notated_hairpins", "dynamics", None, None),
+    "change_velocity_measures_in_stream": ("dynamics.change_velocity_measures_in_stream", "velocity",
+                                           "start_measure", "end_measure"),
+    "randomize_velocity_in_measures": ("dynamics.randomize_velocity_in_measures", "velocity",
+                                       "start_measure", "end_measure"),
+    "change_duration_specific_beats_in_stream": ("timings.change_duration_specific_beats_in_stream", "timing",
+                                                 "start_measure", "end_measure"),
+    "adjust_durations_for_specific_measure": ("timings.adjust_durations_for_specific_measure", "timing",
+                                              "measure_number", "measure_number"),
+    "execute_adjust_durations_for_specific_measure": ("timings.execute_adjust_durations_for_specific_measure",
+                                                      "timing", "start_measure_number", "end_measure_number"),
+    "change_duration_in_measure": ("timings.change_duration_in_measure", "timing", "measure_number", "measure_number"),
+    "execute_change_duration_in_measure": ("timings.execute_change_duration_in_measure", "timing",
+                                           "start_measure_number", "end_measure_number"),
+    "accelerate_measure": ("timings.accelerate_measure", "timing", "measure_number", "measure_number"),
+}
+
+# Transforms drawing random numbers; render passes them the seed sequence of the step as ``rng``,
+# see src.seeding
+RANDOMIZED = {"randomize_velocity_in_measures", "classical_dynamics_shape", "change_dynamics_for_whole_piece"}
+
+
+def transform_function(name: str):
+    """
+    Import and return the function of a transform.
+    :param name: str, key of TRANSFORMS
+    :return: callable
+    """
+    module_name, function_name = TRANSFORMS[name][0].rsplit(".", 1)
+    return getattr(importlib.import_module(f".{module_name}", __package__), function_name)
+
+
+def load_plan(filename: str) -> dict:
+    """
+    Load a performance plan from a JSON or YAML file.
+    :param filename: str, .json, .yaml or .yml
+    :return: dict
+    """
+    with open(filename) as f:
+        if os.path.splitext(filename)[1].lower() in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError as e:
+                raise ImportError("Reading YAML plans requires PyYAML (pip install pyyaml).") from e
+            plan = yaml.safe_load(f)
+        else:
+            plan = json.load(f)
+    for step in plan.get("steps", []):
+        if step["transform"] not in TRANSFORMS:
+            raise ValueError(f"Unknown transform {step['transform']!r} in {filename}.")
+    return plan
+
+
+def step_measures(step: dict) -> tuple:
+    """
+    Measure range touched by a step, (None, None) for the whole piece.
+    :param step: dict with "transform" and "args"
+    :return: tuple (start, end)
+    """
+    _, _, start_arg, end_arg = TRANSFORMS[step["transform"]]
+    args = step.get("args", {})
+    if start_arg is None or start_arg not in args:
+        return None, None
+    return args[start_arg], args.get(end_arg, args[start_arg])
+
+
+def step_fingerprint(step: dict) -> str:
+    """
+    Part of a step that decides its effect on one measure: the transform and its
+    arguments, without the measure range for transforms that have one.
+    :param step: dict with "transform" and "args"
+    :return: str
+    """
+    _, _, start_arg, end_arg = TRANSFORMS[step["transform"]]
+    args = {name: value for name, value in step.get("args", {}).items() if name not in (start_arg, end_arg)}
+    return json.dumps([step["transform"], args], sort_keys=True)
+
+
+def random_keys(steps: list) -> list:
+    """
+    Key of the random stream of each step: the fingerprint of the step and its occurrence
+    among the earlier steps with the same fingerprint, or the ``random_key`` a step was
+    given when its range was cut (see incremental.clip_plan); None for the steps that draw
+    no random numbers.
+    :param steps: list of steps, in schedule order
+    :return: list
+    """
+    counts = {}
+    keys = []
+    for step in steps:
+        if step["transform"] not in RANDOMIZED:
+            keys.append(None)
+        elif "random_key" in step:
+            keys.append(step["random_key"])
+        else:
+            fingerprint = step_fingerprint(step)
+            keys.append([fingerprint, counts.get(fingerprint, 0)])
+            counts[fingerprint] = counts.get(fingerprint, 0) + 1
+    return keys
+
+
+def schedule(plan: dict) -> list:
+    """
+    Order the steps of a plan by pass and group the steps of a pass whose measure ranges
+    overlap, so that each group is run back to back on the same measures.
+    :param plan: dict
+    :return: list of (pass, list of steps)
+    """
+    steps = sorted(plan.get("steps", []), key=lambda step: PASS_ORDER.index(TRANSFORMS[step["transform"]][1]))
+    groups = []
+    for step in steps:
+        pass_name = TRANSFORMS[step["transform"]][1]
+        start, end = step_measures(step)
+        if groups and groups[-1][0] == pass_name and _overlaps(groups[-1][2], (start, end)):
+            groups[-1][1].append(step)
+            previous = groups[-1][2]
+            groups[-1][2] = (None, None) if None in previous or start is None else \
+                (min(previous[0], start), max(previous[1], end))
+        else:
+            groups.append([pass_name, [step], (start, end)])
+    return [(pass_name, group_steps) for pass_name, group_steps, _ in groups]
+
+
+def _overlaps(a: tuple, b: tuple) -> bool:
+    if a[0] is None or b[0] is None:
+        return True
+    return a[0] <= b[1] and b[0] <= a[1]
+
+
+def render(my_stream, plan: dict, index: MeasureIndex = None, report: list = None, rng=None):
+    """
+    Apply every step of a plan to a stream, sharing one measure index between the steps.
+    Each randomized step draws from its own seed sequence, derived from the seed and the
+    step (see src.seeding), so with the same seed a render is reproducible, and a measure
+    gets the same numbers whichever other measures are rendered with it.
+    :param my_stream: music21 stream, modified in place
+    :param plan: dict
+    :param index: optional measure index of my_stream, built once if not given
+    :param report: optional list receiving one timing dict per step
+    :param rng: numpy.random.Generator, SeedSequence or seed, ``plan["seed"]`` if not given
+    :return: stream
+    """
+    index = index if index is not None and index.stream is my_stream else MeasureIndex(my_stream)
+    root = root_sequence(plan.get("seed") if rng is None else rng)
+    groups = schedule(plan)
+    keys = iter(random_keys([step for _, steps in groups for step in steps]))
+    for pass_name, steps in groups:
+        with registry.frame(pass_name):
+            for step in steps:
+                function = transform_function(step["transform"])
+                args = step.get("args", {})
+                key = next(keys)
+                if key is not None:
+                    args = dict(args, rng=step_sequence(root, key))
+                start = time.perf_counter()
+                my_stream = function(my_stream, index=index, **args)
+                if report is not None:
+                    report.append({"transform": step["transform"], "pass": pass_name,
+                                   "measures": step_measures(step), "seconds": time.perf_counter() - start})
+    return my_stream
+
+
+def format_report(report: list) -> str:
+    """
+    Format the per-step timings of a render as a table.
+    :param report: list of timing dicts, see render
+    :return: str
+    """
+    lines = [f"{'pass':<13}{'transform':<48}{'measures':<12}{'ms':>9}"]
+    for entry in report:
+        start, end = entry["measures"]
+        measures = "all" if start is None else (f"{start}" if start == end else f"{start}-{end}")
+        lines.append(f"{entry['pass']:<13}{entry['transform']:<48}{measures:<12}{entry['seconds'] * 1000:>9.1f}")
+    lines.append(f"{'total':<73}{sum(entry['seconds'] for entry in report) * 1000:>9.1f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.render", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("plan", help="performance plan, JSON or YAML")
+    parser.add_argument("input", help="input MIDI or MusicXML file")
+    parser.add_argument("output", help="output MIDI file")
+    parser.add_argument("--no-cache", action="store_true", help="always re-parse the input file")
+    parser.add_argument("--fast-midi", action="store_true",
+                        help="serialize the notes directly instead of using music21's MIDI writer")
+    parser.add_argument("--quiet", action="store_true", help="do not print the timing report")
+    parser.add_argument("--seed", type=int, help="seed of the randomized transforms, overrides the plan's seed")
+    parser.add_argument("--incremental", action="store_true",
+                        help="reuse the cached events of the measures whose source and steps did not change")
+    parser.add_argument("--performance-time", action="store_true",
+                        help="apply the timing steps to a performed-time layer instead of the written durations")
+    parser.add_argument("--profile", help="write the per-transform and per-measure cost report to this file, "
+                                          "as folded stacks for .folded or .txt and as JSON otherwise")
+    parser.add_argument("--log-level", default="WARNING", help="level of the transforms' log messages, "
+                                                               "DEBUG to see every measure adjusted")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(name)s: %(message)s")
+    if args.profile:
+        registry.enable()
+    plan = load_plan(args.plan)
+    if args.seed is not None:
+        plan["seed"] = args.seed
+    if args.incremental:
+        from .incremental import render_incremental
+
+        start = time.perf_counter()
+        counts = render_incremental(args.input, plan, args.output)
+        if not args.quiet:
+            print(f"{counts['rendered']} of {counts['measures']} measures rendered, {counts['reused']} reused "
+                  f"in {(time.perf_counter() - start) * 1000:.1f} ms", file=sys.stderr)
+        if args.profile:
+            registry.dump(args.profile)
+        return
+    from .utils import get_stream, is_musicxml, load_musicxml, save_midi
+
+    start = time.perf_counter()
+    index = None
+    if is_musicxml(args.input) and not args.performance_time:
+        index = load_musicxml(args.input)
+        my_stream = index.stream
+    else:
+        my_stream = get_stream(args.input, cache=None) if args.no_cache else get_stream(args.input)
+    report = [{"transform": "load_musicxml" if index is not None else "get_stream", "pass": "load",
+               "measures": (None, None), "seconds": time.perf_counter() - start}]
+    if args.performance_time:
+        from .performance import render_performed
+
+        start = time.perf_counter()
+        render_performed(my_stream, plan, args.output)
+        report.append({"transform": "render_performed", "pass": "all", "measures": (None, None),
+                       "seconds": time.perf_counter() - start})
+    else:
+        my_stream = render(my_stream, plan, index=index, report=report)
+        start = time.perf_counter()
+        if index is not None:
+            index.materialize()
+        save_midi(my_stream, args.output, fast=args.fast_midi)
+        report.append({"transform": "save_midi", "pass": "save", "measures": (None, None),
+                       "seconds": time.perf_counter() - start})
+    if not args.quiet:
+        print(format_report(report), file=sys.stderr)
+    if args.profile:
+        registry.dump(args.profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Random streams of the randomized transforms.
+
+render derives one numpy SeedSequence per randomized step from the seed of the plan and the
+step (its transform, its arguments other than the measure range, and its occurrence among
+the identical steps), and the transforms draw the numbers of each measure from a generator
+derived from that sequence and the measure number. The numbers drawn for a measure then do
+not depend on the other measures being rendered, so an incremental render or a playback
+chunk gives the same velocities as a full render with the same seed.
+
+Called directly with a Generator or a seed, the transforms draw every measure from that one
+generator, as before.
+"""
+import hashlib
+
+import numpy as np
+
+_KEY_MASK = (1 << 32) - 1
+
+
+def root_sequence(rng=None) -> np.random.SeedSequence:
+    """
+    Seed sequence of a render.
+    :param rng: SeedSequence, Generator (one number is drawn from it), seed, or None for
+        fresh entropy
+    :return: np.random.SeedSequence
+    """
+    if isinstance(rng, np.random.SeedSequence):
+        return rng
+    if isinstance(rng, np.random.Generator):
+        return np.random.SeedSequence(int(rng.integers(2 ** 63)))
+    return np.random.SeedSequence(rng)
+
+
+def step_sequence(root: np.random.SeedSequence, key) -> np.random.SeedSequence:
+    """
+    Seed sequence of one step.
+    :param root: seed sequence of the render, see root_sequence
+    :param key: JSON-serializable key of the step, see render.random_keys
+    :return: np.random.SeedSequence
+    """
+    digest = hashlib.sha1(repr(key).encode()).digest()
+    words = tuple(int.from_bytes(digest[i:i + 4], "little") for i in range(0, 16, 4))
+    return np.random.SeedSequence(root.entropy, spawn_key=tuple(root.spawn_key) + words)
+
+
+def measure_generator(rng, measure: int) -> np.random.Generator:
+    """
+    Generator drawing the numbers of one measure.
+    :param rng: SeedSequence of a step, or a Generator shared by every measure
+    :param measure: measure number
+    :return: np.random.Generator
+    """
+    if isinstance(rng, np.random.SeedSequence):
+        return np.random.default_rng(
+            np.random.SeedSequence(rng.entropy, spawn_key=tuple(rng.spawn_key) + (int(measure) & _KEY_MASK,)))
+    return rng
+
+
+def measure_integers(rng, measures: np.ndarray, low: int, high: int) -> np.ndarray:
+    """
+    Uniform integers in [low, high], one for each entry of ``measures``: drawn measure by
+    measure, in the order of the entries, from a step's SeedSequence, or in one call from
+    a Generator or seed.
+    :param rng: SeedSequence, Generator or seed
+    :param measures: measure number of each entry
+    :param low: int
+    :param high: int, inclusive
+    :return: np.ndarray of int
+    """
+    measures = np.asarray(measures)
+    if not isinstance(rng, np.random.SeedSequence):
+        return np.random.default_rng(rng).integers(low, high + 1, size=len(measures))
+    values = np.empty(len(measures), dtype=np.int64)
+    for number in np.unique(measures):
+        rows = np.nonzero(measures == number)[0]
+        values[rows] = measure_generator(rng, number).integers(low, high + 1, size=len(rows))
+    return values
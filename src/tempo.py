@@ -0,0 +1,219 @@
+import os
+
+import numpy as np
+
+ANNOTATION_DIR = "./Berceuse_op_57"
+PERFORMERS = ("LeungM07M", "MiyashitaM06M", "Tario07M", "Teo11M", "ZhangE09M")
+SCORE_ANNOTATIONS = "midi_score"
+
+# One row per annotated beat. ``position`` is the score position in quarter lengths,
+# derived from the beat labels and the annotated time signatures.
+BEAT_DTYPE = np.dtype([
+    ('time', 'f8'),  # seconds
+    ('position', 'f8'),
+    ('measure', 'i4'),  # 1-based, counted from the first downbeat
+    ('beat', 'i2'),  # 1-based beat inside the measure
+    ('downbeat', '?'),
+    ('numerator', 'i2'),
+    ('denominator', 'i2'),
+])
+
+
+def annotation_path(name: str, directory: str = ANNOTATION_DIR) -> str:
+    """
+    Path of the annotation file of a performer ("LeungM07M", ...) or of the score ("midi_score").
+    :param name: str
+    :param directory: str
+    :return: str
+    """
+    return os.path.join(directory, f"{name}_annotations.txt")
+
+
+def beats_per_measure(numerator: int) -> int:
+    """
+    Number of beats of a time signature: compound meters (6/8, 9/8, 12/8) count dotted beats.
+    :param numerator: int
+    :return: int
+    """
+    return numerator // 3 if numerator > 3 and numerator % 3 == 0 else numerator
+
+
+def beat_length(numerator: int, denominator: int) -> float:
+    """
+    Length of the beat of a time signature in quarter lengths, like music21's
+    ``beatDuration``: a dotted unit in compound meters, the unit otherwise.
+    :param numerator: int
+    :param denominator: int
+    :return: float
+    """
+    return numerator * 4.0 / denominator / beats_per_measure(numerator)
+
+
+def read_annotations(filename: str) -> np.ndarray:
+    """
+    Parse a beat annotation file: tab-separated start time, end time and label per line,
+    where the label is "db" (downbeat) or "b" (beat), a downbeat optionally followed by
+    the time signature and key ("db,6/8,-5").
+    :param filename: str
+    :return: np.ndarray with BEAT_DTYPE
+    """
+    rows = []
+    numerator, denominator = 4, 4
+    measure = 0
+    beat = 0
+    position = 0.0
+    measure_start = 0.0
+    with open(filename) as f:
+        for line in f:
+            fields = line.split("\t")
+            if len(fields) < 3:
+                continue
+            labels = fields[2].strip().split(",")
+            downbeat = labels[0] == "db"
+            if downbeat:
+                if measure > 0:
+                    measure_start += numerator * 4.0 / denominator
+                if len(labels) > 1 and "/" in labels[1]:
+                    numerator, denominator = (int(x) for x in labels[1].split("/"))
+                measure += 1
+                beat = 1
+            else:
+                beat += 1
+            position = measure_start + (beat - 1) * beat_length(numerator, denominator)
+            rows.append((float(fields[0]), position, measure, beat, downbeat, numerator, denominator))
+    return np.array(rows, dtype=BEAT_DTYPE)
+
+
+class TempoMap:
+    """
+    Piecewise-linear map from score position (quarter lengths) to performed time (seconds),
+    through the annotated beats. Positions outside the annotated range are extrapolated
+    with the tempo of the nearest beat interval.
+
+    :param positions: increasing score positions of the beats, in quarter lengths
+    :param times: performed times of the beats, in seconds
+    """
+
+    def __init__(self, positions, times):
+        self.positions = np.asarray(positions, dtype=float)
+        self.times = np.asarray(times, dtype=float)
+        if len(self.positions) < 2 or len(self.positions) != len(self.times):
+            raise ValueError("A tempo map needs at least two beats with one time each.")
+
+    @classmethod
+    def from_annotations(cls, filename: str, start: float = None) -> 'TempoMap':
+        """
+        Tempo map of one annotated performance.
+        :param filename: str, annotation file
+        :param start: optional time of the first beat; the performance is shifted to it
+        :return: TempoMap
+        """
+        beats = read_annotations(filename)
+        times = beats['time'] if start is None else beats['time'] - beats['time'][0] + start
+        return cls(beats['position'], times)
+
+    @classmethod
+    def average(cls, filenames, start: float = 0.0) -> 'TempoMap':
+        """
+        Tempo map averaging several performances beat by beat, each one shifted so that
+        its first beat is at ``start``. The files must annotate the same beats.
+        :param filenames: iterable of annotation files
+        :param start: time of the first beat, in seconds
+        :return: TempoMap
+        """
+        beats = [read_annotations(filename) for filename in filenames]
+        count = min(len(b) for b in beats)
+        times = np.stack([b['time'][:count] - b['time'][0] for b in beats])
+        return cls(beats[0]['position'][:count], times.mean(axis=0) + start)
+
+    @classmethod
+    def performer(cls, name: str, directory: str = ANNOTATION_DIR, start: float = 0.0) -> 'TempoMap':
+        """
+        Tempo map of one of the recorded performances, e.g. TempoMap.performer("LeungM07M").
+        :param name: str, see PERFORMERS
+        :param directory: str
+        :param start: time of the first beat, in seconds
+        :return: TempoMap
+        """
+        return cls.from_annotations(annotation_path(name, directory), start)
+
+    @classmethod
+    def mean_performance(cls, directory: str = ANNOTATION_DIR, performers=PERFORMERS,
+                         start: float = 0.0) -> 'TempoMap':
+        """
+        Tempo map averaged over the recorded performances.
+        :param directory: str
+        :param performers: iterable of performer names
+        :param start: time of the first beat, in seconds
+        :return: TempoMap
+        """
+        return cls.average([annotation_path(name, directory) for name in performers], start)
+
+    def seconds(self, positions) -> np.ndarray:
+        """
+        Performed time of score positions.
+        :param positions: float or array of quarter lengths
+        :return: np.ndarray of seconds
+        """
+        return _interpolate(np.asarray(positions, dtype=float), self.positions, self.times)
+
+    def quarters(self, seconds) -> np.ndarray:
+        """
+        Score position of performed times (inverse of seconds).
+        :param seconds: float or array of seconds
+        :return: np.ndarray of quarter lengths
+        """
+        return _interpolate(np.asarray(seconds, dtype=float), self.times, self.positions)
+
+    def tempo(self, positions) -> np.ndarray:
+        """
+        Local tempo at score positions, in quarter notes per minute.
+        :param positions: float or array of quarter lengths
+        :return: np.ndarray
+        """
+        slopes = np.diff(self.times) / np.diff(self.positions)
+        segment = np.clip(np.searchsorted(self.positions, positions, side='right') - 1, 0, len(slopes) - 1)
+        return 60.0 / slopes[segment]
+
+
+def _interpolate(x: np.ndarray, xp: np.ndarray, fp: np.ndarray) -> np.ndarray:
+    """
+    np.interp with linear extrapolation from the first and last segments.
+    """
+    y = np.interp(x, xp, fp)
+    below = x < xp[0]
+    above = x > xp[-1]
+    if below.any():
+        y = np.where(below, fp[0] + (x - xp[0]) * (fp[1] - fp[0]) / (xp[1] - xp[0]), y)
+    if above.any():
+        y = np.where(above, fp[-1] + (x - xp[-1]) * (fp[-1] - fp[-2]) / (xp[-1] - xp[-2]), y)
+    return y
+
+
+def apply_tempo_map(table, tempo_map: TempoMap, qpm: float = 60.0):
+    """
+    Move the notes and barlines of a NoteTable to performed time in one vectorized
+    interpolation. Onsets and durations are rewritten in quarter lengths at the reference
+    tempo ``qpm``, which becomes the only tempo of the table, so ``table.to_midi`` plays
+    the notes at the performed times.
+    :param table: NoteTable, modified in place
+    :param tempo_map: TempoMap
+    :param qpm: reference tempo in quarter notes per minute
+    :return: table
+    """
+    scale = qpm / 60.0
+    data = table.data
+    onsets = tempo_map.seconds(data['onset'])
+    offsets = tempo_map.seconds(data['onset'] + data['duration'])
+    data['onset'] = onsets * scale
+    data['duration'] = np.maximum(offsets - onsets, 0.0) * scale
+
+    measures = table.measures
+    starts = tempo_map.seconds(measures['offset'])
+    ends = tempo_map.seconds(measures['offset'] + measures['length'])
+    measures['offset'] = starts * scale
+    measures['length'] = (ends - starts) * scale
+    measures['tempo'] = 0.0
+    if len(measures):
+        measures['tempo'][measures['offset'] == measures['offset'].min()] = qpm
+    return table
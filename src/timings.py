@@ -1,5 +1,16 @@
+import logging
+
+import numpy as np
+
+from .index import MeasureIndex, measure_index
+from .instrument import instrumented
+
+logger = logging.getLogger(__name__)
+
+
+@instrumented("start_measure", "end_measure")
 def change_duration_specific_beats_in_stream(s, start_measure: int, end_measure: int, target_beats: list,
-                                             duration_factor: float):
+                                             duration_factor: float, index: MeasureIndex = None):
     """
     Change the duration of notes in a stream at specific beats.
     :param s:  Stream
@@ -7,18 +18,20 @@ def change_duration_specific_beats_in_stream(s, start_measure: int, end_measure:
     :param end_measure: int
     :param target_beats: should be a list of beats where duration needs to be changed, e.g., [1, 3]
     :param duration_factor: float
+    :param index: MeasureIndex, optional measure index of s, built once if not given
     :return:
     """
-    for measure_number in range(start_measure, end_measure + 1):
-        measure = s.measure(measure_number)
-        if measure is not None:
-            for n in measure.notes:  # Iterating over notes directly
-                if n.beat in target_beats:  # Check if the note's beat is in the list of target beats
-                    n.duration.quarterLength *= duration_factor
+    index = measure_index(s, index)
+    grid = index.metric(start_measure, end_measure)
+    # Beats are precomputed for the range (or the whole score), select the notes on the target beats at once
+    for i in np.nonzero(grid.select(start_measure, end_measure, beats=target_beats))[0]:
+        grid.elements[i].duration.quarterLength *= duration_factor
     return s
 
 
-def adjust_durations_for_specific_measure(score, measure_number, track1_new_durations=None):
+@instrumented("measure_number")
+def adjust_durations_for_specific_measure(score, measure_number, track1_new_durations=None,
+                                          index: MeasureIndex = None):
     """
     Adjusts the durations of notes in a specific measure of a score and ensures that the durations
     of notes in another track are updated proportionally to match the total duration of the modified measure.
@@ -27,6 +40,7 @@ def adjust_durations_for_specific_measure(score, measure_number, track1_new_dura
         score (music21.stream.Score): The score containing the music parts.
         measure_number (int): The measure number to adjust durations for.
         track1_new_durations (list[float]): List of new durations for notes in track1.
+        index (MeasureIndex): Optional measure index of score, built once if not given.
 
     Returns:
         music21.stream.Score: The score with adjusted durations.
@@ -34,12 +48,11 @@ def adjust_durations_for_specific_measure(score, measure_number, track1_new_dura
     # Get the relevant tracks from the score
     if track1_new_durations is None:
         track1_new_durations = [0.75, 0.4, 0.3, 0.3, 1.25]
-    track1 = score.parts[1]
-    track0 = score.parts[0]
+    index = measure_index(score, index)
 
     # Get the specific measure from each track
-    track1_measure = track1.measure(measure_number)
-    track0_measure = track0.measure(measure_number)
+    track1_measure = index.get(measure_number, 1)
+    track0_measure = index.get(measure_number, 0)
 
     # Update durations of notes in track1
     for note, new_duration in zip(track1_measure.notes, track1_new_durations):
@@ -59,22 +72,28 @@ def adjust_durations_for_specific_measure(score, measure_number, track1_new_dura
     return score
 
 
-def execute_adjust_durations_for_specific_measure(score, start_measure_number, end_measure_number):
+@instrumented("start_measure_number", "end_measure_number")
+def execute_adjust_durations_for_specific_measure(score, start_measure_number, end_measure_number,
+                                                  index: MeasureIndex = None):
     """
     Adjust the durations of notes in a range of measures of a score.
     :param score:
     :param start_measure_number:
     :param end_measure_number:
+    :param index: MeasureIndex, optional measure index of score, built once if not given
     :return:
     """
+    index = measure_index(score, index)
     for i in range(start_measure_number, end_measure_number + 1):
-        score = adjust_durations_for_specific_measure(score, i)
-        print(f"Measure {i} adjusted.")
+        score = adjust_durations_for_specific_measure(score, i, index=index)
+        logger.debug("Measure %d adjusted.", i)
 
     return score
 
 
-def change_duration_in_measure(score, measure_number, target_duration, new_duration, track_number=0):
+@instrumented("measure_number")
+def change_duration_in_measure(score, measure_number, target_duration, new_duration, track_number=0,
+                               index: MeasureIndex = None, tolerance: float = 0.05):
     """
     Changes the duration of notes with a specific duration in a specified measure of a specified track within a MIDI file.
 
@@ -84,35 +103,40 @@ def change_duration_in_measure(score, measure_number, target_duration, new_durat
         measure_number (int): The measure number where notes' duration will be changed (1-indexed).
         target_duration (float): The duration of the notes to be changed.
         new_duration (float): The new duration to be applied to the notes.
+        index (MeasureIndex): Optional measure index of score, built once if not given.
+        tolerance (float): Relative tolerance of the duration match; the MIDI parser shortens the
+            written durations slightly (e.g. 0.4979 for an eighth note).
 
     Returns:
         music21.stream.Score: The modified Score object with updated note durations in the specified measure.
     """
-    # Access the specific part (track)
-    target_part = score.parts[track_number]
+    index = measure_index(score, index)
 
-    # Access the specific measure
-    target_measure = target_part.measure(measure_number)
+    # Access the specific measure of the specific part (track)
+    target_measure = index.get(measure_number, track_number)
     # Iterate over all notes in the measure
     for note in target_measure.notes:
-        # Check if the note's duration matches the target duration
-        if note.duration.quarterLength == target_duration:
+        # Check if the note's duration matches the target duration, as performance.change_duration_in_measure
+        if np.isclose(float(note.duration.quarterLength), target_duration, rtol=tolerance):
             # Change the note's duration to the new specified duration
             note.duration.quarterLength = new_duration
 
     return score
 
 
-def execute_change_duration_in_measure(score, start_measure_number, end_measure_number):
+@instrumented("start_measure_number", "end_measure_number")
+def execute_change_duration_in_measure(score, start_measure_number, end_measure_number, index: MeasureIndex = None):
     # Adjust durations from start_measure_number to end_measure_number
+    index = measure_index(score, index)
     for i in range(start_measure_number, end_measure_number + 1):
-        score = change_duration_in_measure(score, 15, 0.5, 0.3, 0)
-        print(f"Measure {i} adjusted.")
+        score = change_duration_in_measure(score, i, 0.5, 0.3, 0, index=index)
+        logger.debug("Measure %d adjusted.", i)
 
     return score
 
 
-def accelerate_measure(score, measure_number, accelerate_rate, track_numbers=[0, 1]):
+@instrumented("measure_number")
+def accelerate_measure(score, measure_number, accelerate_rate, track_numbers=[0, 1], index: MeasureIndex = None):
     """
     Accelerates the durations of notes within a specified measure by adjusting their lengths relative to the first note's duration, such that the last note's duration is accelerate_rate times faster than the first note's duration.
 
@@ -122,16 +146,17 @@ def accelerate_measure(score, measure_number, accelerate_rate, track_numbers=[0,
         accelerate_rate (float): The rate at which the durations should accelerate.
             means the last note's duration will be half of the first note's duration.
         track_numbers (list of int): List of track numbers to process (0 or 1).
+        index (MeasureIndex): Optional measure index of score, built once if not given.
 
     Returns:
         music21.stream.Score: The modified score object with the accelerated measure.
     """
+    index = measure_index(score, index)
     for track_number in track_numbers:
-        track = score.parts[track_number]
-        measure = track.measure(measure_number)
+        measure = index.get(measure_number, track_number)
         if measure is None:
             continue
-        notes = measure.recurse().notes
+        notes = index.notes(measure_number, track_number, ordered=False)
         base_duration = notes[0].duration.quarterLength
         num_notes = len(notes)
         for i, note in enumerate(notes):
@@ -1,24 +1,197 @@
-from music21 import converter, stream
+import collections
+import hashlib
+import os
+import zlib
 
+import music21
+from music21 import converter, freezeThaw, stream
+from music21.midi import translate
 
-def get_stream(filename: str = "./Berceuse_op_57/corrected_midi_score.mid") -> 'music21.stream.Stream':
+from . import midi_io
+from .controllers import merge_into_midi_file, stored_controller_track
+from .musicxml import LazyMeasureIndex, is_musicxml, read_musicxml
+
+DEFAULT_CACHE_DIR = os.environ.get("DM_STREAM_CACHE",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "dm_assignment2", "streams"))
+
+
+class StreamCache:
     """
-    Get a music21 stream from a midi file.
+    Cache of parsed music21 streams, kept in memory and as compressed pickles on disk.
+
+    Entries are keyed by the content hash of the source file, the ``quarterLengthDivisors``
+    used for parsing and the music21 version, so editing the file or upgrading music21
+    never serves a stale stream. The in-process memo holds the pickled bytes of the most
+    recently used entries; the disk store is evicted least-recently-used first once it
+    grows past ``max_bytes``. Every hit is unpickled into a fresh stream, so the in-place
+    transforms never touch the cached version.
+
+    :param directory: folder holding the pickles, or None to keep the cache in memory only
+    :param max_bytes: size bound of the disk store
+    :param memo_size: number of entries kept in memory
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = 256 * 1024 * 1024,
+                 memo_size: int = 8):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memo_size = memo_size
+        self._memo = collections.OrderedDict()
+
+    @staticmethod
+    def key(filename: str, quarter_length_divisors: tuple) -> str:
+        """
+        Build the cache key of a file.
+        :param filename: str
+        :param quarter_length_divisors: tuple passed to the parser
+        :return: str, hex digest
+        """
+        digest = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(repr(tuple(quarter_length_divisors)).encode())
+        digest.update(music21.VERSION_STR.encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".p")
+
+    def _remember(self, key: str, data: bytes):
+        self._memo[key] = data
+        self._memo.move_to_end(key)
+        while len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+
+    def get(self, key: str):
+        """
+        Return a fresh copy of the cached stream, or None on a miss.
+        :param key: str, see StreamCache.key
+        :return: music21.stream.Stream or None
+        """
+        data = self._memo.get(key)
+        if data is not None:
+            self._memo.move_to_end(key)
+        elif self.directory is not None and os.path.exists(self._path(key)):
+            path = self._path(key)
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # mark as recently used for eviction
+            self._remember(key, data)
+        else:
+            return None
+        thawer = freezeThaw.StreamThawer()
+        thawer.openStr(zlib.decompress(data), pickleFormat="pickle")
+        return thawer.stream
+
+    def put(self, key: str, my_stream: 'stream.Stream'):
+        """
+        Store a stream. The stream itself is left untouched.
+        :param key: str, see StreamCache.key
+        :param my_stream: music21.stream.Stream
+        """
+        data = zlib.compress(freezeThaw.StreamFreezer(my_stream).writeStr(fmt="pickle"))
+        self._remember(key, data)
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self._path(key) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used pickles until the disk store fits in max_bytes.
+        """
+        if self.directory is None or not os.path.isdir(self.directory):
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".p"):
+                info = os.stat(os.path.join(self.directory, name))
+                entries.append((info.st_mtime, info.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def clear(self):
+        """
+        Forget every entry, in memory and on disk.
+        """
+        self._memo.clear()
+        if self.directory is not None and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(".p"):
+                    os.remove(os.path.join(self.directory, name))
+
+
+stream_cache = StreamCache()
+
+
+def get_stream(filename: str = "./Berceuse_op_57/corrected_midi_score.mid",
+               quarter_length_divisors: tuple = (128, 48),
+               cache: StreamCache = stream_cache) -> 'music21.stream.Stream':
+    """
+    Get a music21 stream from a midi or MusicXML file (see load_musicxml).
     :param filename: str
+    :param quarter_length_divisors: tuple, quantization grid passed to the MIDI parser
+    :param cache: StreamCache holding already parsed files, or None to always parse
     :return: music21.stream.Stream
     """
-    my_stream = converter.parse(filename, format='midi', forceSource=True,
-                                quantizePost=False, quarterLengthDivisors=(128, 48))
+    key = None
+    if cache is not None:
+        key = cache.key(filename, quarter_length_divisors)
+        my_stream = cache.get(key)
+        if my_stream is not None:
+            return my_stream
+    if is_musicxml(filename):
+        my_stream = load_musicxml(filename).materialize()
+    else:
+        my_stream = converter.parse(filename, format='midi', forceSource=True,
+                                    quantizePost=False, quarterLengthDivisors=quarter_length_divisors)
+    if cache is not None:
+        cache.put(key, my_stream)
     return my_stream
 
 
-def save_midi(my_stream: 'stream.Stream', filename: str = "./Berceuse_op_57/generated_midi_score.mid"):
+def load_musicxml(filename: str) -> LazyMeasureIndex:
+    """
+    Read a MusicXML score (.musicxml, .xml or .mxl) without building its measures, see
+    musicxml.LazyMeasureIndex. Pass the index to render so the transforms build only the
+    measures they touch and can read the notated markings.
+    :param filename: str
+    :return: LazyMeasureIndex, its ``stream`` filling in as measures are looked up
+    """
+    return read_musicxml(filename).index()
+
+
+def save_midi(my_stream: 'stream.Stream', filename: str = "./Berceuse_op_57/generated_midi_score.mid",
+              fast: bool = False):
     """
     Save a music21 stream to a midi file.
     :param my_stream: music21.stream.Stream
     :param filename: str
+    :param fast: bool, serialize the notes directly (see midi_io.write_stream) instead of
+        going through music21's write('midi')
     """
-    my_stream.write('midi', fp=filename)
+    if fast:
+        midi_io.write_stream(my_stream, filename)
+        return
+    controllers = stored_controller_track(my_stream)
+    if controllers is None:
+        my_stream.write('midi', fp=filename)
+        return
+    # streams cannot hold controller events, merge them into the translated MIDI file
+    mf = translate.streamToMidiFile(my_stream)
+    merge_into_midi_file(mf, controllers)
+    mf.open(filename, 'wb')
+    mf.write()
+    mf.close()
 
 
 def extract_measures_and_save(input_stream, output_midi_path: str, start_measure: int, end_measure: int):
@@ -30,19 +203,8 @@ def extract_measures_and_save(input_stream, output_midi_path: str, start_measure
     :param start_measure: the first measure to include in the extraction.
     :param end_measure: the last measure to include in the extraction.
     """
-    new_stream = stream.Score()
-
-    for part in input_stream.parts:
-        # Extracts a specified range of bars
-        extracted_measures = part.measures(start_measure, end_measure)
-
-        new_part = stream.Part()
-        for measure in extracted_measures:
-            new_part.append(measure)
-        new_stream.append(new_part)
-
-    # save
-    new_stream.write('midi', fp=output_midi_path)
+    # Serialize the range directly, without copying the measures into a new Score
+    midi_io.write_stream(input_stream, output_midi_path, start_measure, end_measure)
 
 
 def count_notes_in_measure(score, measure_number):
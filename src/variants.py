@@ -0,0 +1,629 @@
+"""
+Compact storage of rendered variants as differences from the score.
+
+A rendition keeps most notes of its score and changes their timing and velocity, so a
+variant is stored as
+
+- one delta column per note field (onset and duration in MIDI ticks, velocity) over the
+  rows of the base score's NoteTable, dense or sparse (changed rows only), whichever is
+  smaller, each in the narrowest integer type that holds it;
+- the base rows the rendition dropped and the notes it added (ornaments), in full;
+- its controller events (pedals).
+
+Rendered notes are paired with the base rows of the same part, measure and pitch by
+nearest onset, see match_rows. Timing is kept at the resolution of the MIDI export
+(``ticks_per_quarter``), so ``to_midi`` writes the same notes as exporting the rendition
+itself.
+
+On disk a variant is one ``.dmv`` file: a JSON header followed by one 64-byte aligned
+block per column. ``Variant.load`` memory-maps the file and its columns are views of the
+mapping, so reading a variant copies nothing and ``diff`` over a parameter sweep touches
+only the columns it compares. Variants are tied to their base score by ``base_key``.
+
+Usage:
+    python -m src.variants encode rendered.mid variant.dmv
+    python -m src.variants diff a.dmv b.dmv
+    python -m src.variants export variant.dmv out.mid
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import warnings
+
+import numpy as np
+
+from . import midi_io
+from .notetable import NOTE_DTYPE, NoteTable
+from .tempo import TempoMap, beat_length
+
+MAGIC = b"DMVARNT1"
+ALIGNMENT = 64
+
+# Note fields stored as deltas against the base rows
+FIELDS = ("onset", "duration", "velocity")
+
+# One row per base row where two variants differ, see diff
+DIFF_DTYPE = np.dtype([
+    ('row', 'i4'),
+    ('part', 'i2'),
+    ('measure', 'i4'),
+    ('pitch', 'i2'),
+    ('onset', 'f8', (2,)),  # quarter lengths in each variant, NaN where the note was dropped
+    ('duration', 'f8', (2,)),
+    ('velocity', 'i2', (2,)),  # 0 where the note was dropped
+])
+
+
+def base_key(table: NoteTable) -> str:
+    """
+    Content key of a base score: variants only apply to the table they were encoded against.
+    :param table: NoteTable
+    :return: str, hex digest
+    """
+    digest = hashlib.sha256()
+    for array in (table.data, table.measures):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()[:32]
+
+
+def _narrow(values: np.ndarray) -> np.ndarray:
+    """
+    Integer values in the smallest signed type holding them.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if not len(values) or (values.min() >= info.min and values.max() <= info.max):
+            return values.astype(dtype)
+    return values
+
+
+def _ticks(quarters, ticks_per_quarter: int) -> np.ndarray:
+    return np.round(np.asarray(quarters, dtype=float) * ticks_per_quarter).astype(np.int64)
+
+
+def match_rows(base: np.ndarray, notes: np.ndarray, tolerance: float = 0.5) -> np.ndarray:
+    """
+    Pair rendered notes with the base rows of the same part, measure and pitch, closest
+    onsets first, each row used once. A note moved to another measure is stored as
+    dropped and added.
+    :param base: NoteTable data of the score
+    :param notes: NoteTable data of the rendition
+    :param tolerance: largest onset difference of a pair, in quarter lengths
+    :return: np.ndarray of int, base row of every rendered note, -1 for added notes
+    """
+    matched = np.full(len(notes), -1, dtype=np.int64)
+    if not len(base) or not len(notes):
+        return matched
+    # one sorted axis: (part, measure, pitch) groups spaced further apart than any onset;
+    # notes repeated at one onset (unisons of two voices) pair up in row order
+    groups = np.concatenate([base[['part', 'measure', 'pitch']], notes[['part', 'measure', 'pitch']]])
+    _, group = np.unique(groups.astype([('part', 'i8'), ('measure', 'i8'), ('pitch', 'i8')]), return_inverse=True)
+    spacing = max(np.abs(base['onset']).max(), np.abs(notes['onset']).max()) * 2 + tolerance + 1.0
+    base_sort = group[:len(base)] * spacing + base['onset'] + _repeats(group[:len(base)], base['onset']) * 1e-6
+    note_sort = group[len(base):] * spacing + notes['onset'] + _repeats(group[len(base):], notes['onset']) * 1e-6
+    order = np.argsort(base_sort, kind='stable')
+    position = np.searchsorted(base_sort[order], note_sort)
+    candidates = []
+    for shift in (-1, 0):
+        index = np.clip(position + shift, 0, len(order) - 1)
+        candidates.append((np.arange(len(notes)), order[index], np.abs(note_sort - base_sort[order[index]])))
+    note_rows, base_rows, distance = (np.concatenate(column) for column in zip(*candidates))
+    close = distance <= tolerance + 1e-9
+    note_rows, base_rows, distance = note_rows[close], base_rows[close], distance[close]
+    used = np.zeros(len(base), dtype=bool)
+    for k in np.argsort(distance, kind='stable').tolist():
+        note_row, base_row = note_rows[k], base_rows[k]
+        if matched[note_row] < 0 and not used[base_row]:
+            matched[note_row] = base_row
+            used[base_row] = True
+    return matched
+
+
+def _store_delta(columns: dict, field: str, delta: np.ndarray):
+    """
+    Add the delta column of a field, sparse (changed rows and their values) when that is
+    smaller than the dense column.
+    """
+    changed = np.nonzero(delta)[0]
+    values = _narrow(delta[changed])
+    if len(changed) * (4 + values.itemsize) < len(delta) * values.itemsize:
+        columns[f"delta.{field}.rows"] = changed.astype(np.int32)
+        columns[f"delta.{field}"] = values
+    else:
+        columns[f"delta.{field}"] = _narrow(delta)
+
+
+def _repeats(group: np.ndarray, onset: np.ndarray) -> np.ndarray:
+    """
+    Number of earlier rows with the same group and onset, for every row.
+    """
+    order = np.lexsort((np.arange(len(group)), onset, group))
+    same = np.r_[False, (group[order][1:] == group[order][:-1]) & (onset[order][1:] == onset[order][:-1])]
+    starts = np.maximum.accumulate(np.where(same, 0, np.arange(len(order))))
+    repeats = np.empty(len(order), dtype=np.int64)
+    repeats[order] = np.arange(len(order)) - starts
+    return repeats
+
+
+class Variant:
+    """
+    A rendition stored as differences from its base score, see the module docstring.
+
+    ``columns`` maps column names to 1-d arrays: ``delta.<field>`` (with
+    ``delta.<field>.rows`` when sparse), ``removed``, ``added.<field>`` and
+    ``controllers.<field>``. Build one with ``encode``, ``from_stream`` or ``from_midi``.
+
+    :param columns: dict str -> np.ndarray
+    :param key: base_key of the base score
+    :param base_rows: number of rows of the base score
+    :param ticks_per_quarter: resolution of the onset and duration columns
+    :param meta: optional JSON-serializable dict (plan parameters, seed, ...)
+    """
+
+    def __init__(self, columns: dict, key: str, base_rows: int, ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER,
+                 meta: dict = None):
+        self.columns = columns
+        self.key = key
+        self.base_rows = base_rows
+        self.ticks_per_quarter = ticks_per_quarter
+        self.meta = meta or {}
+
+    @classmethod
+    def encode(cls, base: NoteTable, table: NoteTable, controllers: np.ndarray = None,
+               ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER, tolerance: float = 0.5,
+               meta: dict = None) -> 'Variant':
+        """
+        Variant of a rendered note table against its base score.
+        :param base: NoteTable of the score
+        :param table: NoteTable of the rendition, with the measures of the score
+        :param controllers: optional np.ndarray with controllers.CONTROLLER_DTYPE
+        :param ticks_per_quarter: MIDI resolution of the timing columns
+        :param tolerance: see match_rows
+        :param meta: optional dict stored with the variant
+        :return: Variant
+        """
+        from .controllers import CONTROLLER_DTYPE
+
+        source, notes = base.data, table.data
+        matched = match_rows(source, notes, tolerance)
+        pairs = np.nonzero(matched >= 0)[0]
+        rows = matched[pairs]
+        columns = {}
+        deltas = {
+            "onset": _ticks(notes['onset'][pairs], ticks_per_quarter) - _ticks(source['onset'][rows],
+                                                                              ticks_per_quarter),
+            "duration": _ticks(notes['duration'][pairs], ticks_per_quarter) - _ticks(source['duration'][rows],
+                                                                                    ticks_per_quarter),
+            "velocity": notes['velocity'][pairs].astype(np.int64) - source['velocity'][rows],
+        }
+        for field in FIELDS:
+            dense = np.zeros(len(source), dtype=np.int64)
+            dense[rows] = deltas[field]
+            _store_delta(columns, field, dense)
+        kept = np.zeros(len(source), dtype=bool)
+        kept[rows] = True
+        columns["removed"] = np.nonzero(~kept)[0].astype(np.int32)
+        added = notes[matched < 0]
+        columns["added.part"] = _narrow(added['part'])
+        columns["added.measure"] = _narrow(added['measure'])
+        columns["added.onset"] = _narrow(_ticks(added['onset'], ticks_per_quarter))
+        columns["added.duration"] = _narrow(_ticks(added['duration'], ticks_per_quarter))
+        columns["added.pitch"] = _narrow(added['pitch'])
+        columns["added.velocity"] = _narrow(added['velocity'])
+        events = np.zeros(0, dtype=CONTROLLER_DTYPE) if controllers is None else controllers
+        columns["controllers.tick"] = _narrow(_ticks(events['time'], ticks_per_quarter))
+        columns["controllers.part"] = _narrow(events['part'])
+        columns["controllers.control"] = events['control'].astype(np.uint8)
+        columns["controllers.value"] = events['value'].astype(np.uint8)
+        return cls(columns, base_key(base), len(source), ticks_per_quarter, meta)
+
+    @classmethod
+    def from_stream(cls, base: NoteTable, s, **kwargs) -> 'Variant':
+        """
+        Variant of a rendered stream, with its controller track.
+        :param base: NoteTable of the score the stream was rendered from
+        :param s: music21 stream
+        :param kwargs: see encode
+        :return: Variant
+        """
+        from .controllers import stored_controller_track
+
+        controllers = stored_controller_track(s)
+        return cls.encode(base, NoteTable.from_stream(s), None if controllers is None else controllers.events,
+                          **kwargs)
+
+    @classmethod
+    def from_midi(cls, base: NoteTable, fp, **kwargs) -> 'Variant':
+        """
+        Variant of a rendered MIDI file, read without music21. Times are brought back to
+        quarter lengths through the tempo marks of the base score; track 1 is part 0. The
+        timing is kept at the resolution of the file unless ``ticks_per_quarter`` is given.
+        :param base: NoteTable of the score the file was rendered from
+        :param fp: file name or binary file object
+        :param kwargs: see encode
+        :return: Variant
+        """
+        from .controllers import CONTROLLER_DTYPE
+
+        performed, control, ticks_per_quarter = midi_io.read_performance(fp)
+        kwargs.setdefault("ticks_per_quarter", ticks_per_quarter)
+        tempo_map = score_tempo_map(base)
+        data = np.zeros(len(performed), dtype=NOTE_DTYPE)
+        data['part'] = np.maximum(performed['track'] - 1, 0)
+        data['onset'] = tempo_map.quarters(performed['onset'])
+        data['duration'] = tempo_map.quarters(performed['offset']) - data['onset']
+        data['pitch'] = performed['pitch']
+        data['velocity'] = performed['velocity']
+        data['measure'] = _measure_of(base.measures, data['part'], data['onset'])
+        events = np.zeros(len(control), dtype=CONTROLLER_DTYPE)
+        events['time'] = tempo_map.quarters(control['time'])
+        events['part'] = np.maximum(control['track'] - 1, 0)
+        events['control'] = control['control']
+        events['value'] = control['value']
+        return cls.encode(base, NoteTable(data, base.measures), events, **kwargs)
+
+    def _check(self, base: NoteTable):
+        if base_key(base) != self.key:
+            raise ValueError("This variant was encoded against another score.")
+
+    def delta(self, field: str) -> np.ndarray:
+        """
+        Dense delta of a field over the base rows, in ticks for onset and duration.
+        :param field: one of FIELDS
+        :return: np.ndarray of int64
+        """
+        values = self.columns[f"delta.{field}"]
+        rows = self.columns.get(f"delta.{field}.rows")
+        if rows is None:
+            return values.astype(np.int64)
+        dense = np.zeros(self.base_rows, dtype=np.int64)
+        dense[rows] = values
+        return dense
+
+    def kept(self) -> np.ndarray:
+        """
+        Boolean mask of the base rows still played by the variant.
+        :return: np.ndarray of bool
+        """
+        mask = np.ones(self.base_rows, dtype=bool)
+        mask[self.columns["removed"]] = False
+        return mask
+
+    def controllers(self) -> np.ndarray:
+        """
+        Controller events of the variant.
+        :return: np.ndarray with controllers.CONTROLLER_DTYPE
+        """
+        from .controllers import CONTROLLER_DTYPE
+
+        events = np.zeros(len(self.columns["controllers.tick"]), dtype=CONTROLLER_DTYPE)
+        events['time'] = self.columns["controllers.tick"] / self.ticks_per_quarter
+        events['part'] = self.columns["controllers.part"]
+        events['control'] = self.columns["controllers.control"]
+        events['value'] = self.columns["controllers.value"]
+        return events
+
+    def values(self, base: NoteTable) -> dict:
+        """
+        Onset and duration (quarter lengths) and velocity of every base row in the variant.
+        Rows without a delta keep the base value exactly.
+        :param base: NoteTable of the score
+        :return: dict field -> np.ndarray over the base rows
+        """
+        self._check(base)
+        data = base.data
+        values = {}
+        for field in ("onset", "duration"):
+            delta = self.delta(field)
+            values[field] = np.where(delta != 0, (_ticks(data[field], self.ticks_per_quarter) + delta) /
+                                     self.ticks_per_quarter, data[field])
+        values["velocity"] = np.clip(data['velocity'] + self.delta("velocity"), 0, 127)
+        return values
+
+    def table(self, base: NoteTable) -> NoteTable:
+        """
+        Note table of the rendition. Added notes are single notes (no chord) and their beat
+        strength is 0, as for the ornament notes of ornaments.ornament_table.
+        :param base: NoteTable of the score
+        :return: NoteTable not tied to a stream
+        """
+        values = self.values(base)
+        data = np.array(base.data)
+        shift = values["onset"] - data['onset']
+        lengths = _beat_lengths(base.measures, data['part'], data['measure'])
+        data['onset'] = values["onset"]
+        data['offset'] += shift
+        data['beat'] += shift / lengths
+        data['duration'] = values["duration"]
+        data['velocity'] = values["velocity"]
+        data = data[self.kept()]
+
+        columns = self.columns
+        added = np.zeros(len(columns["added.part"]), dtype=NOTE_DTYPE)
+        added['part'] = columns["added.part"]
+        added['measure'] = columns["added.measure"]
+        added['onset'] = columns["added.onset"] / self.ticks_per_quarter
+        added['duration'] = columns["added.duration"] / self.ticks_per_quarter
+        added['pitch'] = columns["added.pitch"]
+        added['velocity'] = columns["added.velocity"]
+        added['offset'] = added['onset'] - _measure_offsets(base.measures, added['part'], added['measure'])
+        added['beat'] = 1.0 + added['offset'] / _beat_lengths(base.measures, added['part'], added['measure'])
+        next_chord = int(base.data['chord'].max()) + 1 if len(base.data) else 0
+        added['chord'] = np.arange(next_chord, next_chord + len(added))
+        added['component'] = -1
+        data = np.concatenate([data, added])
+        data = data[np.lexsort((data['component'], data['chord'], data['offset'], data['measure'], data['part']))]
+        return NoteTable(data, np.array(base.measures))
+
+    def to_midi(self, base: NoteTable, fp):
+        """
+        Write the rendition to a MIDI file, notes and controller events, without music21.
+        :param base: NoteTable of the score
+        :param fp: file name or binary file object
+        """
+        from .controllers import ControllerTrack
+
+        events = midi_io.table_events(self.table(base), self.ticks_per_quarter)
+        events = np.concatenate([events, ControllerTrack(self.controllers()).midi_events(self.ticks_per_quarter)])
+        midi_io.write_midi(midi_io.sort_events(events), fp, self.ticks_per_quarter)
+
+    def save(self, filename: str):
+        """
+        Write the variant to a .dmv file, see the module docstring.
+        :param filename: str
+        """
+        header = {"key": self.key, "base_rows": self.base_rows, "ticks_per_quarter": self.ticks_per_quarter,
+                  "meta": self.meta, "columns": {}}
+        position = 0
+        for name, values in self.columns.items():
+            header["columns"][name] = {"dtype": values.dtype.str, "length": len(values), "offset": position}
+            position += -(-values.nbytes // ALIGNMENT) * ALIGNMENT
+        encoded = json.dumps(header).encode()
+        start = -(-(len(MAGIC) + 8 + len(encoded)) // ALIGNMENT) * ALIGNMENT
+        tmp = filename + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(MAGIC + len(encoded).to_bytes(8, "little") + encoded)
+            for name, values in self.columns.items():
+                f.seek(start + header["columns"][name]["offset"])
+                f.write(np.ascontiguousarray(values).tobytes())
+            f.truncate(start + position)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename: str, mmap: bool = True) -> 'Variant':
+        """
+        Read a .dmv file, memory-mapped by default: the columns are read-only views of the
+        mapping and nothing is copied until used.
+        :param filename: str
+        :param mmap: False to read the file into memory instead
+        :return: Variant
+        """
+        if mmap and os.path.getsize(filename) > 0:
+            buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+        else:
+            with open(filename, "rb") as f:
+                buffer = np.frombuffer(f.read(), dtype=np.uint8)
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{filename} is not a variant file.")
+        length = int.from_bytes(bytes(buffer[len(MAGIC):len(MAGIC) + 8]), "little")
+        header = json.loads(bytes(buffer[len(MAGIC) + 8:len(MAGIC) + 8 + length]))
+        start = -(-(len(MAGIC) + 8 + length) // ALIGNMENT) * ALIGNMENT
+        columns = {}
+        for name, column in header["columns"].items():
+            dtype = np.dtype(column["dtype"])
+            offset = start + column["offset"]
+            columns[name] = buffer[offset:offset + column["length"] * dtype.itemsize].view(dtype)
+        return cls(columns, header["key"], header["base_rows"], header["ticks_per_quarter"], header["meta"])
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Size of the columns, without the header and alignment of the file.
+        """
+        return sum(values.nbytes for values in self.columns.values())
+
+
+def score_tempo_map(base: NoteTable) -> TempoMap:
+    """
+    Tempo map of the tempo marks of a score (120 bpm before the first one), as written
+    by table_events.
+    :param base: NoteTable
+    :return: TempoMap
+    """
+    measures = base.measures
+    conductor = measures[measures['part'] == (measures['part'].min() if len(measures) else 0)]
+    marked = conductor[conductor['tempo'] > 0]
+    positions = [0.0] + marked['offset'].tolist()
+    tempos = [120.0] + marked['tempo'].tolist()
+    end = float((measures['offset'] + measures['length']).max()) if len(measures) else 1.0
+    positions, tempos = positions + [max(end, positions[-1] + 1.0)], tempos + [tempos[-1]]
+    # a mark at 0 replaces the default tempo
+    keep = np.r_[np.diff(positions) > 0, True]
+    positions = np.array(positions)[keep]
+    tempos = np.array(tempos)[keep]
+    times = np.r_[0.0, np.cumsum(np.diff(positions) * 60.0 / tempos[:-1])]
+    return TempoMap(positions, times)
+
+
+def _measure_of(measures: np.ndarray, parts: np.ndarray, onsets: np.ndarray) -> np.ndarray:
+    """
+    Number of the measure holding each onset.
+    """
+    numbers = np.zeros(len(onsets), dtype=np.int64)
+    for part in np.unique(parts):
+        rows = measures[measures['part'] == part] if (measures['part'] == part).any() else \
+            measures[measures['part'] == measures['part'].min()]
+        rows = rows[np.argsort(rows['offset'], kind='stable')]
+        mask = parts == part
+        index = np.clip(np.searchsorted(rows['offset'], onsets[mask] + 1e-9, side='right') - 1, 0, len(rows) - 1)
+        numbers[mask] = rows['number'][index]
+    return numbers
+
+
+def _measure_offsets(measures: np.ndarray, parts: np.ndarray, numbers: np.ndarray) -> np.ndarray:
+    lookup = {(int(row['part']), int(row['number'])): float(row['offset']) for row in measures}
+    return np.array([lookup.get((int(p), int(n)), 0.0) for p, n in zip(parts, numbers)], dtype=float)
+
+
+def _beat_lengths(measures: np.ndarray, parts: np.ndarray, numbers: np.ndarray) -> np.ndarray:
+    """
+    Beat length of the time signature in force at every (part, measure), see beat_length.
+    """
+    lookup = {}
+    for part in np.unique(measures['part']):
+        current = 1.0
+        for row in np.sort(measures[measures['part'] == part], order='number'):
+            if row['numerator']:
+                current = beat_length(int(row['numerator']), int(row['denominator']))
+            lookup[(int(part), int(row['number']))] = current
+    keys = list(zip(np.asarray(parts).tolist(), np.asarray(numbers).tolist()))
+    cache = {key: lookup.get(key, 1.0) for key in set(keys)}
+    return np.array([cache[key] for key in keys], dtype=float)
+
+
+def diff(a: Variant, b: Variant, base: NoteTable) -> np.ndarray:
+    """
+    Base rows played differently by two variants of the same score, without building
+    either rendition.
+    :param a: Variant
+    :param b: Variant
+    :param base: NoteTable of the score
+    :return: np.ndarray with DIFF_DTYPE, in base row order
+    """
+    values = [v.values(base) for v in (a, b)]
+    kept = [v.kept() for v in (a, b)]
+    changed = kept[0] != kept[1]
+    for field in FIELDS:
+        changed |= values[0][field] != values[1][field]
+    rows = np.nonzero(changed)[0]
+    result = np.zeros(len(rows), dtype=DIFF_DTYPE)
+    result['row'] = rows
+    for field in ('part', 'measure', 'pitch'):
+        result[field] = base.data[field][rows]
+    for side in (0, 1):
+        for field in FIELDS:
+            column = values[side][field][rows]
+            if field == "velocity":
+                result[field][:, side] = np.where(kept[side][rows], column, 0)
+            else:
+                result[field][:, side] = np.where(kept[side][rows], column, np.nan)
+    return result
+
+
+def merge(a: Variant, b: Variant, start_measure: int = None, end_measure: int = None, fields=FIELDS,
+          base: NoteTable = None, meta: dict = None) -> Variant:
+    """
+    Variant taking ``fields`` from b in a range of measures and everything else from a,
+    e.g. the dynamics of one rendition with the timing of another. In the range, the
+    dropped and added notes and the controller events also come from b.
+    :param a: Variant
+    :param b: Variant of the same score
+    :param start_measure: first measure taken from b, the start of the score if None
+    :param end_measure: last measure taken from b, the end of the score if None
+    :param fields: delta fields taken from b, see FIELDS
+    :param base: NoteTable of the score, needed for a measure range
+    :param meta: optional dict of the new variant
+    :return: Variant, in memory
+    """
+    if (a.key, a.base_rows, a.ticks_per_quarter) != (b.key, b.base_rows, b.ticks_per_quarter):
+        raise ValueError("Only variants of the same score and resolution can be merged.")
+    if start_measure is None and end_measure is None:
+        in_range = np.ones(a.base_rows, dtype=bool)
+    else:
+        if base is None:
+            raise ValueError("Merging a measure range needs the base score.")
+        a._check(base)
+        low = start_measure if start_measure is not None else np.iinfo(np.int32).min
+        high = end_measure if end_measure is not None else np.iinfo(np.int32).max
+        in_range = (base.data['measure'] >= low) & (base.data['measure'] <= high)
+    columns = {}
+    for field in FIELDS:
+        _store_delta(columns, field,
+                     np.where(in_range, b.delta(field), a.delta(field)) if field in fields else a.delta(field))
+    kept = np.where(in_range, b.kept(), a.kept())
+    columns["removed"] = np.nonzero(~kept)[0].astype(np.int32)
+
+    if start_measure is None and end_measure is None:
+        def take_added(v):
+            return np.ones(len(v.columns["added.part"]), dtype=bool)
+
+        def take_controllers(v):
+            return np.ones(len(v.columns["controllers.tick"]), dtype=bool)
+    else:
+        measures = base.measures
+        first = measures[measures['number'] >= low]
+        last = measures[measures['number'] <= high]
+        low_tick = _ticks(first['offset'].min(), a.ticks_per_quarter) if len(first) else 0
+        high_tick = _ticks((last['offset'] + last['length']).max(), a.ticks_per_quarter) if len(last) else 0
+
+        def take_added(v):
+            return (v.columns["added.measure"] >= low) & (v.columns["added.measure"] <= high)
+
+        def take_controllers(v):
+            return (v.columns["controllers.tick"] >= low_tick) & (v.columns["controllers.tick"] < high_tick)
+    for prefix, take in (("added.", take_added), ("controllers.", take_controllers)):
+        from_a, from_b = ~take(a), take(b)
+        for name in [name for name in a.columns if name.startswith(prefix)]:
+            columns[name] = np.concatenate([a.columns[name][from_a], b.columns[name][from_b]])
+    order = np.argsort(columns["controllers.tick"], kind='stable')
+    for name in [name for name in columns if name.startswith("controllers.")]:
+        columns[name] = columns[name][order]
+    return Variant(columns, a.key, a.base_rows, a.ticks_per_quarter, meta)
+
+
+def format_diff(result: np.ndarray, ticks_per_quarter: int = midi_io.TICKS_PER_QUARTER) -> str:
+    """
+    Summarize a diff per measure: notes that differ and the mean absolute differences.
+    :param result: np.ndarray with DIFF_DTYPE
+    :param ticks_per_quarter: only used to show the timing differences in ticks
+    :return: str
+    """
+    lines = [f"{'measure':>8}{'notes':>7}{'onset':>10}{'duration':>10}{'velocity':>10}"]
+    for number in np.unique(result['measure']):
+        rows = result[result['measure'] == number]
+        with warnings.catch_warnings():
+            # measures where only dropped notes differ have no timing difference
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            onset = np.nanmean(np.abs(np.diff(rows['onset'], axis=1))) * ticks_per_quarter
+            duration = np.nanmean(np.abs(np.diff(rows['duration'], axis=1))) * ticks_per_quarter
+        velocity = np.abs(np.diff(rows['velocity'].astype(int), axis=1)).mean()
+        lines.append(f"{number:>8}{len(rows):>7}{onset:>10.1f}{duration:>10.1f}{velocity:>10.1f}")
+    lines.append(f"{'total':>8}{len(result):>7}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    from .utils import get_stream
+
+    parser = argparse.ArgumentParser(prog="python -m src.variants", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--score", default="./Berceuse_op_57/corrected_midi_score.mid",
+                        help="base score the variants are stored against")
+    commands = parser.add_subparsers(dest="command", required=True)
+    encode_parser = commands.add_parser("encode", help="store a rendered MIDI file as a variant")
+    encode_parser.add_argument("input", help="rendered MIDI file")
+    encode_parser.add_argument("output", help="output .dmv file")
+    diff_parser = commands.add_parser("diff", help="compare two variants measure by measure")
+    diff_parser.add_argument("a", help=".dmv file")
+    diff_parser.add_argument("b", help=".dmv file")
+    export_parser = commands.add_parser("export", help="write a variant to a MIDI file")
+    export_parser.add_argument("input", help=".dmv file")
+    export_parser.add_argument("output", help="output MIDI file")
+    args = parser.parse_args(argv)
+
+    base = NoteTable.from_stream(get_stream(args.score))
+    if args.command == "encode":
+        variant = Variant.from_midi(base, args.input)
+        variant.save(args.output)
+        print(f"{os.path.getsize(args.output)} bytes ({os.path.getsize(args.input)} as MIDI)", file=sys.stderr)
+    elif args.command == "diff":
+        a, b = Variant.load(args.a), Variant.load(args.b)
+        print(format_diff(diff(a, b, base), a.ticks_per_quarter))
+    else:
+        Variant.load(args.input).to_midi(base, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCORE = os.path.join(ROOT, "Berceuse_op_57", "corrected_midi_score.mid")
+PLAN = os.path.join(ROOT, "plans", "berceuse.json")
+
+
+@pytest.fixture
+def plan():
+    from src.render import load_plan
+
+    return load_plan(PLAN)
+
+
+def full_render(plan: dict, filename: str):
+    """
+    Render a plan on the score in one go and write it with the direct MIDI writer, the
+    writer of the incremental and playback paths.
+    """
+    from src.render import render
+    from src.utils import get_stream, save_midi
+
+    save_midi(render(get_stream(SCORE), plan), filename, fast=True)
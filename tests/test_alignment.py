@@ -0,0 +1,41 @@
+import numpy as np
+
+from src.alignment import _align_sequences
+
+
+def _cost(expected, performed, pairs, window):
+    unmatched = len(expected) + len(performed) - 2 * len(pairs)
+    return sum(abs(performed[j] - expected[i]) for i, j in pairs) + unmatched * window
+
+
+def _full_cost(expected, performed, window):
+    """Cheapest alignment cost, from the full cost table."""
+    n, m = len(expected), len(performed)
+    cost = np.zeros((n + 1, m + 1))
+    cost[0, :] = np.arange(m + 1) * window
+    cost[:, 0] = np.arange(n + 1) * window
+    for i in range(1, n + 1):
+        for j in range(1, m + 1):
+            distance = abs(performed[j - 1] - expected[i - 1])
+            diagonal = cost[i - 1, j - 1] + distance if distance <= window else np.inf
+            cost[i, j] = min(diagonal, cost[i - 1, j] + window, cost[i, j - 1] + window)
+    return cost[n, m]
+
+
+def test_banded_alignment_is_optimal():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        n, m = rng.integers(0, 25, 2)
+        expected = np.sort(rng.uniform(0, 10, n))
+        performed = np.sort(np.r_[expected[:m] + rng.normal(0, 0.2, min(n, m)), rng.uniform(0, 10, max(0, m - n))])
+        window = float(rng.choice([0.1, 0.35, 2.0]))
+        pairs = _align_sequences(expected, performed, window)
+        assert all(abs(performed[j] - expected[i]) <= window for i, j in pairs)
+        assert all(a[0] < b[0] and a[1] < b[1] for a, b in zip(pairs, pairs[1:]))
+        assert np.isclose(_cost(expected, performed, pairs, window), _full_cost(expected, performed, window))
+
+
+def test_shifted_performance_is_matched_note_for_note():
+    expected = np.arange(0, 50, 0.5)
+    pairs = _align_sequences(expected, expected + 0.05, 0.2)
+    assert pairs == [(i, i) for i in range(len(expected))]
@@ -0,0 +1,29 @@
+import json
+
+from src.batch import MANIFEST, completed_jobs, open_manifest
+
+
+def _write_manifest(directory, entries):
+    with open(directory / MANIFEST, "w") as f:
+        for entry in entries:
+            (directory / entry["output"]).write_bytes(b"")
+            f.write(json.dumps(entry) + "\n")
+        f.write('{"id": "cut')
+
+
+def test_resume_requires_the_same_kind_of_output(tmp_path):
+    _write_manifest(tmp_path, [{"id": "a", "output": "a.mid"},
+                               {"id": "b", "output": "b.mid", "scores": {"ioi_correlation": 0.5}},
+                               {"id": "c", "output": "c.dmv"}])
+    assert completed_jobs(str(tmp_path)) == {"a", "b"}
+    assert completed_jobs(str(tmp_path), evaluate=True) == {"b"}
+    assert completed_jobs(str(tmp_path), variants=True) == {"c"}
+    assert completed_jobs(str(tmp_path), evaluate=True, variants=True) == set()
+
+
+def test_entry_after_a_cut_line_is_read(tmp_path):
+    _write_manifest(tmp_path, [{"id": "a", "output": "a.mid"}])
+    (tmp_path / "b.mid").write_bytes(b"")
+    with open_manifest(str(tmp_path / MANIFEST)) as manifest:
+        manifest.write(json.dumps({"id": "b", "output": "b.mid"}) + "\n")
+    assert completed_jobs(str(tmp_path)) == {"a", "b"}
@@ -0,0 +1,22 @@
+import numpy as np
+from conftest import SCORE
+
+from src import midi_io
+from src.controllers import add_pedal_to_measures
+
+
+def _pedal_tracks(filename):
+    _, controls, _ = midi_io.read_performance(filename)
+    return np.bincount(controls['track'], minlength=3).tolist()
+
+
+def test_pedal_goes_to_the_track_of_its_part(tmp_path):
+    from src.utils import get_stream, save_midi
+
+    for part, counts in ((0, [0, 16, 0]), (1, [0, 0, 16])):
+        s = get_stream(SCORE)
+        add_pedal_to_measures(s, 1, 4, parts=[part])
+        for fast in (False, True):
+            filename = str(tmp_path / f"part{part}_{fast}.mid")
+            save_midi(s, filename, fast=fast)
+            assert _pedal_tracks(filename) == counts
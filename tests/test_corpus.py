@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from src import midi_io
+from src.corpus import CorpusStatistics, STATISTICS, corpus_jobs, load_table, process_corpus, table_prefix
+
+
+def _write_score(filename, pitches):
+    ticks = [i * midi_io.TICKS_PER_QUARTER for i in range(len(pitches))]
+    events = [midi_io.make_events(1, ticks, midi_io.NOTE_ON, 0, pitches, 80),
+              midi_io.make_events(1, [t + midi_io.TICKS_PER_QUARTER for t in ticks], midi_io.NOTE_OFF, 0, pitches)]
+    midi_io.write_midi(midi_io.sort_events(np.concatenate(events)), filename)
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    files = []
+    for k, pitches in enumerate(([60, 62, 64, 65], [67, 65, 64, 62, 60, 59, 60, 62])):
+        files.append(str(tmp_path / f"score{k}.mid"))
+        _write_score(files[-1], pitches)
+    return files
+
+
+def test_resume_skips_counted_files(inputs, tmp_path):
+    output = str(tmp_path / "out")
+    first = process_corpus(corpus_jobs(inputs[:1]), output, progress=None)
+    assert (first["processed"], first["skipped"]) == (1, 0)
+
+    second = process_corpus(corpus_jobs(inputs), output, progress=None)
+    assert (second["processed"], second["skipped"]) == (1, 1)
+    statistics = CorpusStatistics.load(str(tmp_path / "out" / STATISTICS))
+    assert statistics.counts().sum() == 12
+    for job in corpus_jobs(inputs):
+        assert len(load_table(table_prefix(output, job["id"]))) in (4, 8)
+
+
+def test_resume_refuses_another_table_format(inputs, tmp_path):
+    output = str(tmp_path / "out")
+    process_corpus(corpus_jobs(inputs[:1]), output, progress=None)
+    with pytest.raises(ValueError):
+        process_corpus(corpus_jobs(inputs), output, table_format="parquet", progress=None)
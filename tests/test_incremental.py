@@ -0,0 +1,30 @@
+import copy
+
+from src.incremental import MeasureCache, render_incremental
+
+from conftest import SCORE, full_render
+
+
+def test_partial_render_matches_full_render(plan, tmp_path):
+    plan["seed"] = 7
+    cache = MeasureCache(str(tmp_path / "measures"))
+    render_incremental(SCORE, plan, str(tmp_path / "first.mid"), cache)
+
+    changed = copy.deepcopy(plan)
+    for step in changed["steps"]:
+        if step["transform"] == "accentuate_highest_note_in_measure":
+            step["args"]["accent_factor"] = 1.3
+    counts = render_incremental(SCORE, changed, str(tmp_path / "partial.mid"), cache)
+    assert counts["rendered"] == 1
+
+    full_render(changed, str(tmp_path / "full.mid"))
+    assert (tmp_path / "partial.mid").read_bytes() == (tmp_path / "full.mid").read_bytes()
+
+
+def test_cold_render_matches_full_render(plan, tmp_path):
+    plan["seed"] = 3
+    counts = render_incremental(SCORE, plan, str(tmp_path / "cold.mid"), MeasureCache(str(tmp_path / "measures")))
+    assert counts["reused"] == 0
+
+    full_render(plan, str(tmp_path / "full.mid"))
+    assert (tmp_path / "cold.mid").read_bytes() == (tmp_path / "full.mid").read_bytes()
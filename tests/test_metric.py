@@ -0,0 +1,16 @@
+import numpy as np
+from conftest import SCORE
+
+from src.index import MeasureIndex
+
+
+def test_range_grid_matches_the_whole_score_grid():
+    from src.utils import get_stream
+
+    s = get_stream(SCORE)
+    full = MeasureIndex(s).metric()
+    for start, end in ((1, 70), (30, 40), (69, 69)):
+        grid = MeasureIndex(s).metric(start, end)
+        mask = full.select(start, end)
+        assert np.array_equal(grid.positions, full.positions[mask])
+        assert grid.elements == [e for e, keep in zip(full.elements, mask) if keep]
@@ -0,0 +1,26 @@
+from conftest import SCORE
+
+from src import midi_io
+
+
+def _hanging_notes(events):
+    sounding = {}
+    for event in events:
+        key = (event['track'], event['data1'])
+        if event['kind'] == midi_io.NOTE_ON:
+            sounding[key] = sounding.get(key, 0) + 1
+        elif event['kind'] == midi_io.NOTE_OFF and sounding.get(key):
+            sounding[key] -= 1
+    return sum(sounding.values())
+
+
+def test_zero_length_notes_are_released():
+    from src.notetable import NoteTable
+    from src.utils import get_stream
+
+    table = NoteTable.from_stream(get_stream(SCORE))
+    table.data['duration'][::7] = 0.0
+    events = midi_io.table_events(table)
+    assert _hanging_notes(events) == 0
+    notes = events[events['kind'] == midi_io.NOTE_ON]
+    assert len(notes) == len(table)
@@ -0,0 +1,66 @@
+import numpy as np
+from conftest import SCORE
+
+from src.notetable import NoteTable, change_duration_in_measures, change_velocity_measures
+
+
+def _table():
+    from src.utils import get_stream
+
+    return NoteTable.from_stream(get_stream(SCORE))
+
+
+def test_save_and_load(tmp_path):
+    table = _table()
+    table.save(str(tmp_path / "score"))
+    loaded = NoteTable.load(str(tmp_path / "score"))
+    assert np.array_equal(loaded.data, table.data)
+    assert np.array_equal(loaded.measures, table.measures)
+
+
+def _notes(data):
+    # to_stream merges the voices of a measure, so the rows and chord ids come in another order
+    fields = [name for name in data.dtype.names if name != 'chord']
+    return data[fields][np.lexsort((data['pitch'], data['offset'], data['measure'], data['part']))]
+
+
+def test_to_stream_round_trip():
+    table = _table()
+    rebuilt = NoteTable.from_stream(table.to_stream())
+    assert np.array_equal(_notes(rebuilt.data), _notes(table.data))
+    assert np.array_equal(rebuilt.measures, table.measures)
+
+
+def test_apply_to_stream_round_trip():
+    table = _table()
+    change_velocity_measures(table, 10, 20, 1.2)
+    table.data['duration'][table.select(30, 31)] *= 0.5
+    rebuilt = NoteTable.from_stream(table.apply_to_stream())
+    assert np.array_equal(rebuilt.data, table.data)
+
+
+def test_range_carries_the_context_without_building_earlier_measures():
+    from src.musicxml import LazyMeasureIndex, read_musicxml
+
+    index = LazyMeasureIndex(read_musicxml(SCORE.replace("corrected_midi_score.mid", "xml_score.musicxml")))
+    table = NoteTable.from_stream(index.stream, index, 30, 31)
+    assert {number for _, number in index._built} == {30, 31}
+    first = table.measures[table.measures['number'] == 30]
+    assert first['numerator'].tolist() == [6, 6] and first['denominator'].tolist() == [8, 8]
+    assert first['has_key'].all()
+
+
+def test_change_duration_matches_the_stream_path():
+    from src.timings import change_duration_in_measure
+    from src.utils import get_stream
+
+    s = get_stream(SCORE)
+    table = NoteTable.from_stream(s)
+    before = table.data['duration'].copy()
+    change_duration_in_measures(table, 3, 6, 0.5, 0.3)
+    assert np.count_nonzero(table.data['duration'] != before) == 20
+
+    # measures without voices, where the stream path sees every note
+    for number in range(3, 7):
+        change_duration_in_measure(s, number, 0.5, 0.3)
+    assert np.array_equal(NoteTable.from_stream(s).data['duration'], table.data['duration'])
@@ -0,0 +1,85 @@
+import copy
+
+import numpy as np
+from conftest import SCORE
+
+from src.articulations import apply_trill_to_hand_note
+from src.notetable import NoteTable
+from src.ornaments import apply_ornaments, ornament_table
+
+
+def _score(*voices):
+    """One-part score with one 6/8 measure holding the given voices of (offset, element)."""
+    from music21 import meter, stream
+
+    m = stream.Measure(number=1)
+    m.timeSignature = meter.TimeSignature("6/8")
+    if len(voices) == 1:
+        for offset, element in voices[0]:
+            m.insert(offset, element)
+    else:
+        for number, elements in enumerate(voices, 1):
+            voice = stream.Voice(id=str(number))
+            for offset, element in elements:
+                voice.insert(offset, element)
+            m.insert(0, voice)
+    part = stream.Part()
+    part.insert(0, m)
+    score = stream.Score()
+    score.insert(0, part)
+    return score
+
+
+def _note(pitch, length, velocity=80):
+    from music21 import note
+
+    n = note.Note(pitch, quarterLength=length)
+    n.volume.velocity = velocity
+    return n
+
+
+def _events(s):
+    """(measure offset, pitch, duration, velocity) of every note, in onset and pitch order."""
+    data = NoteTable.from_stream(s).data
+    order = np.lexsort((data['pitch'], data['offset']))
+    return [(float(row['offset']), int(row['pitch']), float(row['duration']), int(row['velocity']))
+            for row in data[order]]
+
+
+def test_chord_trill_holds_the_lower_notes():
+    from music21 import chord
+
+    c = chord.Chord([_note(60, 1.5), _note(64, 1.5), _note(67, 1.5)], quarterLength=1.5)
+    s = _score([(0.0, c)])
+    apply_trill_to_hand_note(s, "right", 1, 0, 1, 0.25, 1)
+    assert _events(s) == [(0.0, 60, 1.5, 80), (0.0, 64, 1.5, 80), (0.0, 67, 0.25, 80), (0.25, 68, 0.25, 64),
+                          (0.5, 67, 0.25, 72), (0.75, 68, 0.75, 64)]
+
+
+def test_trill_in_a_voice_keeps_its_offset():
+    s = _score([(0.0, _note(72, 1.5)), (1.5, _note(74, 1.5))], [(0.0, _note(48, 3.0))])
+    apply_ornaments(s, [{"kind": "trill", "part": 0, "measure": 1, "note_index": -1, "speed": 0.5}])
+    voices = list(s.parts[0].getElementsByClass('Measure')[0].voices)
+    assert [(float(n.offset), n.pitch.midi) for n in voices[0].notes] == [(0.0, 72), (1.5, 74), (2.0, 75), (2.5, 74)]
+    assert [n.pitch.midi for n in voices[1].notes] == [48]
+    assert _events(s) == [(0.0, 48, 3.0, 80), (0.0, 72, 1.5, 80), (1.5, 74, 0.5, 80), (2.0, 75, 0.5, 64),
+                          (2.5, 74, 0.5, 72)]
+
+
+def test_stream_and_table_paths_agree():
+    from src.benchmark import CASES
+    from src.utils import get_stream
+
+    ornaments = CASES["apply_ornaments"]["ornaments"]
+    s = get_stream(SCORE)
+    expected = ornament_table(NoteTable.from_stream(s), ornaments).data
+    data = NoteTable.from_stream(apply_ornaments(copy.deepcopy(s), ornaments)).data
+    order = np.lexsort((data['duration'], data['pitch'], data['onset'], data['part']))
+    expected_order = np.lexsort((expected['duration'], expected['pitch'], expected['onset'], expected['part']))
+
+    assert len(data) > len(NoteTable.from_stream(s))
+    for field in ('part', 'measure', 'pitch', 'velocity'):
+        assert np.array_equal(data[field][order], expected[field][expected_order])
+    # the stream path stores the lengths as music21 fractions
+    for field in ('onset', 'duration'):
+        assert np.allclose(data[field][order], expected[field][expected_order])
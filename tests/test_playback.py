@@ -0,0 +1,21 @@
+from src.incremental import MeasureCache
+from src.midi_io import read_notes
+from src.playback import RecorderSink, play
+
+from conftest import SCORE, full_render
+
+SPEED = 200
+
+
+def test_playback_matches_render(plan, tmp_path):
+    plan["seed"] = 3
+    sink = RecorderSink()
+    # fast and with the whole piece as lookahead, so the test does not wait for the music
+    play(SCORE, plan, sink, speed=SPEED, lookahead=1000, cache=MeasureCache(str(tmp_path / "measures")))
+    played = sorted((round(seconds * SPEED, 6), message[0] & 0x0F, message[1], message[2])
+                    for seconds, _, message in sink.messages if message[0] & 0xF0 == 0x90 and message[2] > 0)
+
+    full_render(plan, str(tmp_path / "full.mid"))
+    rendered = sorted((round(float(n['onset']), 6), int(n['channel']), int(n['pitch']), int(n['velocity']))
+                      for n in read_notes(str(tmp_path / "full.mid")))
+    assert played == rendered
@@ -0,0 +1,25 @@
+import numpy as np
+from conftest import SCORE
+
+from src import midi_io
+from src.notetable import NoteTable
+from src.variants import Variant
+
+
+def test_exported_variant_matches_rendition(plan, tmp_path):
+    from src.render import render
+    from src.utils import get_stream, save_midi
+
+    plan["seed"] = 3
+    base = NoteTable.from_stream(get_stream(SCORE))
+    rendered = render(get_stream(SCORE), plan)
+    save_midi(rendered, str(tmp_path / "rendered.mid"), fast=True)
+
+    Variant.from_stream(base, rendered).save(str(tmp_path / "variant.dmv"))
+    Variant.load(str(tmp_path / "variant.dmv")).to_midi(base, str(tmp_path / "exported.mid"))
+
+    notes, controls, _ = midi_io.read_performance(str(tmp_path / "rendered.mid"))
+    exported_notes, exported_controls, _ = midi_io.read_performance(str(tmp_path / "exported.mid"))
+    assert len(notes) and len(controls)
+    assert np.array_equal(exported_notes, notes)
+    assert np.array_equal(exported_controls, controls)